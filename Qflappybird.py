@@ -1,71 +1,184 @@
 import tensorflow as tf
 import numpy as np
-from collections import deque
+import collections
+import multiprocessing
+import os
+import pickle
 import random
+import shutil
 import sys
+import tempfile
+import threading
+import time
 import cv2
 
 import flappybird.flappy_new as game # Change to specific game
+from activations import ActivationRecorder
+from actorpool import ActorPool
+from checkpoint import CheckpointWriter
+from inference import InferenceServer
+from metrics import Metrics
+from planner import loadDemonstrations
+from replay import BatchPrefetcher, PrioritizedReplayMemory, ReplayMemory, ShardedReplayMemory
 
 GAME = 'flappybird' # Name used to store tensorflow data
 ACTIONS = 2 # Number of actions per game
 NOACTION = [1] + [0] * (ACTIONS - 1)  # No action performed
 GAMMA = 0.99 # Decay rate of past observations
+TARGET_SYNC = 10000 # Copy network weights to the target network every TARGET_SYNC iterations
+DOUBLE_DQN = True # Set to true to pick target actions with the network, not the target
 OBSERVE = True # Set to true to stop learning
 EXPLORE = 2000000 # Frames to learn (modify epsilon)
 INITIAL_EPSILON = 0.0001 # Initial value of epsilon
 FINAL_EPSILON = 0.0001 # Final value of epsilon
 REPLAY_MEMORY = 50000 # Number of previous frames to remember
+PACK_FRAMES = False # Set to true to store replay frames at one bit per pixel
+PRIORITIZED = False # Set to true to sample replay in proportion to TD error
+PRIORITY_ALPHA = 0.6 # How strongly TD error shapes sampling, 0 is uniform
+PRIORITY_BETA = 0.4 # Initial importance sampling correction, annealed to 1 over EXPLORE
 BATCH = 32 # Size of batch
+PREFETCH = 0 # Batches sampled ahead on a background thread, 0 samples them when needed
 FRAME_PER_ACTION = 1 # Frames to skip before action
 ACTION_FRAME = 1 # How many frames of actions to perform
+MAX_POOL = False # Set to true to max the last two frames of an action
 SAVE_TICK = 10000 # save progress every SAVE_TICK iterations
+KEEP_CHECKPOINTS = 3 # Newest checkpoints kept, besides the one with the highest training score
+HEADLESS = False # Set to true to run without window, sound or frame cap
+RASTER = False # Set to true to draw 80x80 observations instead of resizing frames
+FEATURES = False # Set to true to learn from game state features with an MLP instead of frames
+MLP_HIDDEN = 64 # Units in each of the two hidden layers of the MLP
+LEARNING_RATE = 1e-6 # Adam step size of the convolutional network
+MLP_LEARNING_RATE = 1e-4 # Adam step size of the MLP
+CHECKPOINT_DIR = 'saved_networks' # Directory to save and restore the network from
+REPLAY_DIR = None # Directory to keep replay memory in memory-mapped files, None keeps it in RAM
+TRAINER_STATE = 'trainer_state.pkl' # Step, epsilon and RNG states to resume from, in CHECKPOINT_DIR
+ACTORS = 0 # Number of actor threads playing while a learner trains, 0 plays and trains in turn
+ACTOR_SYNC = 100 # Actors pull network weights every ACTOR_SYNC learner steps
+REPORT_SECONDS = 10 # Print env steps/s and updates/s every REPORT_SECONDS with actors
+INFERENCE_SERVER = False # Set to true for actors to pick actions through one batched network
+INFERENCE_MAX_BATCH = 32 # Most actor requests evaluated together
+INFERENCE_MAX_WAIT = 0.002 # Seconds a request waits for others to join its batch
+WORKERS = 0 # Number of actor processes playing while a learner trains, used instead of ACTORS
+SHARED_REPLAY_ROOT = '/dev/shm' # Each run shares a new replay memory with workers in here, unless REPLAY_DIR is set
+LOG_DIR = 'logs_' + GAME # Directory of the rolling training metrics log
+METRICS_SECONDS = 60 # Seconds of training summarized by each line of the metrics log
+METRICS_PORT = None # Local port to serve training metrics over HTTP on, None serves nothing
+RECORD_ACTIVATIONS = False # Set to true to log every step's Q values to ACTIVATION_LOG
+ACTIVATION_LOG = LOG_DIR + '/activations.bin' # Binary log read with activations.ActivationLog
+HIDDEN_EVERY = 100 # Steps between the hidden layers kept in the activation log
+DEMONSTRATIONS = None # .npz of planner.py games to fill the replay memory with before training
+PRETRAIN_STEPS = 0 # Minibatches trained on the demonstrations before the first step
 
 
 """
-Generate network layers
-This is used to define convolution -> ROL layers
+Generate network weights
+Created in the order saved checkpoints name them (Variable, Variable_1, ...)
 """
-def createNetwork():
-    # Network Weights
+def createWeights():
+    weights = collections.OrderedDict()
     # Convolution Layer
-    WCONV_1 = weight_variable([8, 8, 4, 32])
-    BCONV_1 = b_conv1 = bias_variable([32])
+    weights['WCONV_1'] = weight_variable([8, 8, 4, 32])
+    weights['BCONV_1'] = bias_variable([32])
 
-    WCONV_2 = weight_variable([4, 4, 32, 64])
-    BCONV_2 = bias_variable([64])
+    weights['WCONV_2'] = weight_variable([4, 4, 32, 64])
+    weights['BCONV_2'] = bias_variable([64])
 
-    WCONV_3 = weight_variable([3, 3, 64, 64])
-    BCONV_3 = bias_variable([64])
+    weights['WCONV_3'] = weight_variable([3, 3, 64, 64])
+    weights['BCONV_3'] = bias_variable([64])
 
     # Fully Connected Linear Layer 
-    WFCL_1 = weight_variable([1600, 512])
-    BFCL_1 = bias_variable([512])
+    weights['WFCL_1'] = weight_variable([1600, 512])
+    weights['BFCL_1'] = bias_variable([512])
 
-    WFCL_2 = weight_variable([512, ACTIONS])
-    BFCL_2 = bias_variable([ACTIONS])
+    weights['WFCL_2'] = weight_variable([512, ACTIONS])
+    weights['BFCL_2'] = bias_variable([ACTIONS])
+    return weights
 
-    # Input Layer
-    IL = tf.placeholder("float", [None, 80, 80, 4])
+"""
+Generate MLP weights for stacks of feature vectors
+"""
+def createFeatureWeights():
+    weights = collections.OrderedDict()
+    inputs = game.FEATURECOUNT * 4
+    weights['WMLP_1'] = weight_variable([inputs, MLP_HIDDEN])
+    weights['BMLP_1'] = bias_variable([MLP_HIDDEN])
+
+    weights['WMLP_2'] = weight_variable([MLP_HIDDEN, MLP_HIDDEN])
+    weights['BMLP_2'] = bias_variable([MLP_HIDDEN])
+
+    weights['WMLP_3'] = weight_variable([MLP_HIDDEN, ACTIONS])
+    weights['BMLP_3'] = bias_variable([ACTIONS])
+    return weights
+
+"""
+Generate MLP layers on input IL, a stack of feature vectors
+"""
+def mlpLayers(IL, weights):
+    IL_FLAT = tf.reshape(IL, [-1, game.FEATURECOUNT * 4])
+    H_MLP1 = tf.nn.relu(tf.matmul(IL_FLAT, weights['WMLP_1']) + weights['BMLP_1'])
+    H_FCL = tf.nn.relu(tf.matmul(H_MLP1, weights['WMLP_2']) + weights['BMLP_2'])
+    ROL = tf.matmul(H_FCL, weights['WMLP_3']) + weights['BMLP_3']
+    return ROL, H_FCL
+
+"""
+Shape of a stack of the last 4 network inputs
+"""
+def getStackShape():
+    if FEATURES:
+        return [game.FEATURECOUNT, 4]
+    return [80, 80, 4]
+
+"""
+Generate network layers on input IL
+This is used to define convolution -> ROL layers
+"""
+def networkLayers(IL, weights):
+    if 'WMLP_1' in weights:
+        return mlpLayers(IL, weights)
 
     # Hidden Layers
-    H_CONV1 = tf.nn.relu(conv2d(IL, WCONV_1, 4) + BCONV_1)
+    H_CONV1 = tf.nn.relu(conv2d(IL, weights['WCONV_1'], 4) + weights['BCONV_1'])
     H_POOL1 = max_pool_2x2(H_CONV1)
 
-    H_CONV2 = tf.nn.relu(conv2d(H_POOL1, WCONV_2, 2) + BCONV_2)
+    H_CONV2 = tf.nn.relu(conv2d(H_POOL1, weights['WCONV_2'], 2) + weights['BCONV_2'])
     #H_POOL2 = max_pool_2x2(H_CONV2)
 
-    H_CONV3 = tf.nn.relu(conv2d(H_CONV2, WCONV_3, 1) + BCONV_3)
+    H_CONV3 = tf.nn.relu(conv2d(H_CONV2, weights['WCONV_3'], 1) + weights['BCONV_3'])
     #H_POOL3 = max_pool_2x2(H_CONV3)
 
     H_CONV_FLAT = tf.reshape(H_CONV3, [-1, 1600])
 
-    H_FCL = tf.nn.relu(tf.matmul(H_CONV_FLAT, WFCL_1) + BFCL_1)
+    H_FCL = tf.nn.relu(tf.matmul(H_CONV_FLAT, weights['WFCL_1']) + weights['BFCL_1'])
 
     # Readout Output Layer
-    ROL = tf.matmul(H_FCL, WFCL_2) + BFCL_2
+    ROL = tf.matmul(H_FCL, weights['WFCL_2']) + weights['BFCL_2']
+
+    return ROL, H_FCL
+
+"""
+Generate network weights and layers
+"""
+def createNetwork():
+    # Network Weights
+    weights = createFeatureWeights() if FEATURES else createWeights()
+
+    # Input Layer
+    IL = tf.placeholder("float", [None] + getStackShape())
 
-    return IL, ROL, H_FCL
+    ROL, H_FCL = networkLayers(IL, weights)
+
+    return IL, ROL, H_FCL, weights
+
+"""
+Copy network weights into variables only changed by the returned sync op
+Targets or actions computed from the copy stay fixed between syncs
+"""
+def copyWeights(weights):
+    target_weights = collections.OrderedDict()
+    for name, weight in weights.items():
+        target_weights[name] = tf.Variable(weight.initialized_value(), trainable = False)
+    sync = tf.group(*[tf.assign(target_weights[name], weights[name]) for name in weights])
+    return target_weights, sync
 
 def weight_variable(shape):
     initial = tf.truncated_normal(shape, stddev = 0.01)
@@ -87,50 +200,288 @@ Placeholders are used as inputs for the rest of the model
 """
 def placeholder_inputs():
     action_placeholder = tf.placeholder("float", [None, ACTIONS])
-    labels_placeholder = tf.placeholder("float", [None])
-    return action_placeholder, labels_placeholder
+    reward_placeholder = tf.placeholder("float", [None])
+    terminal_placeholder = tf.placeholder("float", [None])
+    next_placeholder = tf.placeholder("float", [None] + getStackShape())
+    weights_placeholder = tf.placeholder("float", [None])
+    return action_placeholder, reward_placeholder, terminal_placeholder, \
+        next_placeholder, weights_placeholder
 
 """
 Create cost function
+Bellman targets are computed in the graph from the target network, so one
+session run performs a whole update. Squared TD errors are scaled by
+importance sampling weights, all 1 for uniform replay. The TD errors are
+returned to update replay priorities
 """
-def cost_function(ROL):
-    action_placeholder, labels_placeholder = placeholder_inputs()
+def cost_function(ROL, weights, target_weights):
+    placeholders = placeholder_inputs()
+    action_placeholder, reward_placeholder, terminal_placeholder, \
+        next_placeholder, weights_placeholder = placeholders
+
+    # if terminal only equals reward
+    next_target, _ = networkLayers(next_placeholder, target_weights)
+    if DOUBLE_DQN:
+        next_readout, _ = networkLayers(next_placeholder, weights)
+        next_action = tf.one_hot(tf.argmax(next_readout, 1), ACTIONS)
+        next_value = tf.reduce_sum(tf.mul(next_target, next_action), reduction_indices = 1)
+    else:
+        next_value = tf.reduce_max(next_target, reduction_indices = 1)
+    labels = tf.stop_gradient(
+        reward_placeholder + GAMMA * tf.mul(1.0 - terminal_placeholder, next_value))
+
     readout_action = tf.reduce_sum(tf.mul(ROL, action_placeholder), reduction_indices = 1)
-    cost = tf.reduce_mean(tf.square(labels_placeholder - readout_action))
-    train_step = tf.train.AdamOptimizer(1e-6).minimize(cost)
-    return action_placeholder, labels_placeholder, train_step
+    td_error = labels - readout_action
+    cost = tf.reduce_mean(tf.mul(weights_placeholder, tf.square(td_error)))
+    train_step = tf.train.AdamOptimizer(MLP_LEARNING_RATE if FEATURES else LEARNING_RATE) \
+        .minimize(cost)
+    return placeholders, train_step, td_error
 
 """
-Learn/Train network
+Convert a game frame to the binary 80x80 network input
+Rasterized observations are already in this form, features are used as they are
 """
-def trainNetwork(IL, ROL, H_FCL, sess):
-    # Cost function
-    action_placeholder, labels_placeholder, train_step = cost_function(ROL)
+def preprocess(image_data):
+    if RASTER or FEATURES:
+        return image_data
+    image_data = cv2.cvtColor(cv2.resize(image_data, (80, 80)), cv2.COLOR_BGR2GRAY)
+    ret, image_data = cv2.threshold(image_data,1,255,cv2.THRESH_BINARY)
+    return image_data
 
-    # Setup game
-    game_state = game.GameState()
+"""
+Capture what is needed to resume training from step t besides the network variables
+"""
+def getTrainerState(t, epsilon):
+    return {
+        't': t,
+        'epsilon': epsilon,
+        'random': random.getstate(),
+        'numpy': np.random.get_state(),
+    }
 
-    # Store previous frames in memory using double ended queue
-    DEQ = deque()
+"""
+Save a trainer state as belonging to checkpoint_path
+Written to a temporary file and renamed so a crash never leaves half of it
+"""
+def saveTrainerState(checkpoint_path, state):
+    state = dict(state, checkpoint = checkpoint_path)
+    path = os.path.join(CHECKPOINT_DIR, TRAINER_STATE)
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
 
-    # Start the first frame of the game ane preprocess the image to 80x80x4
-    image_data, reward, terminal = game_state.frame_step(NOACTION)
-    image_data = cv2.cvtColor(cv2.resize(image_data, (80, 80)), cv2.COLOR_BGR2GRAY)
-    ret, image_data = cv2.threshold(image_data,1,255,cv2.THRESH_BINARY)
-    replay_stack_1 = np.stack((image_data, image_data, image_data, image_data), axis = 2)
+"""
+Load the trainer state saved together with checkpoint_path, or None
+"""
+def loadTrainerState(checkpoint_path):
+    path = os.path.join(CHECKPOINT_DIR, TRAINER_STATE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as f:
+        state = pickle.load(f)
+    if os.path.basename(state['checkpoint']) != os.path.basename(checkpoint_path):
+        return None
+    return state
+
+"""
+Setup game
+headless defaults to HEADLESS as it is set when the game is created
+"""
+def createGame(headless = None):
+    if headless is None:
+        headless = HEADLESS
+    observation = 'features' if FEATURES else 'raster' if RASTER else 'image'
+    return game.GameState(headless = headless, observation = observation,
+                          frameSkip = ACTION_FRAME, maxPool = MAX_POOL)
+
+"""
+Store previous frames in a preallocated replay memory
+Given shards, every writer gets its own part of the memory, locked with lock
+"""
+def createMemory(shards = 0, directory = REPLAY_DIR, lock = threading.Lock):
+    if PRIORITIZED:
+        memory_class, options = PrioritizedReplayMemory, {'alpha' : PRIORITY_ALPHA}
+    else:
+        memory_class, options = ReplayMemory, {}
+    if FEATURES:
+        options.update(frameShape = (game.FEATURECOUNT,), dtype = np.float32)
+    packed = PACK_FRAMES and not FEATURES
+    if shards:
+        return ShardedReplayMemory(shards, REPLAY_MEMORY, memory_class, directory = directory,
+                                   lock = lock, actions = ACTIONS, packed = packed,
+                                   **options)
+    return memory_class(REPLAY_MEMORY, actions = ACTIONS, packed = packed,
+                        directory = directory, **options)
 
-    # Load previously saved model or start anew
-    saver = tf.train.Saver()
+"""
+Every variable but the weight copies in copies, what checkpoints hold
+This also covers the Adam slots created by cost_function. Copies are synced
+from the restored weights
+"""
+def getSavedVariables(*copies):
+    copy_names = set(w.name for weights in copies for w in weights.values())
+    return [v for v in tf.all_variables() if v.name not in copy_names]
+
+"""
+Create a saver to restore checkpoints and a writer to save them in the background
+The writer's snapshot variables are copies too
+"""
+def createSaver(sess, *copies):
+    writer = CheckpointWriter(sess, getSavedVariables(*copies),
+                              CHECKPOINT_DIR, GAME + '-dqn', KEEP_CHECKPOINTS)
+    saver = tf.train.Saver(getSavedVariables(writer.shadows, *copies))
+    return saver, writer
+
+"""
+Save a checkpoint at step t without waiting for it to be written, along with
+the replay memory and trainer state, also written in the background. It is
+ranked for retention by the mean of recent_scores, the training score of
+games played with exploration since the last checkpoint
+Prints how long training was held up
+"""
+def saveCheckpoint(writer, memory, t, epsilon, recent_scores):
+    stall_start = time.time()
+    position = memory.getPosition()
+    state = getTrainerState(t, epsilon)
+    training_score = None
+    if recent_scores:
+        training_score = float(np.mean([score for seconds, score in recent_scores]))
+
+    def onSaved(checkpoint_path):
+        memory.save(position)
+        saveTrainerState(checkpoint_path, state)
+
+    writer.save(t, training_score, onSaved)
+    print("checkpoint %d stall %.1f ms" % (t, (time.time() - stall_start) * 1000))
+
+"""
+Load previously saved model or start anew
+Returns the step counter and epsilon to continue from
+"""
+def restoreNetwork(sess, saver):
     sess.run(tf.initialize_all_variables())
-    checkpoint = tf.train.get_checkpoint_state("saved_networks")
+    epsilon = INITIAL_EPSILON
+    t = 0
+    checkpoint = tf.train.get_checkpoint_state(CHECKPOINT_DIR)
     if checkpoint and checkpoint.model_checkpoint_path:
         saver.restore(sess, checkpoint.model_checkpoint_path)
 
-    epsilon = INITIAL_EPSILON
-    t = 0
+        # Resume step counter, epsilon schedule and random generators
+        state = loadTrainerState(checkpoint.model_checkpoint_path)
+        if state is not None:
+            t = state['t']
+            epsilon = state['epsilon']
+            random.setstate(state['random'])
+            np.random.set_state(state['numpy'])
+    return t, epsilon
+
+"""
+Importance sampling exponent at step t, annealed to 1 over EXPLORE
+"""
+def getBeta(t):
+    return min(1.0, PRIORITY_BETA + t * (1.0 - PRIORITY_BETA) / EXPLORE)
+
+"""
+Sample minibatches ahead on a background thread if PREFETCH is set
+get_t returns the current step, lock is held while sampling a memory that
+doesn't lock itself
+"""
+def createPrefetcher(memory, get_t, lock = None):
+    if not PREFETCH or OBSERVE:
+        return None
+    prefetcher = BatchPrefetcher(memory, BATCH, lambda: getBeta(get_t()), PREFETCH, lock)
+    prefetcher.start()
+    return prefetcher
+
+"""
+Take the next minibatch at step t, sampled now or by the prefetcher
+"""
+def getBatch(memory, prefetcher, t):
+    if prefetcher is None:
+        return memory.sampleWeighted(BATCH, getBeta(t))
+    return prefetcher.get()
+
+"""
+Perform a gradient step on a minibatch, targets are computed in the same run
+Returns the TD errors to update replay priorities with
+"""
+def trainBatch(sess, IL, placeholders, train_step, td_error, batch):
+    action_placeholder, reward_placeholder, terminal_placeholder, \
+        next_placeholder, weights_placeholder = placeholders
+    batch_replay_stack_1, batch_action, batch_reward, batch_replay_stack_2, \
+        batch_terminal, batch_weights, batch_ids = batch
+
+    _, batch_td_error = sess.run([train_step, td_error], feed_dict = {
+        action_placeholder : batch_action,
+        reward_placeholder : batch_reward,
+        terminal_placeholder : batch_terminal,
+        next_placeholder : batch_replay_stack_2,
+        weights_placeholder : batch_weights,
+        IL : batch_replay_stack_1})
+    return batch_td_error
+
+"""
+Learn/Train network
+Runs forever, or for max_seconds and then returns the (seconds, score) of
+every finished game
+"""
+def trainNetwork(IL, ROL, H_FCL, sess, weights, max_seconds = None):
+    # Target network and cost function
+    target_weights, sync_target = copyWeights(weights)
+    placeholders, train_step, td_error = cost_function(ROL, weights, target_weights)
+
+    game_state = createGame()
+    memory = createMemory()
+    saver, writer = createSaver(sess, target_weights)
+    t, epsilon = restoreNetwork(sess, saver)
+    sess.run(sync_target)
+
+    # Demonstrations only go into a fresh start, a resumed run learned from them
+    # already and a memory kept in REPLAY_DIR still holds them
+    demonstrate = DEMONSTRATIONS is not None and t == 0 and len(memory) == 0
+    if demonstrate:
+        loadDemonstrations(memory, DEMONSTRATIONS)
+
+    # Start the first frame of the game ane preprocess the image to 80x80x4
+    image_data, reward, terminal = game_state.frame_step(NOACTION)
+    image_data = preprocess(image_data)
+    replay_stack_1 = np.stack((image_data, image_data, image_data, image_data), axis = -1)
+    memory.start(image_data)
+
+    # Learn from the demonstrations before playing
+    if demonstrate and not OBSERVE:
+        for i in range(PRETRAIN_STEPS):
+            batch = memory.sampleWeighted(BATCH, getBeta(0))
+            batch_td_error = trainBatch(sess, IL, placeholders, train_step, td_error, batch)
+            memory.updatePriorities(batch[-1], batch_td_error)
+            if (i + 1) % TARGET_SYNC == 0:
+                sess.run(sync_target)
+        sess.run(sync_target)
+
+    # The prefetcher samples while this loop writes, the lock keeps them apart
+    memory_lock = threading.Lock()
+    prefetcher = createPrefetcher(memory, lambda: t, memory_lock)
+    metrics = Metrics(LOG_DIR, GAME, METRICS_SECONDS, port = METRICS_PORT)
+    recorder = None
+    if RECORD_ACTIVATIONS:
+        recorder = ActivationRecorder(ACTIVATION_LOG, ACTIONS, int(H_FCL.get_shape()[1]),
+                                      HIDDEN_EVERY)
+
+    start_time = time.time()
+    scores = []
+    saved_games = 0 # Games finished before the last checkpoint
+    score = 0
     while True:
+        clock = metrics.now()
         # Choose an action epsilon greedily
-        readout_tick = ROL.eval(feed_dict = {IL : [replay_stack_1]})[0]
+        if recorder is None:
+            readout_tick = ROL.eval(feed_dict = {IL : [replay_stack_1]})[0]
+        else:
+            # the hidden layer comes out of the same run
+            readout_tick, hidden_tick = sess.run([ROL, H_FCL],
+                                                 feed_dict = {IL : [replay_stack_1]})
+            readout_tick = readout_tick[0]
+            recorder.record(t, readout_tick, hidden_tick[0])
         action = np.zeros([ACTIONS])
         action_index = 0
         if t % FRAME_PER_ACTION == 0:
@@ -143,62 +494,373 @@ def trainNetwork(IL, ROL, H_FCL, sess):
         # Not action frame
         else:
             action = NOACTION
+        clock = metrics.lap('act', clock)
 
         # Reduce epsilon (More learnt actions)
         if epsilon > FINAL_EPSILON and t > OBSERVE:
             epsilon -= (INITIAL_EPSILON - FINAL_EPSILON) / EXPLORE
 
-        for i in range(0, ACTION_FRAME):
-            # Run selected action and update image,replay data
-            image_data_col, reward, terminal = game_state.frame_step(action)
-            image_data_gray = cv2.cvtColor(cv2.resize(image_data_col, (80, 80)), cv2.COLOR_BGR2GRAY)
-            ret, image_data_gray = cv2.threshold(image_data_gray,1,255,cv2.THRESH_BINARY)
-            image_data_gray = np.reshape(image_data_gray, (80, 80, 1))
-            replay_stack_2 = np.append(image_data_gray, replay_stack_1[:,:,:3], axis = 2)
+        # Run selected action for ACTION_FRAME frames and update image,replay data
+        image_data_col, reward, terminal = game_state.frame_step(action)
+        clock = metrics.lap('env', clock)
+        image_data_gray = preprocess(image_data_col)
+        clock = metrics.lap('preprocess', clock)
 
-            # Store replay data
-            DEQ.append((replay_stack_1, action, reward, replay_stack_2, terminal))
-            if len(DEQ) > REPLAY_MEMORY:
-                DEQ.popleft()
+        # Store replay data
+        with memory_lock:
+            memory.append(image_data_gray, np.argmax(action), reward, terminal)
+        clock = metrics.lap('insert', clock)
 
         # Train after generating enough observation data
         if t > BATCH and (not OBSERVE):
-            # Train on batch selected randomly
-            batch = random.sample(DEQ, BATCH)
-
-            # get the batch variables
-            batch_replay_stack_1 = [d[0] for d in batch]
-            batch_action = [d[1] for d in batch]
-            batch_reward = [d[2] for d in batch]
-            batch_replay_stack_2 = [d[3] for d in batch]
-
-            batch_y = []
-            batch_readout = ROL.eval(feed_dict = {IL : batch_replay_stack_2})
-            for i in range(0, len(batch)):
-                # if terminal only equals reward
-                if batch[i][4]:
-                    batch_y.append(batch_reward[i])
-                else:
-                    batch_y.append(batch_reward[i] + GAMMA * np.max(batch_readout[i]))
-
-            # perform gradient step
-            train_step.run(feed_dict = {
-                labels_placeholder : batch_y,
-                action_placeholder : batch_action,
-                IL : batch_replay_stack_1})
-
-        # Update replay stack
-        replay_stack_1 = replay_stack_2
+            # Train on batch selected randomly, or by priority
+            batch = getBatch(memory, prefetcher, t)
+            clock = metrics.lap('sample', clock)
+            batch_td_error = trainBatch(sess, IL, placeholders, train_step, td_error, batch)
+            with memory_lock:
+                memory.updatePriorities(batch[-1], batch_td_error)
+            clock = metrics.lap('train', clock)
+
+        # Keep score of finished games
+        if reward > 0:
+            score += 1
+        if terminal:
+            scores.append((time.time() - start_time, score))
+            metrics.score(score)
+            score = 0
+
+        # Update replay stack, a terminal frame starts the next game
+        if terminal:
+            replay_stack_1 = np.stack((image_data_gray,) * 4, axis = -1)
+        else:
+            replay_stack_1 = np.append(image_data_gray[..., None],
+                                       replay_stack_1[..., :3], axis = -1)
         t += 1
 
+        # Refresh the target network
+        if t % TARGET_SYNC == 0:
+            sess.run(sync_target)
+
         # Save after set iterations        
         if t % SAVE_TICK == 0:
-            saver.save(sess, 'saved_networks/' + GAME + '-dqn', global_step = t)
+            clock = metrics.now()
+            with memory_lock:
+                saveCheckpoint(writer, memory, t, epsilon, scores[saved_games:])
+            saved_games = len(scores)
+            metrics.lap('save', clock)
+
+        if metrics.isDue():
+            metrics.gauge('t', t)
+            metrics.gauge('epsilon', epsilon)
+            metrics.gauge('replay_occupancy', len(memory) / float(memory.capacity))
+            if prefetcher is not None:
+                metrics.gauge('prefetch_wait_seconds', prefetcher.waitTime)
+        metrics.tick()
+
+        if max_seconds is not None and time.time() - start_time > max_seconds:
+            if prefetcher is not None:
+                prefetcher.close()
+            writer.wait()
+            metrics.close()
+            if recorder is not None:
+                recorder.close()
+            return scores
+
+"""
+Learn/Train network with actor threads playing while the learner trains
+Every actor steps its own headless game into its shard of the replay memory
+and picks actions with its own copy of the network, pulled every ACTOR_SYNC
+learner steps. With INFERENCE_SERVER actors share one copy instead, batched
+by an InferenceServer. Runs forever, or for max_seconds and then returns the
+(seconds, score) of every finished game
+"""
+def trainNetworkAsync(IL, ROL, H_FCL, sess, weights, actors = ACTORS, max_seconds = None):
+    # Target network and cost function
+    target_weights, sync_target = copyWeights(weights)
+    placeholders, train_step, td_error = cost_function(ROL, weights, target_weights)
+
+    # Actor networks read the same input layer
+    actor_networks = []
+    for index in range(1 if INFERENCE_SERVER else actors):
+        actor_weights, sync_actor = copyWeights(weights)
+        actor_ROL, _ = networkLayers(IL, actor_weights)
+        actor_networks.append((actor_weights, actor_ROL, sync_actor))
+
+    memory = createMemory(shards = actors)
+    saver, writer = createSaver(sess, target_weights, *[network[0] for network in actor_networks])
+    start_t, start_epsilon = restoreNetwork(sess, saver)
+    sess.run(sync_target)
+
+    # Screen images are all drawn on the one pygame display, one at a time
+    render_lock = threading.Lock()
+    stop = threading.Event()
+    steps = [0] * actors # Env steps per actor
+    updates = [0] # Learner steps
+    scores = []
+    saved_games = 0 # Games finished before the last checkpoint
+    start_time = time.time()
+
+    def getEpsilon():
+        # Reduce epsilon (More learnt actions) over the steps of all actors
+        return max(FINAL_EPSILON,
+                   start_epsilon - (INITIAL_EPSILON - FINAL_EPSILON) * sum(steps) / EXPLORE)
+
+    def getEvaluate(network):
+        # Evaluate Q values with an actor network, pulling refreshed weights first
+        actor_weights, actor_ROL, sync_actor = network
+        synced = [None]
+        def evaluate(stacks):
+            if updates[0] // ACTOR_SYNC != synced[0]:
+                synced[0] = updates[0] // ACTOR_SYNC
+                sess.run(sync_actor)
+            return actor_ROL.eval(feed_dict = {IL : stacks})
+        return evaluate
+
+    server = None
+    if INFERENCE_SERVER:
+        server = InferenceServer(getEvaluate(actor_networks[0]), INFERENCE_MAX_BATCH,
+                                 INFERENCE_MAX_WAIT, tuple(getStackShape()),
+                                 np.float32 if FEATURES else np.uint8)
+        server.start()
+
+    def actor(index):
+        if server is None:
+            evaluate = getEvaluate(actor_networks[index])
+        actor_random = random.Random(random.getrandbits(64))
+        # a new game sets the display mode, replacing the screen others draw on
+        with render_lock:
+            game_state = createGame(headless = True)
+            image_data, reward, terminal = game_state.frame_step(NOACTION)
+        image_data = preprocess(image_data)
+        replay_stack_1 = np.stack((image_data,) * 4, axis = -1)
+        memory.start(index, image_data)
+
+        score = 0
+        t = 0
+        while not stop.is_set():
+            # Choose an action epsilon greedily
+            action = np.zeros([ACTIONS])
+            if t % FRAME_PER_ACTION == 0:
+                # Random action
+                if actor_random.random() <= getEpsilon():
+                    action[actor_random.randrange(ACTIONS)] = 1
+                # Learnt action
+                elif server is not None:
+                    action[server.act(replay_stack_1)[0]] = 1
+                else:
+                    readout_tick = evaluate([replay_stack_1])[0]
+                    action[np.argmax(readout_tick)] = 1
+            # Not action frame
+            else:
+                action = NOACTION
+
+            # Run selected action for ACTION_FRAME frames and store replay data
+            if RASTER or FEATURES:
+                image_data_col, reward, terminal = game_state.frame_step(action)
+            else:
+                with render_lock:
+                    image_data_col, reward, terminal = game_state.frame_step(action)
+            image_data_gray = preprocess(image_data_col)
+            memory.append(index, image_data_gray, np.argmax(action), reward, terminal)
+
+            # Keep score of finished games
+            if reward > 0:
+                score += 1
+            if terminal:
+                scores.append((time.time() - start_time, score))
+                score = 0
+
+            # Update replay stack, a terminal frame starts the next game
+            if terminal:
+                replay_stack_1 = np.stack((image_data_gray,) * 4, axis = -1)
+            else:
+                replay_stack_1 = np.append(image_data_gray[..., None],
+                                           replay_stack_1[..., :3], axis = -1)
+            t += 1
+            steps[index] = t
+
+    threads = [threading.Thread(target = actor, args = (index,)) for index in range(actors)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    # Shards lock themselves, the prefetcher needs no lock of its own
+    prefetcher = createPrefetcher(memory, lambda: start_t + sum(steps))
+    report_time, report_steps, report_updates = start_time, 0, 0
+    idle = 0.0 # Seconds the learner waited for batches since the last report
+    while True:
+        # Train continuously once enough observation data is stored
+        if not OBSERVE and len(memory) > BATCH and memory.getMass() > 0:
+            wait_start = time.time()
+            batch = getBatch(memory, prefetcher, start_t + sum(steps))
+            idle += time.time() - wait_start
+            batch_td_error = trainBatch(sess, IL, placeholders, train_step, td_error, batch)
+            memory.updatePriorities(batch[-1], batch_td_error)
+            updates[0] += 1
+
+            # Refresh the target network
+            if updates[0] % TARGET_SYNC == 0:
+                sess.run(sync_target)
+
+            # Save after set iterations
+            if updates[0] % SAVE_TICK == 0:
+                saved_scores = scores[saved_games:]
+                saved_games += len(saved_scores)
+                saveCheckpoint(writer, memory, start_t + sum(steps), getEpsilon(), saved_scores)
+        else:
+            time.sleep(0.01)
+
+        # Throughput counters, to tune the number of actors against the learner
+        now = time.time()
+        if now - report_time >= REPORT_SECONDS:
+            total_steps = sum(steps)
+            print("env steps/s %.1f updates/s %.1f learner idle %.1f%%" % (
+                (total_steps - report_steps) / (now - report_time),
+                (updates[0] - report_updates) / (now - report_time),
+                100.0 * idle / (now - report_time)))
+            if server is not None:
+                print("inference %s" % server.getStats())
+            report_time, report_steps, report_updates = now, total_steps, updates[0]
+            idle = 0.0
+
+        if max_seconds is not None and now - start_time > max_seconds:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            if server is not None:
+                server.close()
+            if prefetcher is not None:
+                prefetcher.close()
+            writer.wait()
+            return scores
+
+"""
+Fork workers playing into a replay memory in shared memory, before
+TensorFlow starts any threads. The memory is kept in REPLAY_DIR if set,
+otherwise in a new directory of SHARED_REPLAY_ROOT removed by stopWorkers.
+Returns the memory, the started ActorPool and the directory to remove
+"""
+def startWorkers(workers = WORKERS):
+    if PRIORITIZED:
+        raise ValueError("Prioritized replay can't be shared with worker processes")
+    if FEATURES:
+        raise ValueError("Worker processes act on frames, set WORKERS = 0 with FEATURES")
+
+    created = None
+    directory = REPLAY_DIR
+    if directory is None:
+        created = directory = tempfile.mkdtemp(prefix = 'flappybird_replay_',
+                                               dir = SHARED_REPLAY_ROOT)
+    try:
+        context = multiprocessing.get_context('fork')
+        memory = createMemory(shards = workers, directory = directory, lock = context.Lock)
+
+        # Workers render headless, there is one pygame display per process.
+        # They act randomly until the learner publishes weights
+        pool = ActorPool(workers, memory, lambda: createGame(headless = True), preprocess,
+                         (INITIAL_EPSILON, FINAL_EPSILON, (INITIAL_EPSILON - FINAL_EPSILON) / EXPLORE),
+                         actions = ACTIONS, framePerAction = FRAME_PER_ACTION)
+        pool.start()
+    except BaseException:
+        if created is not None:
+            shutil.rmtree(created)
+        raise
+    return memory, pool, created
+
+"""
+Stop the workers of startWorkers and remove the replay memory it created
+"""
+def stopWorkers(pool, directory):
+    pool.close()
+    if directory is not None:
+        shutil.rmtree(directory)
+
+"""
+Learn/Train network with worker processes playing while the learner trains
+Workers of startWorkers write straight into a replay memory in shared memory
+and act on weights published to them every ACTOR_SYNC learner steps, see
+ActorPool. Runs forever, or for max_seconds and then returns the
+(seconds, score) of every finished game
+"""
+def trainNetworkProcesses(IL, ROL, H_FCL, sess, weights, memory, pool, max_seconds = None):
+    # Target network and cost function
+    target_weights, sync_target = copyWeights(weights)
+    placeholders, train_step, td_error = cost_function(ROL, weights, target_weights)
+
+    saver, writer = createSaver(sess, target_weights)
+    start_t, start_epsilon = restoreNetwork(sess, saver)
+    sess.run(sync_target)
+    start_t -= pool.getSteps() # Steps the workers took while the network was restored
+    pool.resume(start_epsilon)
+    pool.publish(dict(zip(weights.keys(), sess.run(list(weights.values())))))
+
+    prefetcher = createPrefetcher(memory, lambda: start_t + pool.getSteps())
+    scores = []
+    saved_games = 0 # Games finished before the last checkpoint
+    updates = 0
+    start_time = time.time()
+    report_time, report_steps, report_updates = start_time, 0, 0
+    idle = 0.0 # Seconds the learner waited for batches since the last report
+    while True:
+        # Train continuously once enough observation data is stored
+        if not OBSERVE and len(memory) > BATCH and memory.getMass() > 0:
+            wait_start = time.time()
+            batch = getBatch(memory, prefetcher, start_t + pool.getSteps())
+            idle += time.time() - wait_start
+            batch_td_error = trainBatch(sess, IL, placeholders, train_step, td_error, batch)
+            memory.updatePriorities(batch[-1], batch_td_error)
+            updates += 1
+
+            # Refresh the target network and the workers' weights
+            if updates % TARGET_SYNC == 0:
+                sess.run(sync_target)
+            if updates % ACTOR_SYNC == 0:
+                pool.publish(dict(zip(weights.keys(), sess.run(list(weights.values())))))
+
+            # Save after set iterations
+            if updates % SAVE_TICK == 0:
+                saveCheckpoint(writer, memory, start_t + pool.getSteps(), pool.getEpsilon(),
+                               scores[saved_games:])
+                saved_games = len(scores)
+        else:
+            time.sleep(0.01)
+        scores.extend(pool.getScores())
+
+        # Throughput counters, to tune the number of workers against the learner
+        now = time.time()
+        if now - report_time >= REPORT_SECONDS:
+            total_steps = pool.getSteps()
+            print("env steps/s %.1f updates/s %.1f learner idle %.1f%%" % (
+                (total_steps - report_steps) / (now - report_time),
+                (updates - report_updates) / (now - report_time),
+                100.0 * idle / (now - report_time)))
+            report_time, report_steps, report_updates = now, total_steps, updates
+            idle = 0.0
+
+        if max_seconds is not None and now - start_time > max_seconds:
+            pool.close()
+            if prefetcher is not None:
+                prefetcher.close()
+            writer.wait()
+            return scores + pool.getScores()
 
 def playGame():
+    if WORKERS:
+        # Fork before the session exists, its thread pools don't survive a fork
+        memory, pool, directory = startWorkers(WORKERS)
+        try:
+            sess = tf.InteractiveSession()
+            IL, ROL, H_FCL, weights = createNetwork()
+            trainNetworkProcesses(IL, ROL, H_FCL, sess, weights, memory, pool)
+        finally:
+            stopWorkers(pool, directory)
+        return
     sess = tf.InteractiveSession()
-    IL, ROL, H_FCL = createNetwork()
-    trainNetwork(IL, ROL, H_FCL, sess)
+    IL, ROL, H_FCL, weights = createNetwork()
+    if ACTORS:
+        trainNetworkAsync(IL, ROL, H_FCL, sess, weights)
+    else:
+        trainNetwork(IL, ROL, H_FCL, sess, weights)
 
 def main():
     playGame()
@@ -0,0 +1,248 @@
+"""
+Append-only binary log of the Q values and hidden activations of a network,
+written in chunks by a background thread, and a reader that memory-maps it
+Usage: python activations.py [log file], prints a summary of the log
+"""
+import json
+import os
+import queue
+import struct
+import sys
+import threading
+
+import numpy as np
+
+LOG = 'logs_flappybird/activations.bin' # Default log read by main
+CHUNK_ROWS = 1024 # Steps buffered before a chunk is handed to the writer thread
+MAGIC = b'QLG1'
+# magic, kind, dtype code, padding, rows, columns, first step
+HEADER = struct.Struct('<4sBB2xIIq')
+READOUT, HIDDEN = 0, 1 # Chunk kinds
+DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<f2')}
+DTYPE_CODES = dict((dtype, code) for code, dtype in DTYPES.items())
+
+
+"""
+Bytes of a chunk of rows steps and rows x columns values, padded so the
+next header starts 8 byte aligned
+"""
+def getChunkSize(rows, columns, dtype):
+    size = HEADER.size + 8 * rows + dtype.itemsize * rows * columns
+    return size + -size % 8
+
+
+"""
+Chunks of the log in data, a uint8 array, as (kind, offset, rows, columns,
+dtype), and the byte the last complete chunk ends at. A chunk cut short by
+a crash ends the scan
+"""
+def scanChunks(data, path):
+    index = []
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        magic, kind, code, rows, columns, first = HEADER.unpack_from(data, offset)
+        if magic != MAGIC or code not in DTYPES:
+            raise ValueError('%s: no chunk at byte %d' % (path, offset))
+        size = getChunkSize(rows, columns, DTYPES[code])
+        if offset + size > len(data):
+            break
+        index.append((kind, offset, rows, columns, DTYPES[code]))
+        offset += size
+    return index, offset
+
+"""
+Memory map of the log at path, an empty array for an empty file
+"""
+def mapLog(path):
+    if not os.path.getsize(path):
+        return np.zeros(0, dtype = np.uint8)
+    return np.memmap(path, dtype = np.uint8, mode = 'r')
+
+
+class ChunkBuffer:
+    """Rows of one kind collected for the next chunk"""
+
+    def __init__(self, kind, columns, dtype, rows = CHUNK_ROWS):
+        self.kind = kind
+        self.dtype = dtype
+        self.steps = np.empty(rows, dtype = np.int64)
+        self.values = np.empty((rows, columns), dtype = dtype)
+        self.rows = 0
+
+    def append(self, step, values):
+        """adds a row, returns whether the buffer is full"""
+        self.steps[self.rows] = step
+        self.values[self.rows] = values
+        self.rows += 1
+        return self.rows == len(self.steps)
+
+    def toBytes(self):
+        rows, columns = self.rows, self.values.shape[1]
+        header = HEADER.pack(MAGIC, self.kind, DTYPE_CODES[self.dtype], rows, columns,
+                             int(self.steps[0]))
+        data = header + self.steps[:rows].tobytes() + self.values[:rows].tobytes()
+        return data + b'\0' * (getChunkSize(rows, columns, self.dtype) - len(data))
+
+
+class ActivationRecorder:
+    """Records the readout of every step and the hidden layer of every
+    hiddenEvery-th step to an append-only log at path.
+
+    record() only copies into a preallocated chunk, full chunks are written
+    by a background thread. Readouts are float32, hidden activations float16.
+    A run that is killed loses at most its unwritten chunks, the reader skips
+    a chunk cut short, and the next recorder on the log cuts it off before
+    appending."""
+
+    def __init__(self, path, actions = 2, hiddenUnits = 512, hiddenEvery = 100,
+                 chunkRows = CHUNK_ROWS):
+        self.path = path
+        self.hiddenEvery = hiddenEvery
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.readouts = ChunkBuffer(READOUT, actions, DTYPES[0], chunkRows)
+        self.hidden = ChunkBuffer(HIDDEN, hiddenUnits, DTYPES[1], chunkRows)
+        self.chunks = queue.Queue()
+        if os.path.exists(path):
+            data = mapLog(path)
+            end = scanChunks(data, path)[1]
+            size = len(data)
+            del data
+            if end < size:
+                # a crashed run left part of a chunk, later ones would follow it
+                os.truncate(path, end)
+        self.file = open(path, 'ab')
+        self.thread = threading.Thread(target = self.write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wantsHidden(self, step):
+        """whether record() keeps the hidden layer at step"""
+        return step % self.hiddenEvery == 0
+
+    def record(self, step, readout, hidden = None):
+        if self.readouts.append(step, readout):
+            self.readouts = self.handOff(self.readouts)
+        if hidden is not None and self.wantsHidden(step):
+            if self.hidden.append(step, hidden):
+                self.hidden = self.handOff(self.hidden)
+
+    def handOff(self, buffer):
+        """queues buffer for writing, returns an empty one like it"""
+        self.chunks.put(buffer)
+        return ChunkBuffer(buffer.kind, buffer.values.shape[1], buffer.dtype,
+                           len(buffer.steps))
+
+    def write(self):
+        while True:
+            buffer = self.chunks.get()
+            if buffer is None:
+                return
+            self.file.write(buffer.toBytes())
+            self.file.flush()
+
+    def close(self):
+        """writes what is buffered and waits for the writer"""
+        for buffer in (self.readouts, self.hidden):
+            if buffer.rows:
+                self.chunks.put(buffer)
+        self.chunks.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+class ActivationLog:
+    """Reads a log written by ActivationRecorder through a memory map.
+
+    Opening it only reads the chunk headers, chunks() yields views into the
+    map, so logs larger than memory can be summarized a chunk at a time."""
+
+    def __init__(self, path):
+        self.path = path
+        self.data = mapLog(path)
+        # (kind, offset, rows, columns, dtype)
+        self.index = scanChunks(self.data, path)[0]
+
+    def chunks(self, kind):
+        """(steps, values) views of every chunk of kind"""
+        for chunkKind, offset, rows, columns, dtype in self.index:
+            if chunkKind != kind:
+                continue
+            start = offset + HEADER.size
+            steps = self.data[start:start + 8 * rows].view(np.int64)
+            start += 8 * rows
+            values = self.data[start:start + dtype.itemsize * rows * columns].view(dtype)
+            yield steps, values.reshape(rows, columns)
+
+    def getRows(self, kind):
+        return sum(rows for chunkKind, offset, rows, columns, dtype in self.index
+                   if chunkKind == kind)
+
+    def summarizeReadouts(self):
+        """Q value statistics per action and how often each is greedy"""
+        count, total, squares = 0, 0.0, 0.0
+        lowest, highest, greedy, gap = None, None, None, 0.0
+        first = last = None
+        for steps, values in self.chunks(READOUT):
+            values = values.astype(np.float64)
+            if greedy is None:
+                greedy = np.zeros(values.shape[1], dtype = np.int64)
+                lowest, highest = values.min(axis = 0), values.max(axis = 0)
+                first = int(steps[0])
+            count += len(values)
+            total = total + values.sum(axis = 0)
+            squares = squares + (values ** 2).sum(axis = 0)
+            lowest = np.minimum(lowest, values.min(axis = 0))
+            highest = np.maximum(highest, values.max(axis = 0))
+            greedy += np.bincount(values.argmax(axis = 1), minlength = values.shape[1])
+            ordered = np.sort(values, axis = 1)
+            gap += (ordered[:, -1] - ordered[:, -2]).sum()
+            last = int(steps[-1])
+        if not count:
+            return {'steps': 0}
+        mean = total / count
+        return {
+            'steps': count,
+            'first step': first,
+            'last step': last,
+            'q mean': mean.tolist(),
+            'q std': np.sqrt(np.maximum(squares / count - mean ** 2, 0)).tolist(),
+            'q min': lowest.tolist(),
+            'q max': highest.tolist(),
+            'greedy share': (greedy / float(count)).tolist(),
+            'q gap mean': float(gap / count),
+        }
+
+    def summarizeHidden(self):
+        """mean activation per unit and the share of units never active"""
+        count, total, active = 0, 0.0, None
+        for steps, values in self.chunks(HIDDEN):
+            values = values.astype(np.float32)
+            if active is None:
+                active = np.zeros(values.shape[1], dtype = bool)
+            count += len(values)
+            total = total + values.sum(axis = 0, dtype = np.float64)
+            active |= (values > 0).any(axis = 0)
+        if not count:
+            return {'samples': 0}
+        mean = total / count
+        return {
+            'samples': count,
+            'activation mean': float(mean.mean()),
+            'dead units': float(1 - active.mean()),
+            'unit mean max': float(mean.max()),
+        }
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else LOG
+    log = ActivationLog(path)
+    print(json.dumps({
+        'file bytes': len(log.data),
+        'chunks': len(log.index),
+        'readout': log.summarizeReadouts(),
+        'hidden': log.summarizeHidden(),
+    }, indent = 2))
+
+if __name__ == "__main__":
+    main()
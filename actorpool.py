@@ -0,0 +1,187 @@
+import multiprocessing
+import queue
+import random
+import time
+
+import numpy as np
+
+import network
+
+
+class SharedWeights:
+    """Network weights in shared memory, published by the learner and read
+    by every actor process.
+
+    A version counter is odd while weights are being published, readers
+    retry instead of taking a lock."""
+
+    def __init__(self, shapes, context):
+        self.shapes = list(shapes.items())
+        sizes = [int(np.prod(shape)) for name, shape in self.shapes]
+        self.offsets = np.cumsum([0] + sizes)
+        self.buffer = context.RawArray('f', int(self.offsets[-1]))
+        self.version = context.RawValue('q', 0)
+
+    def getArrays(self):
+        """views of the weights in the shared buffer, by name"""
+        flat = np.frombuffer(self.buffer, dtype = np.float32)
+        return dict((name, flat[start:end].reshape(shape)) for (name, shape), start, end
+                    in zip(self.shapes, self.offsets[:-1], self.offsets[1:]))
+
+    def publish(self, weights):
+        """copies weights, a dict of arrays, to every reader"""
+        self.version.value += 1
+        arrays = self.getArrays()
+        for name, array in arrays.items():
+            array[...] = weights[name]
+        self.version.value += 1
+
+    def read(self, version):
+        """returns the current version and a copy of the weights, or None
+        if they are still at version"""
+        while True:
+            current = self.version.value
+            if current == version:
+                return None
+            if current % 2:
+                time.sleep(0)
+                continue
+            weights = dict((name, array.copy()) for name, array in self.getArrays().items())
+            if self.version.value == current:
+                return current, weights
+
+
+class ActorPool:
+    """Worker processes each stepping their own game into their shard of a
+    ShardedReplayMemory.
+
+    The memory has to be memory-mapped and use multiprocessing locks, so
+    transitions land in shared memory without pickling. Actions come from
+    network.forward on the weights last published with publish(). Workers
+    are forked, so makeGame and preprocess are never pickled either.
+
+    makeGame() returns a GameState, preprocess turns its frames into 80x80
+    observations. epsilon is (start, final, decay per pool step), every
+    worker anneals its own epsilon with the steps of the whole pool. The
+    start can be moved with resume() once the workers run, so the pool can
+    be forked before the learner restores its checkpoint."""
+
+    def __init__(self, workers, memory, makeGame, preprocess, epsilon, actions = 2,
+                 framePerAction = 1):
+        self.workers = workers
+        self.memory = memory
+        self.makeGame = makeGame
+        self.preprocess = preprocess
+        self.epsilon = epsilon
+        self.actions = actions
+        self.framePerAction = framePerAction
+
+        self.context = multiprocessing.get_context('fork')
+        self.weights = SharedWeights(network.getWeightShapes(actions), self.context)
+        self.steps = self.context.RawArray('q', workers) # env steps per worker
+        self.startEpsilon = self.context.RawValue('d', epsilon[0])
+        self.scores = self.context.Queue()
+        self.finished = [] # scores taken off the queue, not returned yet
+        self.stop = self.context.Event()
+        self.processes = []
+        self.startTime = None
+
+    def start(self):
+        self.startTime = time.time()
+        for index in range(self.workers):
+            seed = random.getrandbits(32)
+            process = self.context.Process(target = self.run, args = (index, seed))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+
+    def close(self):
+        """stops and waits for every worker"""
+        self.stop.set()
+        for process in self.processes:
+            # a worker only exits once its queued scores are taken
+            while process.is_alive():
+                self.drainScores()
+                process.join(0.1)
+        self.drainScores()
+        self.processes = []
+
+    def publish(self, weights):
+        self.weights.publish(weights)
+
+    def resume(self, epsilon):
+        """continues annealing from epsilon, where a restored learner left off"""
+        decay = self.epsilon[2]
+        self.startEpsilon.value = epsilon + decay * sum(self.steps)
+
+    def getSteps(self):
+        return sum(self.steps)
+
+    def drainScores(self):
+        while True:
+            try:
+                self.finished.append(self.scores.get_nowait())
+            except queue.Empty:
+                return
+
+    def getScores(self):
+        """(seconds, score) of the games finished since the last call"""
+        self.drainScores()
+        scores, self.finished = self.finished, []
+        return scores
+
+    def getEpsilon(self):
+        final, decay = self.epsilon[1:]
+        return max(final, self.startEpsilon.value - decay * sum(self.steps))
+
+    def run(self, index, seed):
+        """worker loop, runs until close()"""
+        rng = random.Random(seed)
+        # forked workers start with the same random state, games seed from it
+        random.seed(seed)
+        np.random.seed(seed)
+        noAction = np.zeros([self.actions])
+        noAction[0] = 1
+
+        game_state = self.makeGame()
+        image_data, reward, terminal = game_state.frame_step(noAction)
+        image_data = self.preprocess(image_data)
+        stack = np.stack((image_data,) * 4, axis = 2)
+        self.memory.start(index, image_data)
+
+        version, weights = 0, None
+        score = 0
+        t = 0
+        while not self.stop.is_set():
+            update = self.weights.read(version)
+            if update is not None:
+                version, weights = update
+
+            # Choose an action epsilon greedily, randomly until weights arrive
+            action = noAction
+            if t % self.framePerAction == 0:
+                action = np.zeros([self.actions])
+                if weights is None or rng.random() <= self.getEpsilon():
+                    action[rng.randrange(self.actions)] = 1
+                else:
+                    readout, hidden = network.forward(weights, stack[None])
+                    action[np.argmax(readout[0])] = 1
+
+            image_data, reward, terminal = game_state.frame_step(action)
+            image_data = self.preprocess(image_data)
+            self.memory.append(index, image_data, np.argmax(action), reward, terminal)
+
+            # Keep score of finished games
+            if reward > 0:
+                score += 1
+            if terminal:
+                self.scores.put((time.time() - self.startTime, score))
+                score = 0
+
+            # a terminal frame starts the next game
+            if terminal:
+                stack = np.stack((image_data,) * 4, axis = 2)
+            else:
+                stack = np.append(image_data[:, :, None], stack[:, :, :3], axis = 2)
+            t += 1
+            self.steps[index] = t
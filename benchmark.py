@@ -0,0 +1,571 @@
+from collections import deque
+import contextlib
+import multiprocessing
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import sys
+
+import cv2
+import numpy as np
+import pygame
+
+import flappybird.flappy_new as game
+import network
+from actorpool import ActorPool
+from inference import InferenceServer
+from replay import BatchPrefetcher, PackedFrameStore, ReplayMemory, ShardedReplayMemory
+from flappybird import collision
+from flappybird.flappy_vector import VectorGameState
+
+STEPS = 2000 # Number of frame steps timed per benchmark
+DISPLAY_STEPS = 90 # Displayed mode is capped at game.FPS, keep it short
+WORKER_SECONDS = 5 # Seconds each actor pool size is timed for
+INFERENCE_CLIENTS = 32 # Threads requesting actions from the inference server
+RASTER_AGREEMENT = 1.0 # Share of pixels the rasterizer has to match cv2 preprocessing in
+REPLAY_FRAMES = 5000 # Distinct game frames the replay memory benchmark cycles through
+DEQUE_TRANSITIONS = 10000 # Most transitions the deque benchmark holds, 51 KB each
+
+"""
+Time frame_step and return steps per second
+"""
+def benchFrameStep(headless, steps):
+    game_state = game.GameState(headless = headless)
+    action = [1, 0]
+    start = time.time()
+    for i in range(steps):
+        game_state.frame_step(action)
+    return steps / (time.time() - start)
+
+"""
+Compare headless and displayed simulation speed
+"""
+def benchHeadless():
+    results = {}
+    # Displayed mode first, headless mode would otherwise start the one
+    # display of the process on the dummy video driver
+    if '--no-display' not in sys.argv:
+        results['displayed'] = benchFrameStep(False, DISPLAY_STEPS)
+    results['headless'] = benchFrameStep(True, STEPS)
+    return results
+
+"""
+Time frame_step with frame skipping and return simulated frames per second
+"""
+def benchFrameSkip(frameSkip, steps, observation = 'raster'):
+    game_state = game.GameState(headless = True, observation = observation,
+                                frameSkip = frameSkip)
+    action = [1, 0]
+    start = time.time()
+    for i in range(steps):
+        game_state.frame_step(action)
+    return frameSkip * steps / (time.time() - start)
+
+"""
+Time VectorGameState.step and return game steps per second
+"""
+def benchVector(n, steps):
+    games = VectorGameState(n, seed = 0)
+    actions = np.random.RandomState(0).rand(steps, n) < 0.1
+    start = time.time()
+    for i in range(steps):
+        games.step(actions[i])
+    return n * steps / (time.time() - start)
+
+"""
+Compare rasterized observations with the cv2 preprocessing of full frames
+over a seeded game, failing if fewer than RASTER_AGREEMENT of pixels match
+Returns the fraction of matching pixels and the cost per frame of both paths
+"""
+def benchRaster(steps):
+    game_state = game.GameState(headless = True, seed = 0)
+    actions = np.random.RandomState(0).rand(steps) < 0.1
+    same = 0
+    cv2Time = rasterTime = 0.0
+    for i in range(steps):
+        game_state.frame_step([1 - actions[i], actions[i]])
+
+        start = time.time()
+        image_data = pygame.surfarray.array3d(pygame.display.get_surface())
+        image_data = cv2.cvtColor(cv2.resize(image_data, (80, 80)), cv2.COLOR_BGR2GRAY)
+        ret, image_data = cv2.threshold(image_data,1,255,cv2.THRESH_BINARY)
+        cv2Time += time.time() - start
+
+        start = time.time()
+        observation = game_state.getObservation()
+        rasterTime += time.time() - start
+
+        same += np.count_nonzero(observation == image_data)
+    agreement = same / float(steps * image_data.size)
+    if agreement < RASTER_AGREEMENT:
+        raise AssertionError('rasterized observations match cv2 in %.5f of pixels' % agreement)
+    return agreement, cv2Time / steps, rasterTime / steps
+
+"""
+Hitmask and collision check as they were before flappybird.collision,
+kept as the baseline for benchCheckCrash
+"""
+def legacyGetHitmask(image):
+    mask = []
+    for x in range(image.get_width()):
+        mask.append([])
+        for y in range(image.get_height()):
+            mask[x].append(bool(image.get_at((x,y))[3]))
+    return mask
+
+def legacyPixelCollision(rect1, rect2, hitmask1, hitmask2):
+    rect = rect1.clip(rect2)
+
+    if rect.width == 0 or rect.height == 0:
+        return False
+
+    x1, y1 = rect.x - rect1.x, rect.y - rect1.y
+    x2, y2 = rect.x - rect2.x, rect.y - rect2.y
+
+    for x in range(rect.width):
+        for y in range(rect.height):
+            if hitmask1[x1+x][y1+y] and hitmask2[x2+x][y2+y]:
+                return True
+    return False
+
+def legacyCheckCrash(player, upperPipes, lowerPipes, hitmasks):
+    pi = player['index']
+    player['w'] = game.IMAGES['player'][0].get_width()
+    player['h'] = game.IMAGES['player'][0].get_height()
+
+    if player['y'] + player['h'] >= game.BASEY - 1:
+        return [True, True]
+
+    playerRect = pygame.Rect(player['x'], player['y'], player['w'], player['h'])
+    pipeW = game.IMAGES['pipe'][0].get_width()
+    pipeH = game.IMAGES['pipe'][0].get_height()
+
+    for uPipe, lPipe in zip(upperPipes, lowerPipes):
+        uPipeRect = pygame.Rect(uPipe['x'], uPipe['y'], pipeW, pipeH)
+        lPipeRect = pygame.Rect(lPipe['x'], lPipe['y'], pipeW, pipeH)
+
+        pHitMask = hitmasks['player'][pi]
+        uCollide = legacyPixelCollision(playerRect, uPipeRect, pHitMask, hitmasks['pipe'][0])
+        lCollide = legacyPixelCollision(playerRect, lPipeRect, pHitMask, hitmasks['pipe'][1])
+
+        if uCollide or lCollide:
+            return [True, False]
+
+    return [False, False]
+
+"""
+Time getHitmask and checkCrash on states recorded from a game
+Returns seconds per call for the legacy and the NumPy implementation
+"""
+def benchCheckCrash(steps):
+    game_state = game.GameState(headless = True, observation = 'raster')
+    actions = np.random.RandomState(0).rand(steps) < 0.1
+    states = []
+    for i in range(steps):
+        game_state.frame_step([1 - actions[i], actions[i]])
+        states.append(({'x': game_state.playerx, 'y': game_state.playery,
+                        'index': game_state.playerIndex},
+                       [dict(pipe) for pipe in game_state.upperPipes],
+                       [dict(pipe) for pipe in game_state.lowerPipes]))
+
+    images = [game.IMAGES['pipe'][0], game.IMAGES['pipe'][1]] + list(game.IMAGES['player'])
+    results = {}
+    start = time.time()
+    legacyHitmasks = {
+        'pipe': [legacyGetHitmask(image) for image in game.IMAGES['pipe']],
+        'player': [legacyGetHitmask(image) for image in game.IMAGES['player']],
+    }
+    results['getHitmask legacy'] = (time.time() - start) / len(images)
+    start = time.time()
+    for image in images:
+        collision.getHitmask(image)
+    results['getHitmask numpy'] = (time.time() - start) / len(images)
+
+    start = time.time()
+    for player, upperPipes, lowerPipes in states:
+        legacyCheckCrash(player, upperPipes, lowerPipes, legacyHitmasks)
+    results['checkCrash legacy'] = (time.time() - start) / steps
+    start = time.time()
+    for player, upperPipes, lowerPipes in states:
+        game_state.checkCrash(player, upperPipes, lowerPipes)
+    results['checkCrash numpy'] = (time.time() - start) / steps
+    return results
+
+"""
+Raster frames of games played with random flaps, the actions taken and
+whether each frame ended a game
+"""
+def getGameFrames(count, seed = 0):
+    rng = np.random.RandomState(seed)
+    game_state = game.GameState(headless = True, observation = 'raster', seed = seed)
+    frames = np.empty((count, 80, 80), dtype = np.uint8)
+    actions = (rng.rand(count) < 0.1).astype(np.int64)
+    terminals = np.zeros(count, dtype = bool)
+    for i in range(count):
+        frames[i], reward, terminals[i] = game_state.frame_step(np.eye(2)[actions[i]])
+    return frames, actions, terminals
+
+"""
+Memory use and sample latency of ReplayMemory against a deque holding two
+stacks per transition, both filled with game frames. The replay memory
+cycles through REPLAY_FRAMES of them up to its capacity, the deque holds
+distinct stacks for at most DEQUE_TRANSITIONS, its bytes are given for the
+full capacity. Samples are timed up to the float32 batch the network takes
+"""
+def benchReplay(capacity, batchSize = 32, samples = 200, packed = False):
+    frames, actions, terminals = getGameFrames(REPLAY_FRAMES)
+    results = {}
+    memory = ReplayMemory(capacity, packed = packed)
+    memory.start(frames[0])
+    for i in range(capacity):
+        j = i % len(frames)
+        memory.append(frames[j], actions[j], 0, terminals[j])
+    results['replay bytes'] = memory.nbytes
+    start = time.time()
+    for i in range(samples):
+        batch = memory.sample(batchSize)
+        batch[0].astype(np.float32)
+        batch[3].astype(np.float32)
+    results['replay sample'] = (time.time() - start) / samples
+
+    # Every deque entry holds two 80x80x4 uint8 stacks and a one-hot action
+    stack = np.stack((frames[0],) * 4, axis = 2)
+    action = np.zeros(2)
+    results['deque bytes'] = capacity * (2 * stack.nbytes + action.nbytes)
+    memory = deque(maxlen = min(capacity, DEQUE_TRANSITIONS))
+    for i in range(memory.maxlen):
+        j = i % len(frames)
+        nextStack = np.append(frames[j][:, :, None], stack[:, :, :3], axis = 2)
+        memory.append((stack, np.eye(2)[actions[j]], 0, nextStack, terminals[j]))
+        stack = nextStack
+    start = time.time()
+    for i in range(samples):
+        batch = random.sample(memory, batchSize)
+        np.array([d[0] for d in batch], dtype = np.float32)
+        np.array([d[3] for d in batch], dtype = np.float32)
+    results['deque sample'] = (time.time() - start) / samples
+    return results
+
+"""
+Pack and unpack throughput of PackedFrameStore in frames per second
+Raises if frames don't round-trip exactly
+"""
+def benchPacking(frames = 4096, batchSize = 128):
+    observations = (np.random.RandomState(0).rand(frames, 80, 80) < 0.3).astype(np.uint8) * 255
+    store = PackedFrameStore(frames, (80, 80))
+    start = time.time()
+    for i in range(frames):
+        store[i] = observations[i]
+    packTime = time.time() - start
+
+    indices = np.arange(frames).reshape(-1, batchSize)
+    start = time.time()
+    unpacked = [store.gather(batch) for batch in indices]
+    unpackTime = time.time() - start
+    if not np.array_equal(np.concatenate(unpacked), observations):
+        raise AssertionError('packed frames did not round-trip')
+    return frames / packTime, frames / unpackTime
+
+"""
+Time an actor pool of workers filling a shared replay memory, acting on
+random network weights 90% of the time, and return env steps per second
+"""
+def benchWorkers(workers, seconds = WORKER_SECONDS):
+    context = multiprocessing.get_context('fork')
+    directory = tempfile.mkdtemp(dir = '/dev/shm' if os.path.isdir('/dev/shm') else None)
+    try:
+        memory = ShardedReplayMemory(workers, 10000 * workers, directory = directory,
+                                     lock = context.Lock, packed = True)
+        pool = ActorPool(workers, memory,
+                         lambda: game.GameState(headless = True, observation = 'raster'),
+                         lambda image_data: image_data, (0.1, 0.1, 0))
+        pool.publish(network.initWeights(seed = 0))
+        pool.start()
+        # leave out process start up and the first game set up
+        while pool.getSteps() < 10 * workers:
+            time.sleep(0.01)
+        start, steps = time.time(), pool.getSteps()
+        time.sleep(seconds)
+        stepsPerSec = (pool.getSteps() - steps) / (time.time() - start)
+        pool.close()
+    finally:
+        shutil.rmtree(directory)
+    return stepsPerSec
+
+"""
+Time clients threads asking an InferenceServer for actions with the NumPy
+network. Returns requests per second and the server's statistics
+"""
+def benchInference(clients, maxBatch, maxWait, requests = 100):
+    weights = network.initWeights(seed = 0)
+    server = InferenceServer(lambda stacks: network.forward(weights, stacks)[0],
+                             maxBatch, maxWait)
+    stack = (np.random.rand(80, 80, 4) > 0.9).astype(np.uint8) * 255
+
+    def client():
+        for i in range(requests):
+            server.act(stack)
+
+    threads = [threading.Thread(target = client) for i in range(clients)]
+    server.start()
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    requestsPerSec = clients * requests / (time.time() - start)
+    server.close()
+    return requestsPerSec, server.getStats()
+
+"""
+Time a stand-in learner, NumPy forward passes over both sides of each batch,
+with batches sampled when needed (depth 0) or by a BatchPrefetcher. Returns
+learner updates per second and the fraction of time spent waiting for batches
+"""
+def benchPrefetch(depth, updates = 100, capacity = 20000, batchSize = 32):
+    memory = ReplayMemory(capacity)
+    frames = (np.random.rand(256, 80, 80) > 0.9).astype(np.uint8) * 255
+    memory.start(frames[0])
+    for i in range(1, capacity):
+        memory.append(frames[i % len(frames)], random.randrange(2), 0, random.random() < 0.01)
+    weights = network.initWeights(seed = 0)
+
+    prefetcher = None
+    if depth:
+        prefetcher = BatchPrefetcher(memory, batchSize, depth = depth)
+        prefetcher.start()
+        # a full queue to start with, as after the first few updates of a run
+        while prefetcher.batches.qsize() < depth:
+            time.sleep(0.01)
+    idle = 0.0
+    start = time.time()
+    for i in range(updates):
+        wait_start = time.time()
+        if prefetcher is None:
+            batch = memory.sampleWeighted(batchSize)
+        else:
+            batch = prefetcher.get()
+        idle += time.time() - wait_start
+        network.forward(weights, batch[0])
+        network.forward(weights, batch[3])
+    seconds = time.time() - start
+    if prefetcher is not None:
+        prefetcher.close()
+    return updates / seconds, idle / seconds
+
+"""
+Time loading exported weights and the NumPy forward pass at batch sizes.
+Returns load seconds and stacks per second by batch size
+"""
+def benchNetwork(batchSizes = (1, 32, 256), stacks = 1024):
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'weights.npz')
+        network.saveWeights(path, network.initWeights(seed = 0))
+        start = time.time()
+        weights = network.loadWeights(path)
+        loadTime = time.time() - start
+    finally:
+        shutil.rmtree(directory)
+
+    results = {}
+    for batchSize in batchSizes:
+        batch = (np.random.rand(batchSize, 80, 80, 4) > 0.9).astype(np.uint8) * 255
+        network.forward(weights, batch)
+        calls = max(stacks // batchSize, 3)
+        start = time.time()
+        for i in range(calls):
+            network.forward(weights, batch)
+        results[batchSize] = calls * batchSize / (time.time() - start)
+    return loadTime, results
+
+"""
+Time frame_step and the NumPy network for each kind of observation
+Returns env steps per second, including cv2 preprocessing for images, and
+forward passes per second at batch sizes 1 and 32
+"""
+def benchObservations(steps):
+    flaps = np.random.RandomState(0).rand(steps) < 0.1
+    results = {}
+    for observation in ('image', 'raster', 'features'):
+        game_state = game.GameState(headless = True, observation = observation, seed = 0)
+        start = time.time()
+        for flap in flaps:
+            image_data = game_state.frame_step([1 - flap, flap])[0]
+            if observation == 'image':
+                image_data = cv2.cvtColor(cv2.resize(image_data, (80, 80)), cv2.COLOR_BGR2GRAY)
+                ret, image_data = cv2.threshold(image_data, 1, 255, cv2.THRESH_BINARY)
+        results[observation + ' steps/s'] = steps / (time.time() - start)
+
+    networks = {
+        'conv': (network.initWeights(seed = 0), (80, 80, 4)),
+        'mlp': (network.initWeights(seed = 0, shapes = network.getFeatureWeightShapes(
+            game.FEATURECOUNT)), (game.FEATURECOUNT, 4)),
+    }
+    for name, (weights, stackShape) in networks.items():
+        for batchSize in (1, 32):
+            stacks = np.random.RandomState(0).rand(batchSize, *stackShape).astype(np.float32)
+            calls = max(2000 // batchSize if name == 'mlp' else 200 // batchSize, 3)
+            start = time.time()
+            for i in range(calls):
+                network.forward(weights, stacks)
+            results['%s forward %d /s' % (name, batchSize)] = calls / (time.time() - start)
+    return results
+
+"""
+Point Qflappybird's checkpoints and logs at a temporary directory for the
+length of the with block, so training starts from random weights away from
+saved_networks and leaves nothing behind
+"""
+@contextlib.contextmanager
+def temporaryOutput(dqn):
+    saved = dqn.CHECKPOINT_DIR, dqn.LOG_DIR, dqn.ACTIVATION_LOG
+    with tempfile.TemporaryDirectory() as directory:
+        dqn.CHECKPOINT_DIR = os.path.join(directory, 'saved_networks')
+        dqn.LOG_DIR = os.path.join(directory, 'logs')
+        dqn.ACTIVATION_LOG = os.path.join(dqn.LOG_DIR, 'activations.bin')
+        try:
+            yield
+        finally:
+            dqn.CHECKPOINT_DIR, dqn.LOG_DIR, dqn.ACTIVATION_LOG = saved
+
+"""
+Train from scratch on frames and on features for seconds each, returning
+env steps per second and the seconds until a game first scored target,
+None if none did. Needs TensorFlow
+"""
+def compareObservations(seconds, target = 100):
+    import tensorflow as tf
+    import Qflappybird as dqn
+
+    dqn.OBSERVE = False
+    dqn.HEADLESS = True
+    dqn.RASTER = True
+    dqn.INITIAL_EPSILON = 0.1
+    createGame = dqn.createGame
+    steps = [0]
+
+    def createCountingGame(headless = True):
+        game_state = createGame(headless)
+        frame_step = game_state.frame_step
+        def countingStep(action):
+            steps[0] += 1
+            return frame_step(action)
+        game_state.frame_step = countingStep
+        return game_state
+
+    dqn.createGame = createCountingGame
+    results = {}
+    try:
+        for features in (False, True):
+            dqn.FEATURES = features
+            steps[0] = 0
+            with temporaryOutput(dqn), tf.Graph().as_default():
+                sess = tf.InteractiveSession()
+                IL, ROL, H_FCL, weights = dqn.createNetwork()
+                scores = dqn.trainNetwork(IL, ROL, H_FCL, sess, weights, max_seconds = seconds)
+                sess.close()
+            reached = [end for end, score in scores if score >= target]
+            results['features' if features else 'pixels'] = (
+                steps[0] / float(seconds), reached[0] if reached else None)
+    finally:
+        dqn.createGame = createGame
+        dqn.FEATURES = False
+    return results
+
+"""
+Train from scratch with uniform and with prioritized replay for the same
+wall-clock budget, returning the mean score of the games finished in each
+of intervals equal parts of it. Needs TensorFlow
+"""
+def compareReplay(seconds, intervals = 5):
+    import tensorflow as tf
+    import Qflappybird as dqn
+
+    dqn.OBSERVE = False
+    dqn.HEADLESS = True
+    dqn.RASTER = True
+    dqn.INITIAL_EPSILON = 0.1
+    results = {}
+    for prioritized in (False, True):
+        dqn.PRIORITIZED = prioritized
+        with temporaryOutput(dqn), tf.Graph().as_default():
+            sess = tf.InteractiveSession()
+            IL, ROL, H_FCL, weights = dqn.createNetwork()
+            scores = dqn.trainNetwork(IL, ROL, H_FCL, sess, weights, max_seconds = seconds)
+            sess.close()
+
+        means = []
+        for i in range(intervals):
+            finished = [score for end, score in scores
+                        if i * seconds / intervals <= end < (i + 1) * seconds / intervals]
+            means.append(np.mean(finished) if finished else float('nan'))
+        results['prioritized' if prioritized else 'uniform'] = means
+    return results
+
+def main():
+    for name, stepsPerSec in sorted(benchHeadless().items()):
+        print('frame_step %-10s %10.1f steps/s' % (name, stepsPerSec))
+    for frameSkip in (1, 2, 4):
+        print('frame_step skip=%d raster %10.1f frames/s' % (
+            frameSkip, benchFrameSkip(frameSkip, STEPS // frameSkip)))
+    for n in (1, 64, 1024):
+        print('vector step n=%-6d %10.1f steps/s' % (n, benchVector(n, STEPS // 4)))
+    agreement, cv2Time, rasterTime = benchRaster(STEPS // 2)
+    print('observation cv2 %.1f us/frame, raster %.1f us/frame, %.5f pixels agree' % (
+        cv2Time * 1e6, rasterTime * 1e6, agreement))
+    for name, seconds in sorted(benchCheckCrash(STEPS // 2).items()):
+        print('%-20s %10.1f us/call' % (name, seconds * 1e6))
+    # a million unpacked frames fill 6.4 GB
+    for capacity, packed in ((50000, False), (50000, True), (1000000, True)):
+        name = 'packed' if packed else 'uint8'
+        try:
+            results = benchReplay(capacity, packed = packed)
+        except MemoryError:
+            print('replay %-6s %7d: not enough memory' % (name, capacity))
+            continue
+        print('replay %-6s %7d: memory %8.1f MB (deque %8.1f MB), sample %8.1f us (deque %8.1f us)' % (
+            name, capacity, results['replay bytes'] / 1e6, results['deque bytes'] / 1e6,
+            results['replay sample'] * 1e6, results['deque sample'] * 1e6))
+    packRate, unpackRate = benchPacking()
+    print('frame packing %.0f frames/s, unpacking %.0f frames/s, round-trip exact' % (
+        packRate, unpackRate))
+    for maxBatch, maxWait in ((1, 0), (8, 0.001), (32, 0.002), (32, 0.01)):
+        requestsPerSec, stats = benchInference(INFERENCE_CLIENTS, maxBatch, maxWait)
+        print('inference batch<=%-2d wait %4.1f ms %8.1f requests/s, latency p50 %6.2f ms p90 %6.2f ms p99 %6.2f ms' % (
+            maxBatch, maxWait * 1e3, requestsPerSec, stats['latency p50'] * 1e3,
+            stats['latency p90'] * 1e3, stats['latency p99'] * 1e3))
+        print('    batch sizes %s' % ' '.join('%d:%d' % item
+                                         for item in sorted(stats['batch sizes'].items())))
+    for name, value in sorted(benchObservations(STEPS).items()):
+        print('observation %-24s %10.1f' % (name, value))
+    loadTime, results = benchNetwork()
+    print('numpy network load %.1f ms, forward %s' % (loadTime * 1e3, ', '.join(
+        'batch %d %.0f stacks/s' % item for item in sorted(results.items()))))
+    for depth in (0, 2, 4):
+        updatesPerSec, idle = benchPrefetch(depth)
+        print('learner prefetch depth %d %8.1f updates/s, idle %5.1f%%' % (
+            depth, updatesPerSec, idle * 100))
+    single = None
+    for workers in (1, 2, 4, 8, 16):
+        stepsPerSec = benchWorkers(workers)
+        single = single or stepsPerSec
+        print('actor pool %2d workers %10.1f steps/s, %5.2fx one worker (%d cores)' % (
+            workers, stepsPerSec, stepsPerSec / single, multiprocessing.cpu_count()))
+    if '--observations' in sys.argv:
+        seconds = float(sys.argv[sys.argv.index('--observations') + 1])
+        for name, (stepsPerSec, reached) in sorted(compareObservations(seconds).items()):
+            print('train on %-8s %8.1f steps/s, score 100 %s' % (
+                name, stepsPerSec, 'after %.0fs' % reached if reached is not None
+                else 'not reached in %.0fs' % seconds))
+    if '--train' in sys.argv:
+        seconds = float(sys.argv[sys.argv.index('--train') + 1])
+        for name, means in sorted(compareReplay(seconds).items()):
+            print('replay %-11s mean score per %.0fs: %s' % (
+                name, seconds / len(means), ' '.join('%.2f' % mean for mean in means)))
+
+if __name__ == "__main__":
+    main()
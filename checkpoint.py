@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import tensorflow as tf
+
+
+class CheckpointWriter:
+    """Writes checkpoints of variables on a background thread.
+
+    save() copies the variables into non-trainable shadows in one session
+    run and returns, a thread then saves the shadows under the original
+    variable names, so tf.train.Saver restores them as usual. Files are
+    written to a temporary directory and renamed into place before the
+    checkpoint state file is replaced to point at them, a crash never
+    leaves a checkpoint that is listed but incomplete.
+
+    The newest keep checkpoints are kept, plus the one saved with the
+    highest score, whatever the caller ranks them by. The shadows must be
+    left out of any other Saver."""
+
+    def __init__(self, sess, variables, directory, name, keep = 3):
+        self.sess = sess
+        self.directory = directory
+        self.name = name
+        self.keep = keep
+        self.shadows = dict((variable.op.name, tf.Variable(variable.initialized_value(),
+                                                           trainable = False))
+                            for variable in variables)
+        self.snapshot = tf.group(*[tf.assign(self.shadows[variable.op.name], variable)
+                                   for variable in variables])
+        self.saver = tf.train.Saver(self.shadows, max_to_keep = 0)
+
+        self.thread = None
+        self.error = None # raised by the background write, re-raised by wait()
+        self.stalls = [] # seconds each save() held up its caller
+        self.checkpoints = self.loadRetention() # [name, score] oldest first
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def loadRetention(self):
+        path = os.path.join(self.directory, 'retention.json')
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return json.load(f)
+
+    def save(self, step, score = None, onSaved = None):
+        """snapshots the variables and writes them as checkpoint step in the
+        background. score ranks it for retention, onSaved(path) is called
+        once it is in place. Returns the seconds the caller was held up,
+        including waiting for the previous checkpoint to be written"""
+        start = time.time()
+        self.wait()
+        self.sess.run(self.snapshot)
+        self.thread = threading.Thread(target = self.run, args = (step, score, onSaved))
+        self.thread.start()
+        stall = time.time() - start
+        self.stalls.append(stall)
+        return stall
+
+    def wait(self):
+        """blocks until the last checkpoint is written, raising what made
+        writing it fail"""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self, step, score, onSaved):
+        """write() on the background thread, keeping its exception for wait()"""
+        try:
+            self.write(step, score, onSaved)
+        except Exception as error:
+            self.error = error
+
+    def isCheckpointFile(self, filename, name):
+        return filename == name or filename.startswith(name + '.')
+
+    def write(self, step, score, onSaved):
+        name = '%s-%d' % (self.name, step)
+        temp = tempfile.mkdtemp(prefix = '.tmp-', dir = self.directory)
+        try:
+            self.saver.save(self.sess, os.path.join(temp, self.name), global_step = step)
+            for filename in os.listdir(temp):
+                if self.isCheckpointFile(filename, name):
+                    os.replace(os.path.join(temp, filename),
+                               os.path.join(self.directory, filename))
+        finally:
+            shutil.rmtree(temp)
+
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints
+                            if checkpoint[0] != name] + [[name, score]]
+        kept = self.getKept()
+        self.writeState(name, kept)
+        for dropped, dropped_score in self.checkpoints:
+            if dropped in kept:
+                continue
+            for filename in os.listdir(self.directory):
+                if self.isCheckpointFile(filename, dropped):
+                    os.remove(os.path.join(self.directory, filename))
+        self.checkpoints = [checkpoint for checkpoint in self.checkpoints
+                            if checkpoint[0] in kept]
+        self.writeRetention()
+
+        if onSaved is not None:
+            onSaved(os.path.join(self.directory, name))
+
+    def getKept(self):
+        """names of the newest keep checkpoints and the highest scored one"""
+        newest = self.checkpoints[max(len(self.checkpoints) - self.keep, 0):]
+        kept = [name for name, score in newest]
+        scored = [checkpoint for checkpoint in self.checkpoints if checkpoint[1] is not None]
+        if scored:
+            highest = max(scored, key = lambda checkpoint: checkpoint[1])[0]
+            if highest not in kept:
+                kept.insert(0, highest)
+        return kept
+
+    def replace(self, filename, text):
+        path = os.path.join(self.directory, filename)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+    def writeState(self, latest, kept):
+        """points the checkpoint state file at latest, listing kept"""
+        lines = ['model_checkpoint_path: "%s"' % latest]
+        lines += ['all_model_checkpoint_paths: "%s"' % name for name in kept]
+        self.replace('checkpoint', '\n'.join(lines) + '\n')
+
+    def writeRetention(self):
+        self.replace('retention.json', json.dumps(self.checkpoints))
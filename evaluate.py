@@ -0,0 +1,147 @@
+"""
+Play seeded games with a trained network, headless and in parallel, and
+report score and episode length statistics as JSON
+Usage: python evaluate.py [weights.npz or checkpoint directory] [options]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+import flappybird.flappy_new as game
+import network
+from workers import mapWorkers
+
+WEIGHTS = 'saved_networks/flappybird-dqn.npz' # Written by export.py
+EPISODES = 100 # Games to play
+MAX_STEPS = 10000 # Frames a game is cut off at, so a strong policy still finishes
+SEED = 0 # Game i draws its pipes from seed + i
+PERCENTILES = (5, 25, 75, 95) # Score percentiles reported besides the median
+
+
+"""
+Weights from a .npz file written by export.py, or from the latest
+checkpoint in a directory, which needs TensorFlow
+"""
+def loadWeights(path):
+    if os.path.isdir(path):
+        import tensorflow as tf
+        import export
+        sess = tf.InteractiveSession()
+        weights, IL, ROL = export.restoreWeights(sess, path)
+        sess.close()
+        return weights
+    return network.loadWeights(path)
+
+"""
+Observation an exported network was trained on, game state features for the
+MLP, otherwise frames. Rasterized frames are the same frames Qflappybird's
+preprocessing makes of the rendered screen
+"""
+def getObservation(weights):
+    return 'features' if 'WMLP_1' in weights else 'raster'
+
+"""
+Play one game greedily with forward, its pipes drawn from seed
+Returns the score and the frames played
+"""
+def playEpisode(game_state, forward, seed, max_steps = MAX_STEPS):
+    game_state.seed(seed)
+    game_state.reInit()
+    image_data, reward, terminal = game_state.frame_step([1, 0])
+    stack = np.stack((image_data,) * 4, axis = -1)
+    score = step = 0
+    for step in range(1, max_steps + 1):
+        action = np.zeros(2)
+        action[np.argmax(forward(stack[None])[0][0])] = 1
+        image_data, reward, terminal = game_state.frame_step(action)
+        if terminal:
+            break
+        score += reward > 0
+        stack = np.append(image_data[..., None], stack[..., :3], axis = -1)
+    return int(score), step
+
+def createGame(observation = 'raster'):
+    return game.GameState(headless = True, observation = observation)
+
+def startEpisodes(forward, observation):
+    return createGame(observation), forward
+
+def runEpisode(worker, task):
+    game_state, forward = worker
+    seed, max_steps = task
+    return playEpisode(game_state, forward, seed, max_steps)
+
+"""
+Play games with seeds, on workers forked processes when there are more
+than one. Returns (score, frames) for every seed, in order
+"""
+def playEpisodes(forward, seeds, max_steps = MAX_STEPS, workers = 1, observation = 'raster'):
+    return mapWorkers(runEpisode, [(seed, max_steps) for seed in seeds], startEpisodes,
+                      (forward, observation), workers)
+
+"""
+Statistics of episodes, a list of (score, frames), played in seconds
+"""
+def getStats(episodes, seconds, max_steps):
+    scores = np.array([score for score, frames in episodes])
+    lengths = np.array([frames for score, frames in episodes])
+    stats = {
+        'episodes': len(episodes),
+        'score mean': float(scores.mean()),
+        'score median': float(np.median(scores)),
+        'score std': float(scores.std()),
+        'score min': int(scores.min()),
+        'score max': int(scores.max()),
+    }
+    for percentile in PERCENTILES:
+        stats['score p%d' % percentile] = float(np.percentile(scores, percentile))
+    stats.update({
+        'length mean': float(lengths.mean()),
+        'length median': float(np.median(lengths)),
+        'length max': int(lengths.max()),
+        'capped': int(np.sum(lengths >= max_steps)),
+        'steps': int(lengths.sum()),
+        'seconds': seconds,
+        'steps/s': float(lengths.sum() / seconds),
+        'scores': scores.tolist(),
+    })
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().split('\n')[0])
+    parser.add_argument('weights', nargs = '?', default = WEIGHTS,
+                        help = '.npz from export.py or a checkpoint directory')
+    parser.add_argument('--episodes', type = int, default = EPISODES)
+    parser.add_argument('--max-steps', type = int, default = MAX_STEPS)
+    parser.add_argument('--seed', type = int, default = SEED)
+    parser.add_argument('--workers', type = int, default = multiprocessing.cpu_count())
+    parser.add_argument('--output', help = 'write the JSON here instead of stdout')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.weights):
+        sys.exit('%s not found, export a checkpoint with export.py first' % args.weights)
+    weights = loadWeights(args.weights)
+    forward = lambda stacks: network.forward(weights, stacks)
+
+    seeds = range(args.seed, args.seed + args.episodes)
+    start = time.time()
+    episodes = playEpisodes(forward, seeds, args.max_steps, args.workers,
+                            getObservation(weights))
+    stats = getStats(episodes, time.time() - start, args.max_steps)
+    stats.update({'weights': args.weights, 'seed': args.seed,
+                  'max steps': args.max_steps, 'workers': args.workers})
+
+    text = json.dumps(stats, indent = 2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
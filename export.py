@@ -0,0 +1,69 @@
+"""
+Export the network weights of a checkpoint to a .npz file for network.forward,
+then check its Q values against TensorFlow's on game frames
+Usage: python export.py [output.npz] [checkpoint directory]
+"""
+import sys
+
+import numpy as np
+import tensorflow as tf
+
+import Qflappybird as dqn
+import network
+
+OUTPUT = 'saved_networks/' + dqn.GAME + '-dqn.npz' # Default exported file
+CHECK_FRAMES = 256 # Number of game frames to compare Q values on
+TOLERANCE = 1e-4 # Largest difference to TensorFlow's Q values, relative to their scale
+
+"""
+Restore only the network weights from the latest checkpoint in checkpoint_dir
+Returns them as a dict of arrays, with the graph's input and readout layers
+"""
+def restoreWeights(sess, checkpoint_dir):
+    IL, ROL, H_FCL, weights = dqn.createNetwork()
+    checkpoint = tf.train.get_checkpoint_state(checkpoint_dir)
+    if not checkpoint or not checkpoint.model_checkpoint_path:
+        raise IOError('No checkpoint in %s' % checkpoint_dir)
+    tf.train.Saver(list(weights.values())).restore(sess, checkpoint.model_checkpoint_path)
+    values = sess.run(list(weights.values()))
+    return dict(zip(weights.keys(), values)), IL, ROL
+
+"""
+Stacks of frames from a game played at random, in the network's input format
+"""
+def getStacks(count):
+    game_state = dqn.createGame(headless = True)
+    image_data = dqn.preprocess(game_state.frame_step(dqn.NOACTION)[0])
+    stack = np.stack((image_data,) * 4, axis = 2)
+    stacks = []
+    for i in range(count):
+        action = dqn.NOACTION if np.random.rand() < 0.9 else [0, 1]
+        image_data, reward, terminal = game_state.frame_step(action)
+        image_data = dqn.preprocess(image_data)
+        if terminal:
+            stack = np.stack((image_data,) * 4, axis = 2)
+        else:
+            stack = np.append(image_data[:, :, None], stack[:, :, :3], axis = 2)
+        stacks.append(stack)
+    return np.array(stacks)
+
+def main():
+    output = sys.argv[1] if len(sys.argv) > 1 else OUTPUT
+    checkpoint_dir = sys.argv[2] if len(sys.argv) > 2 else dqn.CHECKPOINT_DIR
+
+    sess = tf.InteractiveSession()
+    weights, IL, ROL = restoreWeights(sess, checkpoint_dir)
+    network.saveWeights(output, weights)
+
+    # Check the NumPy forward pass on the exported file against the graph
+    stacks = getStacks(CHECK_FRAMES)
+    expected = ROL.eval(feed_dict = {IL : stacks})
+    readout, hidden = network.forward(network.loadWeights(output), stacks)
+    error = np.abs(readout - expected).max() / max(np.abs(expected).max(), 1e-6)
+    agreement = np.mean(readout.argmax(axis = 1) == expected.argmax(axis = 1))
+    print('exported %s, relative error %.2e, argmax agreement %.4f' % (output, error, agreement))
+    if error > TOLERANCE:
+        sys.exit('NumPy Q values differ from TensorFlow by more than %g' % TOLERANCE)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import sys
+
+import numpy as np
+import pygame
+
+from . import collision
+
+# hitmasks computed once are kept here, named by the hash of their image file
+CACHE_DIR = os.environ.get('FLAPPYBIRD_CACHE',
+                           os.path.join(os.path.expanduser('~'), '.cache', 'flappybird'))
+SOUND_EXT = '.wav' if 'win' in sys.platform else '.ogg'
+
+# process-wide caches, filled on first use
+LOADED_IMAGES = {}
+LOADED_HITMASKS = {}
+LOADED_SOUNDS = {}
+
+
+def getImage(path, alpha=True, rotate=False):
+    """returns the sprite at path converted for the display, loaded once per
+    process. The display mode has to be set before the first call"""
+    key = (path, alpha, rotate)
+    if key not in LOADED_IMAGES:
+        image = pygame.image.load(path)
+        image = image.convert_alpha() if alpha else image.convert()
+        if rotate:
+            image = pygame.transform.rotate(image, 180)
+        LOADED_IMAGES[key] = image
+    return LOADED_IMAGES[key]
+
+
+def getFileHash(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def getHitmask(path, rotate=False):
+    """returns the hitmask of the sprite at path, a boolean (width, height)
+    array, rotated by 180 degrees with rotate. Masks are computed once and
+    stored in CACHE_DIR keyed by the file's content, so an edited sprite
+    gets a new one"""
+    key = (path, rotate)
+    if key in LOADED_HITMASKS:
+        return LOADED_HITMASKS[key]
+    cachePath = os.path.join(CACHE_DIR, 'hitmask-%s.npy' % getFileHash(path))
+    try:
+        mask = np.load(cachePath)
+    except (OSError, ValueError):
+        mask = collision.getHitmask(pygame.image.load(path))
+        try:
+            if not os.path.isdir(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            # written aside and renamed, a concurrent reader never sees half of it
+            np.save(cachePath + '.%d.tmp.npy' % os.getpid(), mask)
+            os.replace(cachePath + '.%d.tmp.npy' % os.getpid(), cachePath)
+        except OSError:
+            pass # a read-only home only costs recomputing the mask
+    if rotate:
+        # same as pygame.transform.rotate(image, 180)
+        mask = mask[::-1, ::-1]
+    LOADED_HITMASKS[key] = mask
+    return mask
+
+
+def getSound(name):
+    """returns the sound name from the audio assets, loaded on first use,
+    or None if there is no audio device"""
+    if name not in LOADED_SOUNDS:
+        try:
+            if not pygame.mixer.get_init():
+                pygame.mixer.init()
+            LOADED_SOUNDS[name] = pygame.mixer.Sound(
+                'flappybird/assets/audio/' + name + SOUND_EXT)
+        except pygame.error:
+            LOADED_SOUNDS[name] = None
+    return LOADED_SOUNDS[name]
@@ -0,0 +1,61 @@
+import numpy as np
+import pygame
+
+
+def getHitmask(image):
+    """returns a hitmask using an image's alpha, a boolean (width, height) array"""
+    return pygame.surfarray.array_alpha(image) > 0
+
+
+def pixelCollision(rect1, rect2, hitmask1, hitmask2):
+    """Checks if two objects collide and not just their rects"""
+    rect = rect1.clip(rect2)
+
+    if rect.width == 0 or rect.height == 0:
+        return False
+
+    x1, y1 = rect.x - rect1.x, rect.y - rect1.y
+    x2, y2 = rect.x - rect2.x, rect.y - rect2.y
+
+    return bool(np.any(
+        hitmask1[x1:x1 + rect.width, y1:y1 + rect.height] &
+        hitmask2[x2:x2 + rect.width, y2:y2 + rect.height]))
+
+
+def checkCrash(player, upperPipes, lowerPipes, images, hitmasks, baseY):
+    """returns True if player collders with base or pipes."""
+    pi = player['index']
+    player['w'] = images['player'][0].get_width()
+    player['h'] = images['player'][0].get_height()
+
+    # if player crashes into ground
+    if player['y'] + player['h'] >= baseY - 1:
+        return [True, True]
+
+    playerRect = pygame.Rect(player['x'], player['y'],
+                  player['w'], player['h'])
+    pipeW = images['pipe'][0].get_width()
+    pipeH = images['pipe'][0].get_height()
+
+    # player and upper/lower pipe hitmasks
+    pHitMask = hitmasks['player'][pi]
+    uHitmask = hitmasks['pipe'][0]
+    lHitmask = hitmasks['pipe'][1]
+
+    for uPipe, lPipe in zip(upperPipes, lowerPipes):
+        # only pipes overlapping the player along x can hit it
+        if uPipe['x'] >= playerRect.right or uPipe['x'] + pipeW <= playerRect.left:
+            continue
+
+        # upper and lower pipe rects
+        uPipeRect = pygame.Rect(uPipe['x'], uPipe['y'], pipeW, pipeH)
+        lPipeRect = pygame.Rect(lPipe['x'], lPipe['y'], pipeW, pipeH)
+
+        # if bird collided with upipe or lpipe
+        uCollide = pixelCollision(playerRect, uPipeRect, pHitMask, uHitmask)
+        lCollide = pixelCollision(playerRect, lPipeRect, pHitMask, lHitmask)
+
+        if uCollide or lCollide:
+            return [True, False]
+
+    return [False, False]
@@ -1,10 +1,14 @@
-from itertools import cycle
+import os
 import random
-import sys
+import threading
 
+import numpy as np
 import pygame
 from pygame.locals import *
 
+from . import assets, collision
+from .raster import Rasterizer
+
 
 FPS = 30
 SCREENWIDTH  = 288
@@ -14,6 +18,33 @@ PIPEGAPSIZE  = 100 # gap between upper and lower part of pipe
 BASEY        = SCREENHEIGHT * 0.79
 # image, sound and hitmask  dicts
 IMAGES, SOUNDS, HITMASKS = {}, {}, {}
+# draws 80x80 observations without rendering the screen, see getObservation
+RASTERIZER = None
+# set once loadAssets has filled IMAGES and HITMASKS, games in other threads wait on the lock
+ASSETSLOADED = False
+ASSETSLOCK = threading.Lock()
+PLAYERINDEXES = (0, 1, 2, 1) # player sprite cycle of the flapping animation
+MAXPIPES = 3 # a new pipe is added before the first one is removed
+# snapshot() record: player, animation and base fields, then the pipe count
+# and x, upper y and lower y of every pipe slot
+SNAPSHOT_FIELDS = ('playery', 'playerVelY', 'playerFlapped', 'playerIndex',
+                   'playerIndexStep', 'loopIter', 'basex', 'score', 'pipeSeed',
+                   'pipesDrawn', 'pipes')
+SNAPSHOT_SIZE = len(SNAPSHOT_FIELDS) + 3 * MAXPIPES
+MASK64 = 2 ** 64 - 1
+SEEDMASK = 2 ** 53 - 1 # seeds are cut to 53 bits, which a snapshot holds exactly
+FEATURECOUNT = 8 # length of getFeatures(), the player and the next two pipes
+# getFeatures() of a pipe not spawned yet: farther than any pipe, gap closed
+MISSINGPIPE = (2.5, -1.0, -1.0)
+
+
+def mix64(seed, index):
+    """returns a 64 bit hash of seed and index (splitmix64), the random
+    number behind the index-th pipe of a game seeded with seed"""
+    z = (seed + (index + 1) * 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
 
 # list of all possible players (tuple of 3 positions of flap)
 PLAYERS_LIST = (
@@ -51,85 +82,94 @@ PIPES_LIST = (
     'flappybird/assets/sprites/pipe-red.png',
 )
 
-class GameState:
-    def  __init__(self):
-        global SCREEN, FPSCLOCK
-        pygame.init()
-        FPSCLOCK = pygame.time.Clock()
-        SCREEN = pygame.display.set_mode((SCREENWIDTH, SCREENHEIGHT))
-        pygame.display.set_caption('Flappy Bird')
+# sprites used, the original game picks them at random
+BACKGROUND = 0
+PLAYER = 0
+PIPE = 0
 
-        # numbers sprites for score display
-        IMAGES['numbers'] = (
-            pygame.image.load('flappybird/assets/sprites/0.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/1.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/2.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/3.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/4.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/5.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/6.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/7.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/8.png').convert_alpha(),
-            pygame.image.load('flappybird/assets/sprites/9.png').convert_alpha()
-        )
 
+def loadAssets():
+    """fills IMAGES and HITMASKS from the process-wide asset cache, only
+    the first call loads anything. The display mode has to be set first"""
+    global ASSETSLOADED
+    with ASSETSLOCK:
+        if ASSETSLOADED:
+            return
+        # numbers sprites for score display
+        IMAGES['numbers'] = tuple(assets.getImage('flappybird/assets/sprites/%d.png' % digit)
+                                  for digit in range(10))
         # game over sprite
-        IMAGES['gameover'] = pygame.image.load('flappybird/assets/sprites/gameover.png').convert_alpha()
+        IMAGES['gameover'] = assets.getImage('flappybird/assets/sprites/gameover.png')
         # message sprite for welcome screen
-        IMAGES['message'] = pygame.image.load('flappybird/assets/sprites/message.png').convert_alpha()
+        IMAGES['message'] = assets.getImage('flappybird/assets/sprites/message.png')
         # base (ground) sprite
-        IMAGES['base'] = pygame.image.load('flappybird/assets/sprites/base.png').convert_alpha()
-
-        # sounds
-        if 'win' in sys.platform:
-            soundExt = '.wav'
-        else:
-            soundExt = '.ogg'
-
-        SOUNDS['die']    = pygame.mixer.Sound('flappybird/assets/audio/die' + soundExt)
-        SOUNDS['hit']    = pygame.mixer.Sound('flappybird/assets/audio/hit' + soundExt)
-        SOUNDS['point']  = pygame.mixer.Sound('flappybird/assets/audio/point' + soundExt)
-        SOUNDS['swoosh'] = pygame.mixer.Sound('flappybird/assets/audio/swoosh' + soundExt)
-        SOUNDS['wing']   = pygame.mixer.Sound('flappybird/assets/audio/wing' + soundExt)
-
-        # select random background sprites
-        # randBg = random.randint(0, len(BACKGROUNDS_LIST) - 1)
-        randBg = 0
-        IMAGES['background'] = pygame.image.load(BACKGROUNDS_LIST[randBg]).convert()
-
-        # select random player sprites
-        # randPlayer = random.randint(0, len(PLAYERS_LIST) - 1)
-        randPlayer = 0
-        IMAGES['player'] = (
-            pygame.image.load(PLAYERS_LIST[randPlayer][0]).convert_alpha(),
-            pygame.image.load(PLAYERS_LIST[randPlayer][1]).convert_alpha(),
-            pygame.image.load(PLAYERS_LIST[randPlayer][2]).convert_alpha(),
-        )
-
-        # select random pipe sprites
-        # pipeindex = random.randint(0, len(PIPES_LIST) - 1)
-        pipeindex = 0
+        IMAGES['base'] = assets.getImage('flappybird/assets/sprites/base.png')
+        IMAGES['background'] = assets.getImage(BACKGROUNDS_LIST[BACKGROUND], alpha=False)
+        IMAGES['player'] = tuple(assets.getImage(path) for path in PLAYERS_LIST[PLAYER])
         IMAGES['pipe'] = (
-            pygame.transform.rotate(
-                pygame.image.load(PIPES_LIST[pipeindex]).convert_alpha(), 180),
-            pygame.image.load(PIPES_LIST[pipeindex]).convert_alpha(),
+            assets.getImage(PIPES_LIST[PIPE], rotate=True),
+            assets.getImage(PIPES_LIST[PIPE]),
         )
 
-        # hismask for pipes
+        # hitmasks for pipes and player
         HITMASKS['pipe'] = (
-            self.getHitmask(IMAGES['pipe'][0]),
-            self.getHitmask(IMAGES['pipe'][1]),
+            assets.getHitmask(PIPES_LIST[PIPE], rotate=True),
+            assets.getHitmask(PIPES_LIST[PIPE]),
         )
+        HITMASKS['player'] = tuple(assets.getHitmask(path) for path in PLAYERS_LIST[PLAYER])
+        ASSETSLOADED = True
+
+def initDisplay(headless):
+    """starts the display, on the dummy video driver when headless. Headless
+    games draw into an offscreen display, sprites still need a video mode
+    to convert against. There is one display per process and SDL reads the
+    driver when it starts, so a game only picks the driver if it is the
+    first, every later game shares that display headless or not"""
+    if not headless or pygame.display.get_init():
+        pygame.display.init()
+        return
+    previous = os.environ.get('SDL_VIDEODRIVER')
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    try:
+        pygame.display.init()
+    finally:
+        # leave the environment of the process, and its children, as it was
+        if previous is None:
+            del os.environ['SDL_VIDEODRIVER']
+        else:
+            os.environ['SDL_VIDEODRIVER'] = previous
 
-        # hitmask for player
-        HITMASKS['player'] = (
-            self.getHitmask(IMAGES['player'][0]),
-            self.getHitmask(IMAGES['player'][1]),
-            self.getHitmask(IMAGES['player'][2]),
-        )
+class GameState:
+    def  __init__(self, headless=False, observation='image', frameSkip=1, maxPool=False,
+                  seed=None, audio=True):
+        """headless skips the window, sound and the frame rate cap, audio
+        False only the sound. Sprites and hitmasks are loaded once per
+        process, sounds when first played.
+        observation 'raster' makes frame_step return getObservation()
+        instead of the rendered screen, 'features' returns getFeatures().
+        frameSkip ticks run per frame_step, maxPool takes the pixelwise max
+        of the last two of them, images only. Pipes are
+        drawn from seed, or from a seed taken from the random module"""
+        global SCREEN, FPSCLOCK, RASTERIZER
+        self.seed(random.getrandbits(64) if seed is None else seed)
+        self.headless = headless
+        self.observation = observation
+        self.frameSkip = frameSkip
+        self.maxPool = maxPool
+        self.audio = audio
+        initDisplay(headless)
+        # the mixer is started by the first sound played, see assets.getSound
+        FPSCLOCK = pygame.time.Clock()
+        SCREEN = pygame.display.set_mode((SCREENWIDTH, SCREENHEIGHT))
+        pygame.display.set_caption('Flappy Bird')
 
-        self.score = self.playerIndex = self.loopIter = self.distance = self.tick = 0
-        self.playerIndexGen = cycle([0, 1, 2, 1])
+        loadAssets()
+
+        if RASTERIZER is None:
+            RASTERIZER = Rasterizer(PLAYERS_LIST[PLAYER], PIPES_LIST[PIPE],
+                'flappybird/assets/sprites/base.png', BASEY, (SCREENWIDTH, SCREENHEIGHT))
+
+        self.score = self.playerIndex = self.playerIndexStep = self.loopIter = 0
 
         self.playerx = int(SCREENWIDTH * 0.2)
         self.playery = int((SCREENHEIGHT - IMAGES['player'][0].get_height()) / 2)
@@ -163,9 +203,14 @@ class GameState:
         self.playerFlapAcc =  -9   # players speed on flapping
         self.playerFlapped = False # True when player flaps
 
+    def seed(self, seed):
+        """draws the following pipes from seed, the same seed always gives
+        the same pipes. Call reInit() to start a game with them"""
+        self.pipeSeed = seed & SEEDMASK
+        self.pipesDrawn = 0
+
     def reInit(self):
-        self.score = self.playerIndex = self.loopIter = 0
-        self.playerIndexGen = cycle([0, 1, 2, 1])
+        self.score = self.playerIndex = self.playerIndexStep = self.loopIter = 0
 
         self.playerx = int(SCREENWIDTH * 0.2)
         self.playery = int((SCREENHEIGHT - IMAGES['player'][0].get_height()) / 2)
@@ -199,14 +244,46 @@ class GameState:
         self.playerFlapAcc =  -9   # players speed on flapping
         self.playerFlapped = False # True when player flaps
         
-        self.frame_step([1,0])
+        self.physics_step([1,0])
 
     def frame_step(self, key_input):
+        """repeats key_input for frameSkip ticks and draws the last one.
+        Rewards add up over the ticks, a crash ends the step early with a
+        reward of -1, like a crash in the tick a pipe is passed"""
 
         # Ignore events so pygame doesn't freeze
-        for event in pygame.event.get():
-            None
+        if not self.headless:
+            for event in pygame.event.get():
+                None
+
+        reward = 0
+        endgame = False
+        previous_data = None
+
+        for i in range(self.frameSkip):
+            tick_reward, endgame = self.physics_step(key_input)
+            reward += tick_reward
+            if endgame:
+                # a pipe passed earlier in the step doesn't cancel the crash
+                reward = tick_reward
+                # frames before the crash belong to the old game, don't pool them
+                previous_data = None
+                break
+            if self.maxPool and i == self.frameSkip - 2 and self.observation != 'features':
+                previous_data = self.render()
+
+        image_data = self.render()
+        if previous_data is not None:
+            image_data = np.maximum(image_data, previous_data)
+
+        if not self.headless:
+            pygame.display.update()
+            FPSCLOCK.tick(FPS / float(self.frameSkip))
+
+        return image_data, reward, endgame
 
+    def physics_step(self, key_input):
+        """advances the game by one frame without drawing it"""
         reward = 0
         endgame = False
 
@@ -214,7 +291,7 @@ class GameState:
             if self.playery > -2 * IMAGES['player'][0].get_height():
                 self.playerVelY = self.playerFlapAcc
                 self.playerFlapped = True
-                SOUNDS['wing'].play()
+                self.playSound('wing')
 
         # check for score
         playerMidPos = self.playerx + IMAGES['player'][0].get_width() / 2
@@ -223,11 +300,12 @@ class GameState:
             if pipeMidPos <= playerMidPos < pipeMidPos + 4:
                 self.score += 1
                 reward = 1
-                SOUNDS['point'].play()
+                self.playSound('point')
 
         # playerIndex basex change
         if (self.loopIter + 1) % 3 == 0:
-            self.playerIndex = next(self.playerIndexGen)
+            self.playerIndex = PLAYERINDEXES[self.playerIndexStep]
+            self.playerIndexStep = (self.playerIndexStep + 1) % len(PLAYERINDEXES)
         self.loopIter = (self.loopIter + 1) % 30
         self.basex = -((-self.basex + 100) % self.baseShift)
 
@@ -260,29 +338,61 @@ class GameState:
                                self.upperPipes, self.lowerPipes)
         if crashTest[0]:
             self.reInit()
-            image_data = pygame.surfarray.array3d(pygame.display.get_surface())
             endgame = True
             reward = -1
 
-        # draw sprites
-        SCREEN.blit(IMAGES['background'], (0,0))
-
+        return reward, endgame
+
+    def render(self):
+        """draws the current frame and returns the observation"""
+        # draw sprites, nobody sees them headless unless the screen is returned
+        if not self.headless or self.observation == 'image':
+            SCREEN.blit(IMAGES['background'], (0,0))
+
+            for uPipe, lPipe in zip(self.upperPipes, self.lowerPipes):
+                SCREEN.blit(IMAGES['pipe'][0], (uPipe['x'], uPipe['y']))
+                SCREEN.blit(IMAGES['pipe'][1], (lPipe['x'], lPipe['y']))
+
+            SCREEN.blit(IMAGES['base'], (self.basex, BASEY))
+            # print score so player overlaps the score
+            # self.showScore(self.score)
+            SCREEN.blit(IMAGES['player'][self.playerIndex], (self.playerx, self.playery))
+
+        if self.observation == 'raster':
+            return self.getObservation()
+        if self.observation == 'features':
+            return self.getFeatures()
+        return pygame.surfarray.array3d(pygame.display.get_surface())
+
+    def getObservation(self):
+        """returns the preprocessed 80x80 frame drawn from the game state"""
+        pipes = [(uPipe['x'], uPipe['y'], lPipe['y'])
+                 for uPipe, lPipe in zip(self.upperPipes, self.lowerPipes)]
+        return RASTERIZER.draw(self.playerx, self.playery, self.playerIndex,
+                               pipes, self.basex)
+
+    def getFeatures(self):
+        """returns the player's y and velocity and the x, upper y and lower y
+        of the next two pipes, scaled by the screen size to between -1 and 2.
+        x is measured from the player, a pipe is next until its right edge
+        passes the player. Pipes not spawned yet are MISSINGPIPE"""
+        pipeW = IMAGES['pipe'][0].get_width()
+        features = [self.playery / SCREENHEIGHT, self.playerVelY / float(self.playerMaxVelY)]
         for uPipe, lPipe in zip(self.upperPipes, self.lowerPipes):
-            SCREEN.blit(IMAGES['pipe'][0], (uPipe['x'], uPipe['y']))
-            SCREEN.blit(IMAGES['pipe'][1], (lPipe['x'], lPipe['y']))
-
-        SCREEN.blit(IMAGES['base'], (self.basex, BASEY))
-        # print score so player overlaps the score
-        # self.showScore(self.score)
-        SCREEN.blit(IMAGES['player'][self.playerIndex], (self.playerx, self.playery))
-
-
-        image_data = pygame.surfarray.array3d(pygame.display.get_surface())
-
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
-
-        return image_data, reward, endgame
+            if uPipe['x'] + pipeW > self.playerx and len(features) < FEATURECOUNT:
+                features += [(uPipe['x'] - self.playerx) / SCREENWIDTH,
+                             uPipe['y'] / SCREENHEIGHT, lPipe['y'] / SCREENHEIGHT]
+        while len(features) < FEATURECOUNT:
+            features += MISSINGPIPE
+        return np.array(features, dtype=np.float32)
+
+    def playSound(self, name):
+        """plays a sound unless running headless or without audio"""
+        if not self.headless and self.audio:
+            if name not in SOUNDS:
+                SOUNDS[name] = assets.getSound(name)
+            if SOUNDS[name] is not None:
+                SOUNDS[name].play()
 
     def playerShm(self, playerShm):
         """oscillates the value of playerShm['val'] between 8 and -8"""
@@ -298,7 +408,8 @@ class GameState:
     def getRandomPipe(self):
         """returns a randomly generated pipe"""
         # y of gap between upper and lower pipe
-        gapY = random.randrange(0, int(BASEY * 0.6 - PIPEGAPSIZE))
+        gapY = mix64(self.pipeSeed, self.pipesDrawn) % int(BASEY * 0.6 - PIPEGAPSIZE)
+        self.pipesDrawn += 1
         gapY += int(BASEY * 0.2)
         pipeHeight = IMAGES['pipe'][0].get_height()
         pipeX = SCREENWIDTH + 10
@@ -309,6 +420,32 @@ class GameState:
         ]
 
 
+    def snapshot(self):
+        """returns the whole game state as SNAPSHOT_SIZE floats"""
+        record = [self.playery, self.playerVelY, self.playerFlapped, self.playerIndex,
+                  self.playerIndexStep, self.loopIter, self.basex, self.score,
+                  self.pipeSeed, self.pipesDrawn, len(self.upperPipes)]
+        for uPipe, lPipe in zip(self.upperPipes, self.lowerPipes):
+            record += (uPipe['x'], uPipe['y'], lPipe['y'])
+        record += [0] * (SNAPSHOT_SIZE - len(record))
+        return np.array(record, dtype=np.float64)
+
+    def restore(self, record):
+        """returns the game to the state of a snapshot() record"""
+        (self.playery, self.playerVelY, flapped, index, indexStep, loopIter, basex,
+         score, pipeSeed, pipesDrawn, pipes) = record[:len(SNAPSHOT_FIELDS)].tolist()
+        self.playerFlapped = bool(flapped)
+        self.playerIndex = int(index)
+        self.playerIndexStep = int(indexStep)
+        self.loopIter = int(loopIter)
+        self.basex = int(basex)
+        self.score = int(score)
+        self.pipeSeed = int(pipeSeed)
+        self.pipesDrawn = int(pipesDrawn)
+        values = record[len(SNAPSHOT_FIELDS):len(SNAPSHOT_FIELDS) + 3 * int(pipes)].tolist()
+        self.upperPipes = [{'x': x, 'y': int(uy)} for x, uy, ly in zip(*[iter(values)] * 3)]
+        self.lowerPipes = [{'x': x, 'y': int(ly)} for x, uy, ly in zip(*[iter(values)] * 3)]
+
     def showScore(self, score):
         """displays score in center of screen"""
         scoreDigits = [int(x) for x in list(str(score))]
@@ -326,60 +463,13 @@ class GameState:
 
     def checkCrash(self, player, upperPipes, lowerPipes):
         """returns True if player collders with base or pipes."""
-        pi = player['index']
-        player['w'] = IMAGES['player'][0].get_width()
-        player['h'] = IMAGES['player'][0].get_height()
-
-        # if player crashes into ground
-        if player['y'] + player['h'] >= BASEY - 1:
-            return [True, True]
-        else:
-
-            playerRect = pygame.Rect(player['x'], player['y'],
-                          player['w'], player['h'])
-            pipeW = IMAGES['pipe'][0].get_width()
-            pipeH = IMAGES['pipe'][0].get_height()
-
-            for uPipe, lPipe in zip(upperPipes, lowerPipes):
-                # upper and lower pipe rects
-                uPipeRect = pygame.Rect(uPipe['x'], uPipe['y'], pipeW, pipeH)
-                lPipeRect = pygame.Rect(lPipe['x'], lPipe['y'], pipeW, pipeH)
-
-                # player and upper/lower pipe hitmasks
-                pHitMask = HITMASKS['player'][pi]
-                uHitmask = HITMASKS['pipe'][0]
-                lHitmask = HITMASKS['pipe'][1]
-
-                # if bird collided with upipe or lpipe
-                uCollide = self.pixelCollision(playerRect, uPipeRect, pHitMask, uHitmask)
-                lCollide = self.pixelCollision(playerRect, lPipeRect, pHitMask, lHitmask)
-
-                if uCollide or lCollide:
-                    return [True, False]
-
-        return [False, False]
+        return collision.checkCrash(player, upperPipes, lowerPipes,
+                                    IMAGES, HITMASKS, BASEY)
 
     def pixelCollision(self, rect1, rect2, hitmask1, hitmask2):
         """Checks if two objects collide and not just their rects"""
-        rect = rect1.clip(rect2)
-
-        if rect.width == 0 or rect.height == 0:
-            return False
-
-        x1, y1 = rect.x - rect1.x, rect.y - rect1.y
-        x2, y2 = rect.x - rect2.x, rect.y - rect2.y
-
-        for x in range(rect.width):
-            for y in range(rect.height):
-                if hitmask1[x1+x][y1+y] and hitmask2[x2+x][y2+y]:
-                    return True
-        return False
+        return collision.pixelCollision(rect1, rect2, hitmask1, hitmask2)
 
     def getHitmask(self, image):
         """returns a hitmask using an image's alpha."""
-        mask = []
-        for x in range(image.get_width()):
-            mask.append([])
-            for y in range(image.get_height()):
-                mask[x].append(bool(image.get_at((x,y))[3]))
-        return mask
+        return collision.getHitmask(image)
@@ -0,0 +1,226 @@
+import numpy as np
+
+from . import assets, flappy_new as game
+from .raster import OBSSIZE, Rasterizer
+
+SCREENWIDTH  = game.SCREENWIDTH
+SCREENHEIGHT = game.SCREENHEIGHT
+PIPEGAPSIZE  = game.PIPEGAPSIZE
+BASEY        = game.BASEY
+
+# constants GameState sets up per instance, kept identical here
+PIPEVELX      = -4  # pipes speed along X
+PLAYERMAXVELY =  10 # max vel along Y, max descend speed
+PLAYERACCY    =   1 # players downward accleration
+PLAYERFLAPACC =  -9 # players speed on flapping
+PLAYERX       = int(SCREENWIDTH * 0.2)
+PLAYERINDEXES = np.array(game.PLAYERINDEXES)
+
+MAXPIPES = 3 # a new pipe is added before the first one is removed
+NOPIPE   = 10 ** 6 # x of an unused pipe slot, never scores or collides
+
+
+def loadHitmask(path, rotate=False):
+    """returns an image's alpha as a boolean (width, height) array"""
+    return assets.getHitmask(path, rotate)
+
+
+def getCollisionTable(playerMask, pipeMask):
+    """returns table[ox, oy], True if player drawn at offset (ox, oy) from
+    the pipe overlaps it. Offsets are shifted by the player size so the
+    table covers every overlapping position."""
+    pw, ph = playerMask.shape
+    w, h = pipeMask.shape
+    padded = np.zeros((w + 2 * (pw - 1), h + 2 * (ph - 1)), dtype=np.float32)
+    padded[pw - 1:pw - 1 + w, ph - 1:ph - 1 + h] = pipeMask
+    flat = playerMask.astype(np.float32).ravel()
+
+    table = np.zeros((w + pw - 1, h + ph - 1), dtype=bool)
+    for ox in range(table.shape[0]):
+        columns = padded[ox:ox + pw]
+        # every vertical offset at once, (h + ph - 1, pw, ph) windows
+        windows = np.lib.stride_tricks.sliding_window_view(columns, ph, axis=1)
+        table[ox] = np.tensordot(windows.transpose(1, 0, 2).reshape(
+            table.shape[1], -1), flat, axes=1) > 0
+    return table
+
+
+class VectorGameState:
+    """Steps n games of flappy_new.GameState at once in NumPy arrays.
+
+    Finished games restart the way GameState.reInit does, so step() has the
+    same reward and terminal semantics as frame_step for every game."""
+
+    def __init__(self, n, seed=None, frameSkip=1):
+        self.n = n
+        self.frameSkip = frameSkip
+        self.random = np.random.RandomState(seed)
+
+        playerMasks = [loadHitmask(path) for path in game.PLAYERS_LIST[0]]
+        pipeMask = loadHitmask(game.PIPES_LIST[0])
+        self.playerWidth, self.playerHeight = playerMasks[0].shape
+        self.pipeWidth, self.pipeHeight = pipeMask.shape
+
+        # collision tables indexed [pipe, playerIndex, ox, oy]
+        self.crashTable = np.array([
+            [getCollisionTable(mask, pipeMask[::-1, ::-1]) for mask in playerMasks],
+            [getCollisionTable(mask, pipeMask) for mask in playerMasks],
+        ])
+
+        self.playery       = np.zeros(n)
+        self.playerVelY    = np.zeros(n, dtype=np.int64)
+        self.playerIndex   = np.zeros(n, dtype=np.int64)
+        self.playerIndexAt = np.zeros(n, dtype=np.int64) # position in PLAYERINDEXES
+        self.loopIter      = np.zeros(n, dtype=np.int64)
+        self.basex         = np.zeros(n, dtype=np.int64)
+        self.score         = np.zeros(n, dtype=np.int64)
+
+        # pipe x and gap y, upper pipe at gapY - pipeHeight, lower at gapY + PIPEGAPSIZE
+        self.pipeX = np.full((n, MAXPIPES), NOPIPE, dtype=np.int64)
+        self.pipeGapY = np.zeros((n, MAXPIPES), dtype=np.int64)
+        self.pipeCount = np.zeros(n, dtype=np.int64)
+
+        self.baseShift = 336 - SCREENWIDTH # base width - background width
+        self.rasterizer = None
+        self.reset(np.ones(n, dtype=bool))
+
+    @property
+    def upperPipeY(self):
+        return self.pipeGapY - self.pipeHeight
+
+    @property
+    def lowerPipeY(self):
+        return self.pipeGapY + PIPEGAPSIZE
+
+    def getRandomGapY(self, count):
+        """returns count random gap y positions, see GameState.getRandomPipe"""
+        return self.random.randint(0, int(BASEY * 0.6 - PIPEGAPSIZE), size=count) \
+            + int(BASEY * 0.2)
+
+    def reset(self, games):
+        """restarts the games selected by the boolean mask games"""
+        count = int(games.sum())
+        self.playery[games] = int((SCREENHEIGHT - self.playerHeight) / 2)
+        self.playerVelY[games] = PLAYERFLAPACC
+        self.playerIndex[games] = 0
+        self.playerIndexAt[games] = 0
+        self.loopIter[games] = 0
+        self.basex[games] = 0
+        self.score[games] = 0
+
+        self.pipeX[games] = NOPIPE
+        self.pipeX[games, 0] = SCREENWIDTH + 200
+        self.pipeX[games, 1] = SCREENWIDTH + 200 + SCREENWIDTH // 2
+        self.pipeGapY[games, 0] = self.getRandomGapY(count)
+        self.pipeGapY[games, 1] = self.getRandomGapY(count)
+        self.pipeCount[games] = 2
+
+    def step(self, actions):
+        """advances every game by frameSkip frames, repeating actions.
+
+        actions holds a flap flag per game, or GameState style one-hot rows.
+        Returns rewards summed over the frames and terminals, a game stops at
+        its crash with a reward of -1 and is already restarted."""
+        actions = np.asarray(actions)
+        if actions.ndim == 2:
+            flap = actions[:, 1] == 1
+        else:
+            flap = actions == 1
+
+        rewards = np.zeros(self.n, dtype=np.float32)
+        terminals = np.zeros(self.n, dtype=bool)
+        active = np.ones(self.n, dtype=bool)
+        for i in range(self.frameSkip):
+            tickRewards, crashed = self.tick(flap, active)
+            rewards += tickRewards
+            if crashed.any():
+                # GameState.reInit restarts and runs one more frame without flapping
+                self.reset(crashed)
+                self.tick(np.zeros(self.n, dtype=bool), crashed)
+                rewards[crashed] = -1
+                terminals |= crashed
+                active &= ~crashed
+        return rewards, terminals
+
+    def tick(self, flap, games=None):
+        """runs one frame of GameState.frame_step physics for the games mask"""
+        if games is None:
+            games = np.ones(self.n, dtype=bool)
+        rewards = np.zeros(self.n, dtype=np.float32)
+
+        flapped = games & flap & (self.playery > -2 * self.playerHeight)
+        self.playerVelY[flapped] = PLAYERFLAPACC
+
+        # check for score
+        playerMidPos = PLAYERX + self.playerWidth / 2
+        pipeMidPos = self.pipeX + self.pipeWidth / 2
+        scored = ((pipeMidPos <= playerMidPos) & (playerMidPos < pipeMidPos + 4)).any(axis=1)
+        scored &= games
+        self.score += scored
+        rewards[scored] = 1
+
+        # playerIndex basex change
+        advance = games & ((self.loopIter + 1) % 3 == 0)
+        self.playerIndex[advance] = PLAYERINDEXES[self.playerIndexAt[advance] % 4]
+        self.playerIndexAt += advance
+        self.loopIter[games] = (self.loopIter[games] + 1) % 30
+        self.basex[games] = -((-self.basex[games] + 100) % self.baseShift)
+
+        # player's movement
+        fall = games & ~flapped & (self.playerVelY < PLAYERMAXVELY)
+        self.playerVelY += fall * PLAYERACCY
+        self.playery[games] += np.minimum(self.playerVelY[games],
+            BASEY - self.playery[games] - self.playerHeight)
+
+        # move pipes to left
+        moving = games[:, None] & (self.pipeX != NOPIPE)
+        self.pipeX[moving] += PIPEVELX
+
+        # add new pipe when first pipe is about to touch left of screen
+        add = games & (0 < self.pipeX[:, 0]) & (self.pipeX[:, 0] < 5)
+        if add.any():
+            rows = np.flatnonzero(add)
+            self.pipeX[rows, self.pipeCount[rows]] = SCREENWIDTH + 10
+            self.pipeGapY[rows, self.pipeCount[rows]] = self.getRandomGapY(len(rows))
+            self.pipeCount[rows] += 1
+
+        # remove first pipe if its out of the screen
+        remove = games & (self.pipeX[:, 0] < -self.pipeWidth)
+        if remove.any():
+            self.pipeX[remove, :-1] = self.pipeX[remove, 1:]
+            self.pipeGapY[remove, :-1] = self.pipeGapY[remove, 1:]
+            self.pipeX[remove, -1] = NOPIPE
+            self.pipeCount[remove] -= 1
+
+        return rewards, games & self.checkCrash()
+
+    def getObservations(self, out=None):
+        """returns the 80x80 observation of every game, see GameState.getObservation"""
+        if self.rasterizer is None:
+            self.rasterizer = Rasterizer(game.PLAYERS_LIST[0], game.PIPES_LIST[0],
+                'flappybird/assets/sprites/base.png', BASEY, (SCREENWIDTH, SCREENHEIGHT))
+        if out is None:
+            out = np.empty((self.n,) + OBSSIZE, dtype=np.uint8)
+        upperPipeY, lowerPipeY = self.upperPipeY, self.lowerPipeY
+        for i in range(self.n):
+            count = self.pipeCount[i]
+            pipes = zip(self.pipeX[i, :count], upperPipeY[i, :count], lowerPipeY[i, :count])
+            self.rasterizer.draw(PLAYERX, self.playery[i], self.playerIndex[i],
+                                 pipes, self.basex[i], out[i])
+        return out
+
+    def checkCrash(self):
+        """returns True for every game whose player hit the base or a pipe"""
+        crashed = self.playery + self.playerHeight >= BASEY - 1
+
+        # offsets of the player relative to each pipe, as pygame.Rect truncates
+        playery = np.trunc(self.playery).astype(np.int64)[:, None]
+        ox = PLAYERX - self.pipeX + self.playerWidth - 1
+        for pipe, pipeY in enumerate((self.upperPipeY, self.lowerPipeY)):
+            oy = playery - pipeY + self.playerHeight - 1
+            inside = (ox >= 0) & (ox < self.crashTable.shape[2]) \
+                & (oy >= 0) & (oy < self.crashTable.shape[3])
+            rows, cols = np.nonzero(inside)
+            hit = self.crashTable[pipe, self.playerIndex[rows], ox[rows, cols], oy[rows, cols]]
+            crashed[rows[hit]] = True
+        return crashed
@@ -0,0 +1,119 @@
+import threading
+
+import numpy as np
+import pygame
+
+OBSSIZE = (80, 80) # size of the preprocessed observation, (width, height)
+
+
+def loadSprite(path, rotate=False):
+    """returns an image's gray level on a black background and its hitmask
+    as (width, height) arrays"""
+    image = pygame.image.load(path)
+    rgb = pygame.surfarray.array3d(image).astype(np.float32)
+    alpha = pygame.surfarray.array_alpha(image)
+    # cv2.COLOR_BGR2GRAY weights applied to pygame's RGB order, as in
+    # Qflappybird's preprocessing
+    gray = rgb.dot(np.array([0.114, 0.587, 0.299], dtype=np.float32)) * (alpha / 255.0)
+    mask = alpha > 0
+    if rotate:
+        # same as pygame.transform.rotate(image, 180)
+        gray, mask = gray[::-1, ::-1], mask[::-1, ::-1]
+    return gray.astype(np.float32), mask
+
+
+def getSamples(size, outSize):
+    """returns the two source pixels and the weight of the second one that
+    cv2.resize INTER_LINEAR reads for every output pixel"""
+    position = (np.arange(outSize) + 0.5) * size / outSize - 0.5
+    first = np.clip(np.floor(position), 0, size - 1).astype(np.int64)
+    weight = np.clip(position - first, 0, 1).astype(np.float32)
+    second = np.minimum(first + 1, size - 1)
+    return first, second, weight
+
+
+class Rasterizer:
+    """Draws the 80x80 binary observation straight from game state.
+
+    Only the screen pixels cv2.resize samples are drawn, then blended and
+    thresholded the way Qflappybird preprocesses a full frame."""
+
+    def __init__(self, playerPaths, pipePath, basePath, baseY, screenSize):
+        self.players = [loadSprite(path) for path in playerPaths]
+        self.pipes = (loadSprite(pipePath, rotate=True), loadSprite(pipePath))
+        self.base = loadSprite(basePath)
+        self.baseY = baseY
+
+        width, height = OBSSIZE
+        x0, x1, fx = getSamples(screenSize[0], width)
+        y0, y1, fy = getSamples(screenSize[1], height)
+        self.xs = np.concatenate((x0, x1))
+        self.ys = np.concatenate((y0, y1))
+        # bilinear weights of the four samples, scene is laid out as
+        # [x0|x1] by [y0|y1] blocks
+        self.weights = (
+            np.outer(1 - fx, 1 - fy), np.outer(1 - fx, fy),
+            np.outer(fx, 1 - fy), np.outer(fx, fy),
+        )
+        # one scene per thread, so games in several threads can share sprites
+        self.local = threading.local()
+        # base only ever takes a few x positions, keep its sampled pixels
+        self.baseSamples = {}
+
+    @property
+    def scene(self):
+        scene = getattr(self.local, 'scene', None)
+        if scene is None:
+            width, height = OBSSIZE
+            scene = self.local.scene = np.zeros((2 * width, 2 * height), dtype=np.float32)
+        return scene
+
+    def sample(self, sprite, x, y):
+        """returns the scene index, mask and gray level of sprite drawn at
+        (x, y), or None if it is outside the sampled pixels"""
+        gray, mask = sprite
+        cols = self.xs - int(x)
+        rows = self.ys - int(y)
+        colIndex = np.flatnonzero((cols >= 0) & (cols < gray.shape[0]))
+        rowIndex = np.flatnonzero((rows >= 0) & (rows < gray.shape[1]))
+        if len(colIndex) == 0 or len(rowIndex) == 0:
+            return None
+
+        source = np.ix_(cols[colIndex], rows[rowIndex])
+        return np.ix_(colIndex, rowIndex), mask[source], gray[source]
+
+    def blit(self, sprite, x, y, samples=None):
+        """draws sprite at (x, y) into the sampled scene"""
+        if samples is None:
+            samples = self.sample(sprite, x, y)
+            if samples is None:
+                return
+        target, mask, gray = samples
+        scene = self.scene
+        scene[target] = np.where(mask, gray, scene[target])
+
+    def draw(self, playerx, playery, playerIndex, pipes, basex, out=None):
+        """returns the observation as uint8 0/255, indexed [x][y] like
+        pygame.surfarray. pipes holds (x, upperY, lowerY) tuples"""
+        self.scene.fill(0)
+        for x, upperY, lowerY in pipes:
+            self.blit(self.pipes[0], x, upperY)
+            self.blit(self.pipes[1], x, lowerY)
+        basex = int(basex)
+        if basex not in self.baseSamples:
+            self.baseSamples[basex] = self.sample(self.base, basex, self.baseY)
+        self.blit(self.base, basex, self.baseY, self.baseSamples[basex])
+        self.blit(self.players[playerIndex], playerx, playery)
+
+        width, height = OBSSIZE
+        scene = self.scene
+        value = self.weights[0] * scene[:width, :height] \
+            + self.weights[1] * scene[:width, height:] \
+            + self.weights[2] * scene[width:, :height] \
+            + self.weights[3] * scene[width:, height:]
+
+        if out is None:
+            out = np.empty(OBSSIZE, dtype=np.uint8)
+        # cv2 rounds to uint8 before thresholding at 1
+        np.multiply(value >= 1.5, 255, out=out, casting='unsafe')
+        return out
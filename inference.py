@@ -0,0 +1,105 @@
+import collections
+import queue
+import threading
+import time
+
+import numpy as np
+
+LATENCY_SAMPLES = 100000 # Number of recent request latencies kept for percentiles
+
+
+class Request:
+    """One stack waiting for its Q values"""
+
+    def __init__(self, stack):
+        self.stack = stack
+        self.time = time.time()
+        self.done = threading.Event()
+        self.readout = None
+
+
+class InferenceServer:
+    """Serves action requests from many threads in batches.
+
+    act() queues a stack and blocks until a server thread has run it
+    through evaluate(stacks), which returns Q values for a whole batch. A
+    batch is closed after maxBatch requests, or maxWait seconds after its
+    first request arrived, whichever comes first."""
+
+    def __init__(self, evaluate, maxBatch = 32, maxWait = 0.002, stackShape = (80, 80, 4),
+                 dtype = np.uint8):
+        self.evaluate = evaluate
+        self.maxBatch = maxBatch
+        self.maxWait = maxWait
+        self.requests = queue.Queue()
+        self.stacks = np.empty((maxBatch,) + stackShape, dtype = dtype)
+
+        self.latencies = collections.deque(maxlen = LATENCY_SAMPLES)
+        self.batchSizes = np.zeros(maxBatch + 1, dtype = np.int64) # histogram
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def act(self, stack):
+        """returns the greedy action index and Q values for stack"""
+        request = Request(stack)
+        self.requests.put(request)
+        request.done.wait()
+        return int(np.argmax(request.readout)), request.readout
+
+    def getBatch(self):
+        """waits for the next batch of requests, None once closed"""
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.time + self.maxWait
+        while len(batch) < self.maxBatch:
+            try:
+                request = self.requests.get(timeout = max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                # serve what is waiting, then stop
+                self.requests.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def serve(self):
+        while True:
+            batch = self.getBatch()
+            if batch is None:
+                return
+            stacks = self.stacks[:len(batch)]
+            for i, request in enumerate(batch):
+                stacks[i] = request.stack
+            readouts = self.evaluate(stacks)
+
+            now = time.time()
+            for request, readout in zip(batch, readouts):
+                request.readout = readout
+                request.done.set()
+                self.latencies.append(now - request.time)
+            self.batchSizes[len(batch)] += 1
+
+    def getStats(self):
+        """latency percentiles in seconds and the batch size histogram"""
+        latencies = np.array(self.latencies)
+        stats = {
+            'requests': int(np.dot(np.arange(self.maxBatch + 1), self.batchSizes)),
+            'batches': int(self.batchSizes.sum()),
+            'batch sizes': dict((size, int(count)) for size, count
+                                in enumerate(self.batchSizes) if count),
+        }
+        if len(latencies):
+            for percentile in (50, 90, 99):
+                stats['latency p%d' % percentile] = float(np.percentile(latencies, percentile))
+        return stats
@@ -0,0 +1,193 @@
+import http.server
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+
+import numpy as np
+
+
+class Metrics:
+    """Stage timings, counters, gauges and game scores of a training loop.
+
+    The loop calls lap(stage, clock) after each stage, which adds the time
+    since clock to the stage and returns the new clock, and tick() once per
+    step. Every flushSeconds tick() appends a JSON line with the interval's
+    statistics to a log in directory, rotated after maxBytes with backups
+    old files kept. Given a port, the totals are also served over HTTP on
+    localhost, as JSON at / and in the Prometheus text format at /metrics."""
+
+    def __init__(self, directory, name, flushSeconds = 10, maxBytes = 10 * 2 ** 20,
+                 backups = 3, port = None):
+        self.name = name
+        self.flushSeconds = flushSeconds
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handler = logging.handlers.RotatingFileHandler(
+            os.path.join(directory, name + '.jsonl'), maxBytes = maxBytes, backupCount = backups)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.log = logging.getLogger('metrics.' + name)
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log.handlers = [handler]
+
+        # per interval, reset by flush()
+        self.seconds = {}
+        self.calls = {}
+        self.longest = {}
+        self.scores = []
+        self.steps = 0
+        # since start, what the HTTP endpoint serves as of the last flush()
+        self.totalSeconds = {}
+        self.totalCalls = {}
+        self.totalSteps = 0
+        self.counters = {}
+        self.gauges = {}
+
+        self.lock = threading.Lock() # between flush() and HTTP requests
+        self.latest = {}
+        self.startTime = self.flushTime = time.perf_counter()
+        self.nextFlush = self.flushTime + flushSeconds
+        self.clock = self.flushTime
+        self.server = None
+        self.thread = None
+        if port is not None:
+            self.serve(port)
+
+    def now(self):
+        return time.perf_counter()
+
+    def lap(self, stage, clock):
+        """adds the time since clock to stage, returns the current clock"""
+        now = time.perf_counter()
+        elapsed = now - clock
+        if stage in self.seconds:
+            self.seconds[stage] += elapsed
+            self.calls[stage] += 1
+            if elapsed > self.longest[stage]:
+                self.longest[stage] = elapsed
+        else:
+            self.seconds[stage] = elapsed
+            self.calls[stage] = 1
+            self.longest[stage] = elapsed
+        self.clock = now
+        return now
+
+    def count(self, name, value = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def score(self, score):
+        self.scores.append(score)
+
+    def isDue(self):
+        """whether the next tick() flushes, gauges only read then can be set"""
+        return self.clock >= self.nextFlush
+
+    def tick(self):
+        """ends a step, flushing if the interval is over"""
+        self.steps += 1
+        if self.clock >= self.nextFlush:
+            self.flush()
+
+    def flush(self):
+        now = time.perf_counter()
+        interval = now - self.flushTime
+        record = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seconds': interval,
+            'steps': self.steps,
+            'steps/s': self.steps / interval,
+            'stages': dict((stage, {
+                'mean ms': self.seconds[stage] / self.calls[stage] * 1e3,
+                'max ms': self.longest[stage] * 1e3,
+                'calls': self.calls[stage],
+                'share': self.seconds[stage] / interval,
+            }) for stage in self.seconds),
+            'counters': dict(self.counters),
+            'gauges': dict(self.gauges),
+        }
+        if self.scores:
+            record['games'] = len(self.scores)
+            record['score mean'] = float(np.mean(self.scores))
+            record['score max'] = max(self.scores)
+        self.log.info(json.dumps(record, sort_keys = True))
+
+        with self.lock:
+            for stage, seconds in self.seconds.items():
+                self.totalSeconds[stage] = self.totalSeconds.get(stage, 0) + seconds
+                self.totalCalls[stage] = self.totalCalls.get(stage, 0) + self.calls[stage]
+            self.totalSteps += self.steps
+            self.latest = record
+        self.seconds, self.calls, self.longest = {}, {}, {}
+        self.scores = []
+        self.steps = 0
+        self.flushTime = now
+        self.nextFlush = now + self.flushSeconds
+
+    def getTotals(self):
+        with self.lock:
+            return {
+                'uptime seconds': time.perf_counter() - self.startTime,
+                'steps': self.totalSteps,
+                'stage seconds': dict(self.totalSeconds),
+                'stage calls': dict(self.totalCalls),
+                'counters': self.latest.get('counters', {}),
+                'gauges': self.latest.get('gauges', {}),
+                'latest': self.latest,
+            }
+
+    def getPrometheus(self):
+        """totals in the Prometheus text exposition format"""
+        totals = self.getTotals()
+        prefix = self.name.replace('-', '_')
+        lines = ['%s_steps_total %d' % (prefix, totals['steps'])]
+        for stage in sorted(totals['stage seconds']):
+            lines.append('%s_stage_seconds_total{stage="%s"} %r' % (
+                prefix, stage, totals['stage seconds'][stage]))
+            lines.append('%s_stage_calls_total{stage="%s"} %d' % (
+                prefix, stage, totals['stage calls'][stage]))
+        for name, value in sorted(totals['counters'].items()):
+            lines.append('%s_%s_total %r' % (prefix, name, value))
+        for name, value in sorted(totals['gauges'].items()):
+            lines.append('%s_%s %r' % (prefix, name, value))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port):
+        """serves the totals on localhost:port from a daemon thread, port 0
+        picks a free one, read back from server.server_address"""
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body, contentType = metrics.getPrometheus(), 'text/plain; version=0.0.4'
+                else:
+                    body, contentType = json.dumps(metrics.getTotals()), 'application/json'
+                body = body.encode()
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.flush()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.thread.join()
+        for handler in self.log.handlers:
+            handler.close()
@@ -0,0 +1,291 @@
+"""
+Time each stage of a training step on its own and write the results as JSON
+Usage: python microbench.py [--output results.json] [--compare baseline.json]
+Stages that need TensorFlow are skipped when it is not installed. With
+--compare, stages slower than the baseline by more than THRESHOLD are listed
+and the exit status is 1
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import pygame
+
+import flappybird.flappy_new as game
+import network
+from metrics import Metrics
+from replay import ReplayMemory
+
+MIN_SECONDS = 0.2 # Each repeat runs enough calls to last at least this long
+REPEATS = 5 # Repeats per stage, the fastest is compared across commits
+THRESHOLD = 1.2 # Slowdown against the baseline reported as a regression
+RECORDED_STEPS = 1000 # Game states recorded to replay collision checks on
+REPLAY_CAPACITY = 50000 # Transitions in the replay memory sampled from
+BATCH = 32 # Minibatch size of the batched stages
+
+
+"""
+Run call until it has taken MIN_SECONDS, REPEATS times
+Returns the seconds per call of every repeat and the calls per repeat
+"""
+def timeCall(call):
+    calls = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(calls):
+            call()
+        seconds = time.perf_counter() - start
+        if seconds >= MIN_SECONDS:
+            break
+        calls = max(calls * 2, int(calls * MIN_SECONDS / max(seconds, 1e-9)))
+    times = [seconds / calls]
+    for repeat in range(REPEATS - 1):
+        start = time.perf_counter()
+        for i in range(calls):
+            call()
+        times.append((time.perf_counter() - start) / calls)
+    return times, calls
+
+def createGame(observation = 'image'):
+    return game.GameState(headless = True, observation = observation)
+
+"""
+Player and pipe arguments of checkCrash, recorded from a game played with
+random flaps
+"""
+def recordStates(steps = RECORDED_STEPS):
+    game_state = createGame('raster')
+    flaps = np.random.RandomState(0).rand(steps) < 0.1
+    states = []
+    for flap in flaps:
+        game_state.frame_step([1 - flap, flap])
+        states.append(({'x': game_state.playerx, 'y': game_state.playery,
+                        'index': game_state.playerIndex},
+                       [dict(pipe) for pipe in game_state.upperPipes],
+                       [dict(pipe) for pipe in game_state.lowerPipes]))
+    return game_state, states
+
+def getStack():
+    return (np.random.RandomState(0).rand(80, 80, 4) < 0.1).astype(np.uint8) * 255
+
+def getStacks(count):
+    return (np.random.RandomState(0).rand(count, 80, 80, 4) < 0.1).astype(np.uint8) * 255
+
+def getFullMemory():
+    memory = ReplayMemory(REPLAY_CAPACITY)
+    frame = getStack()[:, :, 0]
+    memory.start(frame)
+    for i in range(REPLAY_CAPACITY):
+        memory.append(frame, i % 2, 0, i % 100 == 99)
+    return memory
+
+# Every setup function returns the call to time
+
+def setupGameInit():
+    return lambda: createGame()
+
+def setupFrameStep():
+    game_state = createGame()
+    return lambda: game_state.frame_step([1, 0])
+
+def setupFrameStepRaster():
+    game_state = createGame('raster')
+    return lambda: game_state.frame_step([1, 0])
+
+def setupCheckCrash():
+    game_state, states = recordStates()
+    states = itertools.cycle(states)
+    return lambda: game_state.checkCrash(*next(states))
+
+def setupPixelCollision():
+    game_state = createGame('raster')
+    player = game.IMAGES['player'][0]
+    pipe = game.IMAGES['pipe'][1]
+    # the bird overlapping the top left corner of a lower pipe
+    playerRect = pygame.Rect(100, 300, player.get_width(), player.get_height())
+    pipeRect = pygame.Rect(110, 310, pipe.get_width(), pipe.get_height())
+    return lambda: game_state.pixelCollision(playerRect, pipeRect, game.HITMASKS['player'][0],
+                                             game.HITMASKS['pipe'][1])
+
+def setupGetHitmask():
+    game_state = createGame('raster')
+    return lambda: game_state.getHitmask(game.IMAGES['pipe'][0])
+
+def setupPreprocess():
+    # Qflappybird.preprocess on the rendered screen, which needs TensorFlow to import
+    game_state = createGame()
+    image_data = game_state.frame_step([1, 0])[0]
+    def preprocess():
+        x_t = cv2.cvtColor(cv2.resize(image_data, (80, 80)), cv2.COLOR_BGR2GRAY)
+        ret, x_t = cv2.threshold(x_t, 1, 255, cv2.THRESH_BINARY)
+        return x_t
+    return preprocess
+
+def setupObservation():
+    game_state = createGame('raster')
+    game_state.frame_step([1, 0])
+    return game_state.getObservation
+
+def setupStackAppend():
+    stack = getStack()
+    frame = stack[:, :, :1]
+    return lambda: np.append(frame, stack[:, :, :3], axis = 2)
+
+def setupReplayAppend():
+    memory = ReplayMemory(REPLAY_CAPACITY)
+    frame = getStack()[:, :, 0]
+    memory.start(frame)
+    return lambda: memory.append(frame, 1, 0, False)
+
+def setupReplaySample():
+    memory = getFullMemory()
+    return lambda: memory.sampleWeighted(BATCH)
+
+def setupMetricsLap():
+    metrics = Metrics(tempfile.mkdtemp(), 'microbench', flushSeconds = 1)
+    def lap():
+        metrics.lap('stage', metrics.now())
+        metrics.tick()
+    return lap
+
+def setupForward(batchSize):
+    weights = network.initWeights(seed = 0)
+    stacks = getStacks(batchSize)
+    return lambda: network.forward(weights, stacks)
+
+"""
+Session and graph of Qflappybird's training loop on random weights
+"""
+def createGraph():
+    import tensorflow as tf
+    import Qflappybird as dqn
+
+    sess = tf.InteractiveSession()
+    IL, ROL, H_FCL, weights = dqn.createNetwork()
+    target_weights, sync_target = dqn.copyWeights(weights)
+    placeholders, train_step, td_error = dqn.cost_function(ROL, weights, target_weights)
+    sess.run(tf.initialize_all_variables())
+    return dqn, sess, IL, ROL, placeholders, train_step, td_error
+
+def setupEval(graph, batchSize):
+    dqn, sess, IL, ROL, placeholders, train_step, td_error = graph
+    stacks = getStacks(batchSize)
+    return lambda: ROL.eval(feed_dict = {IL : stacks})
+
+def setupTrainStep(graph):
+    dqn, sess, IL, ROL, placeholders, train_step, td_error = graph
+    batch = getFullMemory().sampleWeighted(BATCH)
+    return lambda: dqn.trainBatch(sess, IL, placeholders, train_step, td_error, batch)
+
+# (name, setup) of every stage, in the order of a training step
+BENCHMARKS = [
+    ('GameState.__init__', setupGameInit),
+    ('frame_step', setupFrameStep),
+    ('frame_step raster', setupFrameStepRaster),
+    ('checkCrash', setupCheckCrash),
+    ('pixelCollision', setupPixelCollision),
+    ('getHitmask', setupGetHitmask),
+    ('preprocess cv2', setupPreprocess),
+    ('getObservation', setupObservation),
+    ('stack np.append', setupStackAppend),
+    ('replay append', setupReplayAppend),
+    ('replay sample', setupReplaySample),
+    ('metrics lap', setupMetricsLap),
+    ('numpy forward 1', lambda: setupForward(1)),
+    ('numpy forward %d' % BATCH, lambda: setupForward(BATCH)),
+]
+
+# (name, setup(graph)) of the stages that need TensorFlow
+GRAPH_BENCHMARKS = [
+    ('ROL.eval 1', lambda graph: setupEval(graph, 1)),
+    # what target evaluation cost before targets moved into train_step
+    ('ROL.eval %d' % BATCH, lambda graph: setupEval(graph, BATCH)),
+    ('train_step.run', setupTrainStep),
+]
+
+def getCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+"""
+Time every stage, returns the JSON record of the run
+"""
+def runBenchmarks(names = None):
+    stages = [(name, setup, ()) for name, setup in BENCHMARKS]
+    try:
+        graph = createGraph()
+    except ImportError:
+        graph = None
+    if graph is not None:
+        stages += [(name, setup, (graph,)) for name, setup in GRAPH_BENCHMARKS]
+
+    results = {}
+    for name, setup, args in stages:
+        if names and name not in names:
+            continue
+        times, calls = timeCall(setup(*args))
+        results[name] = {'min': min(times), 'median': float(np.median(times)), 'calls': calls}
+        print('%-22s %12.2f us/call' % (name, min(times) * 1e6), file = sys.stderr)
+
+    return {
+        'commit': getCommit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': multiprocessing.cpu_count(),
+        'skipped': [name for name, setup in GRAPH_BENCHMARKS] if graph is None else [],
+        'results': results,
+    }
+
+"""
+Stages of run slower than in baseline by more than THRESHOLD, with the ratio
+"""
+def compare(run, baseline):
+    regressions = []
+    for name, result in sorted(run['results'].items()):
+        if name not in baseline['results']:
+            continue
+        ratio = result['min'] / baseline['results'][name]['min']
+        print('%-22s %6.2fx baseline' % (name, ratio), file = sys.stderr)
+        if ratio > THRESHOLD:
+            regressions.append((name, ratio))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help = 'write the JSON here instead of stdout')
+    parser.add_argument('--compare', help = 'JSON of an earlier run to compare against')
+    parser.add_argument('--only', nargs = '+', help = 'names of the stages to time')
+    args = parser.parse_args()
+
+    run = runBenchmarks(args.only)
+    text = json.dumps(run, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(run, json.load(f))
+        for name, ratio in regressions:
+            print('regression: %s %.2fx slower than %s' % (name, ratio, args.compare),
+                  file = sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
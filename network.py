@@ -0,0 +1,135 @@
+import collections
+
+import numpy as np
+
+CHUNK = 32 # Most stacks forward passes at once, larger batches are split
+
+"""
+Shapes of the Q network weights, in the order Qflappybird creates them
+"""
+def getWeightShapes(actions = 2):
+    return collections.OrderedDict([
+        ('WCONV_1', (8, 8, 4, 32)), ('BCONV_1', (32,)),
+        ('WCONV_2', (4, 4, 32, 64)), ('BCONV_2', (64,)),
+        ('WCONV_3', (3, 3, 64, 64)), ('BCONV_3', (64,)),
+        ('WFCL_1', (1600, 512)), ('BFCL_1', (512,)),
+        ('WFCL_2', (512, actions)), ('BFCL_2', (actions,)),
+    ])
+
+"""
+Shapes of the MLP Qflappybird uses on stacks of history feature vectors
+"""
+def getFeatureWeightShapes(features, history = 4, hidden = 64, actions = 2):
+    return collections.OrderedDict([
+        ('WMLP_1', (features * history, hidden)), ('BMLP_1', (hidden,)),
+        ('WMLP_2', (hidden, hidden)), ('BMLP_2', (hidden,)),
+        ('WMLP_3', (hidden, actions)), ('BMLP_3', (actions,)),
+    ])
+
+"""
+Weights initialized like Qflappybird's weight_variable and bias_variable
+shapes defaults to the convolutional network's
+"""
+def initWeights(actions = 2, seed = None, shapes = None):
+    rng = np.random.RandomState(seed)
+    weights = collections.OrderedDict()
+    if shapes is None:
+        shapes = getWeightShapes(actions)
+    for name, shape in shapes.items():
+        if name.startswith('B'):
+            weights[name] = np.full(shape, 0.01, dtype = np.float32)
+        else:
+            # truncated normal, redraw values beyond two standard deviations
+            values = rng.normal(0, 0.01, size = shape)
+            outside = np.abs(values) > 0.02
+            while outside.any():
+                values[outside] = rng.normal(0, 0.01, size = outside.sum())
+                outside = np.abs(values) > 0.02
+            weights[name] = values.astype(np.float32)
+    return weights
+
+"""
+Save weights, a dict of arrays, to a compressed .npz file
+"""
+def saveWeights(path, weights):
+    np.savez_compressed(path, **dict((name, np.asarray(value, dtype = np.float32))
+                                     for name, value in weights.items()))
+
+"""
+Load weights saved with saveWeights, in creation order
+"""
+def loadWeights(path):
+    with np.load(path) as data:
+        if 'WMLP_1' in data:
+            # names don't depend on the sizes
+            return collections.OrderedDict((name, data[name])
+                                           for name in getFeatureWeightShapes(1))
+        actions = data['BFCL_2'].shape[0]
+        return collections.OrderedDict((name, data[name])
+                                       for name in getWeightShapes(actions))
+
+"""
+Pad the spatial axes of NHWC x the way TensorFlow's SAME padding does
+for a kernel of size and stride
+"""
+def padSame(x, size, stride):
+    pads = []
+    for length in x.shape[1:3]:
+        out = -(-length // stride)
+        total = max((out - 1) * stride + size - length, 0)
+        pads.append((total // 2, total - total // 2))
+    return np.pad(x, [(0, 0)] + pads + [(0, 0)])
+
+"""
+tf.nn.conv2d with SAME padding, as a matrix product over image patches
+"""
+def conv2d(x, weight, stride):
+    size = weight.shape[0]
+    x = padSame(x, size, stride)
+    windows = np.lib.stride_tricks.sliding_window_view(x, (size, size), axis = (1, 2))
+    windows = windows[:, ::stride, ::stride]
+    # patches ordered (height, width, channel) like the filter
+    n, height, width = windows.shape[:3]
+    patches = windows.transpose(0, 1, 2, 4, 5, 3).reshape(n * height * width, -1)
+    return patches.dot(weight.reshape(-1, weight.shape[3])).reshape(n, height, width, -1)
+
+"""
+tf.nn.max_pool with a 2x2 window and stride and SAME padding
+"""
+def maxPool2x2(x):
+    n, height, width, channels = x.shape
+    if height % 2 or width % 2:
+        x = np.pad(x, [(0, 0), (0, height % 2), (0, width % 2), (0, 0)],
+                   constant_values = -np.inf)
+    return x.reshape(n, x.shape[1] // 2, 2, x.shape[2] // 2, 2, channels).max(axis = (2, 4))
+
+"""
+Q values of a batch of (80, 80, 4) stacks, the readout layer of
+Qflappybird.createNetwork. Also returns the last hidden layer
+Large batches run in chunks, whose image patches stay in cache
+"""
+def forward(weights, stacks):
+    if 'WMLP_1' in weights:
+        return mlpForward(weights, stacks)
+    if len(stacks) > CHUNK:
+        outputs = [forward(weights, stacks[start:start + CHUNK])
+                   for start in range(0, len(stacks), CHUNK)]
+        return tuple(np.concatenate(parts) for parts in zip(*outputs))
+
+    x = np.asarray(stacks, dtype = np.float32)
+    x = np.maximum(conv2d(x, weights['WCONV_1'], 4) + weights['BCONV_1'], 0)
+    x = maxPool2x2(x)
+    x = np.maximum(conv2d(x, weights['WCONV_2'], 2) + weights['BCONV_2'], 0)
+    x = np.maximum(conv2d(x, weights['WCONV_3'], 1) + weights['BCONV_3'], 0)
+    hidden = np.maximum(x.reshape(len(x), -1).dot(weights['WFCL_1']) + weights['BFCL_1'], 0)
+    return hidden.dot(weights['WFCL_2']) + weights['BFCL_2'], hidden
+
+"""
+Q values and last hidden layer of the MLP on stacks of feature vectors,
+Qflappybird.mlpLayers
+"""
+def mlpForward(weights, stacks):
+    x = np.asarray(stacks, dtype = np.float32).reshape(len(stacks), -1)
+    x = np.maximum(x.dot(weights['WMLP_1']) + weights['BMLP_1'], 0)
+    hidden = np.maximum(x.dot(weights['WMLP_2']) + weights['BMLP_2'], 0)
+    return hidden.dot(weights['WMLP_3']) + weights['BMLP_3'], hidden
@@ -0,0 +1,328 @@
+"""
+Lookahead planner that plays flappy_new.GameState near perfectly, and writes
+the games it plays as demonstrations to fill a replay memory with
+Usage: python planner.py [--games N] [--output demonstrations.npz] [options]
+Prints planner decisions/s and the demonstration scores as JSON
+"""
+import argparse
+import json
+import multiprocessing
+import time
+
+import numpy as np
+
+import flappybird.flappy_new as game
+from flappybird import flappy_vector as physics
+from workers import mapWorkers
+
+DEPTH = 48 # Frames searched ahead of every decision, more than a pipe takes to pass
+GAMES = 25 # Demonstration games to play
+MAX_STEPS = 2000 # Frames a game is cut off at, the planner rarely crashes
+SEED = 0 # Game i draws its pipes from seed + i
+EPSILON = 0.0 # Share of random actions, for demonstrations that also show crashes
+OUTPUT = 'demonstrations.npz' # Written by main, read by loadDemonstrations
+YOFFSET = 128 # Lowest player y in the crash tables is -YOFFSET, flapping stops at -2 * height
+
+RECORD = dict((name, i) for i, name in enumerate(game.SNAPSHOT_FIELDS))
+
+
+class Planner:
+    """Picks flap or no flap for a game from its snapshot() record.
+
+    The pipes and the flapping animation don't depend on the player, so they
+    are stepped once per frame into a timeline holding, for every frame, which
+    player heights crash. Searching then only moves (y, velocity) through that
+    timeline with GameState's physics, in plain Python without pygame. The
+    search is depth-first, tries the action heading for the next gap first and
+    stops at the first line surviving depth frames. Results are cached on
+    (y, velocity, frame), the frame standing for the pipe offset, and the
+    cache carries over to the next decisions of the game."""
+
+    def __init__(self, depth = DEPTH, frameSkip = 1):
+        self.depth = depth
+        self.frameSkip = frameSkip
+        playerMasks = [physics.loadHitmask(path) for path in game.PLAYERS_LIST[0]]
+        pipeMask = physics.loadHitmask(game.PIPES_LIST[0])
+        self.playerWidth, self.playerHeight = playerMasks[0].shape
+        self.pipeWidth, self.pipeHeight = pipeMask.shape
+        # indexed [pipe, playerIndex, ox, oy], see VectorGameState.checkCrash
+        self.crashTable = np.array([
+            [physics.getCollisionTable(mask, pipeMask[::-1, ::-1]) for mask in playerMasks],
+            [physics.getCollisionTable(mask, pipeMask) for mask in playerMasks],
+        ])
+        self.groundY = game.BASEY - 1 - self.playerHeight
+        self.heights = np.arange(-YOFFSET, int(np.ceil(self.groundY)))
+        self.decisions = 0
+        self.seconds = 0.0
+        self.frame = None
+
+    def reset(self, record):
+        """starts a new timeline at the game state of record"""
+        values = record[:len(game.SNAPSHOT_FIELDS)].tolist()
+        pipes = int(values[RECORD['pipes']])
+        triples = record[len(game.SNAPSHOT_FIELDS):len(game.SNAPSHOT_FIELDS) + 3 * pipes]
+        self.pipes = [[x, int(upperY), int(lowerY)] for x, upperY, lowerY
+                      in zip(*[iter(triples.tolist())] * 3)]
+        self.playerIndex = int(values[RECORD['playerIndex']])
+        self.playerIndexStep = int(values[RECORD['playerIndexStep']])
+        self.loopIter = int(values[RECORD['loopIter']])
+        self.pipeSeed = int(values[RECORD['pipeSeed']])
+        self.pipesDrawn = int(values[RECORD['pipesDrawn']])
+        self.frame = 0
+        self.last = 0 # last frame in the timeline
+        self.keys = {0: self.getKey()}
+        self.crashes = {0: self.getCrashes()}
+        self.targets = {0: self.getTarget()}
+        self.cache = {}
+
+    def getKey(self):
+        """what a snapshot of the current timeline frame has to match"""
+        return (self.pipes[0][0], self.loopIter, self.pipesDrawn, self.pipeSeed)
+
+    def getRecordKey(self, record):
+        return (record[len(game.SNAPSHOT_FIELDS)], int(record[RECORD['loopIter']]),
+                int(record[RECORD['pipesDrawn']]), int(record[RECORD['pipeSeed']]))
+
+    def getCrashes(self):
+        """bytes, nonzero at y + YOFFSET for the heights crashing in this frame"""
+        crashed = np.zeros(len(self.heights), dtype = bool)
+        for x, upperY, lowerY in self.pipes:
+            # player offsets from the pipe, as VectorGameState.checkCrash
+            ox = physics.PLAYERX - int(x) + self.playerWidth - 1
+            if not 0 <= ox < self.crashTable.shape[2]:
+                continue
+            for pipe, pipeY in enumerate((upperY, lowerY)):
+                oy = self.heights - pipeY + self.playerHeight - 1
+                inside = (oy >= 0) & (oy < self.crashTable.shape[3])
+                crashed[inside] |= self.crashTable[pipe, self.playerIndex, ox, oy[inside]]
+        return crashed.tobytes()
+
+    def getTarget(self):
+        """player y centered in the gap of the next pipe"""
+        for x, upperY, lowerY in self.pipes:
+            if x + self.pipeWidth > physics.PLAYERX:
+                return (upperY + self.pipeHeight + lowerY - self.playerHeight) / 2.0
+        return self.pipes[-1][2] - physics.PIPEGAPSIZE / 2.0
+
+    def extend(self):
+        """steps the pipes and the animation one frame further, as
+        GameState.physics_step does"""
+        if (self.loopIter + 1) % 3 == 0:
+            self.playerIndex = game.PLAYERINDEXES[self.playerIndexStep]
+            self.playerIndexStep = (self.playerIndexStep + 1) % len(game.PLAYERINDEXES)
+        self.loopIter = (self.loopIter + 1) % 30
+
+        for pipe in self.pipes:
+            pipe[0] += physics.PIPEVELX
+        if 0 < self.pipes[0][0] < 5:
+            gapY = game.mix64(self.pipeSeed, self.pipesDrawn) \
+                % int(game.BASEY * 0.6 - game.PIPEGAPSIZE) + int(game.BASEY * 0.2)
+            self.pipesDrawn += 1
+            self.pipes.append([game.SCREENWIDTH + 10, gapY - self.pipeHeight,
+                               gapY + game.PIPEGAPSIZE])
+        if self.pipes[0][0] < -self.pipeWidth:
+            self.pipes.pop(0)
+
+        self.last += 1
+        self.keys[self.last] = self.getKey()
+        self.crashes[self.last] = self.getCrashes()
+        self.targets[self.last] = self.getTarget()
+
+    def move(self, y, velY, t, flap, frames):
+        """runs frames frames of player physics from frame t
+        Returns y, velocity and the frames survived"""
+        for i in range(frames):
+            if flap and y > -2 * self.playerHeight:
+                velY = physics.PLAYERFLAPACC
+            elif velY < physics.PLAYERMAXVELY:
+                velY += physics.PLAYERACCY
+            y += velY
+            t += 1
+            if t > self.last:
+                self.extend()
+            if y >= self.groundY or self.crashes[t][y + YOFFSET]:
+                return y, velY, i
+        return y, velY, frames
+
+    def getOrder(self, y, t):
+        """actions to search, the one heading for the gap first"""
+        return (1, 0) if y > self.targets[t] else (0, 1)
+
+    def survive(self, y, velY, t, depth):
+        """frames the player can survive from (y, velY) at frame t, at most depth"""
+        if depth <= 0:
+            return 0
+        key = (y, velY, t)
+        cached = self.cache.get(key)
+        # a line that crashed is exact, one that survived holds up to its depth
+        if cached is not None and (cached[0] < cached[1] or depth <= cached[1]):
+            return min(cached[0], depth)
+        best = 0
+        frames = min(self.frameSkip, depth)
+        for flap in self.getOrder(y, t):
+            nextY, nextVelY, survived = self.move(y, velY, t, flap, frames)
+            if survived == frames:
+                survived += self.survive(nextY, nextVelY, t + frames, depth - frames)
+            if survived > best:
+                best = survived
+                if best == depth:
+                    break
+        self.cache[key] = (best, depth)
+        return best
+
+    def act(self, record):
+        """returns 1 to flap in the game state of record, else 0. Records
+        are expected a frameSkip apart, any other record starts over"""
+        start = time.time()
+        if self.frame is not None:
+            self.frame += self.frameSkip
+        if self.frame is None or self.frame > self.last \
+                or self.keys[self.frame] != self.getRecordKey(record):
+            self.reset(record)
+        # frames behind the decision are never searched again
+        for t in [t for t in self.keys if t < self.frame]:
+            del self.keys[t], self.crashes[t], self.targets[t]
+        if len(self.cache) > 64 * self.depth * 1024:
+            self.cache = {}
+
+        y = int(record[RECORD['playery']])
+        velY = int(record[RECORD['playerVelY']])
+        best, bestFlap = -1, 0
+        for flap in self.getOrder(y, self.frame):
+            nextY, nextVelY, survived = self.move(y, velY, self.frame, flap, self.frameSkip)
+            if survived == self.frameSkip:
+                survived += self.survive(nextY, nextVelY, self.frame + self.frameSkip,
+                                         self.depth - self.frameSkip)
+            if survived > best:
+                best, bestFlap = survived, flap
+                if best >= self.depth:
+                    break
+        self.decisions += 1
+        self.seconds += time.time() - start
+        return bestFlap
+
+"""
+Play one game with planner from seed, taking a random action with
+probability epsilon. Returns the game's slots as ReplayMemory stores them,
+the first one a start, and the score
+"""
+def playDemonstration(game_state, planner, seed, max_steps = MAX_STEPS, epsilon = EPSILON):
+    random = np.random.RandomState(seed)
+    game_state.seed(seed)
+    game_state.reInit()
+    image_data, reward, terminal = game_state.frame_step([1, 0])
+    frames, actions, rewards, terminals = [image_data], [0], [0], [False]
+    score = 0
+    for step in range(max_steps):
+        flap = planner.act(game_state.snapshot())
+        if random.rand() < epsilon:
+            flap = random.randint(2)
+        image_data, reward, terminal = game_state.frame_step([1 - flap, flap])
+        frames.append(image_data)
+        actions.append(flap)
+        rewards.append(reward)
+        terminals.append(terminal)
+        if terminal:
+            break
+        score += reward > 0
+    starts = np.zeros(len(frames), dtype = bool)
+    starts[0] = True
+    return {
+        'frames': np.array(frames),
+        'actions': np.array(actions, dtype = np.int8),
+        'rewards': np.array(rewards, dtype = np.float32),
+        'terminals': np.array(terminals),
+        'starts': starts,
+    }, int(score)
+
+def createGame(observation = 'raster', frameSkip = 1):
+    return game.GameState(headless = True, observation = observation, frameSkip = frameSkip)
+
+def startGames(observation, frameSkip, depth):
+    return createGame(observation, frameSkip), Planner(depth, frameSkip)
+
+def runGame(worker, task):
+    game_state, planner = worker
+    seed, max_steps, epsilon = task
+    planner.decisions, planner.seconds = 0, 0.0
+    slots, score = playDemonstration(game_state, planner, seed, max_steps, epsilon)
+    return slots, score, planner.decisions, planner.seconds
+
+"""
+Play demonstration games with seeds, on workers forked processes when there
+are more than one. Returns (slots, score, decisions, planner seconds) for
+every seed, in order
+"""
+def playDemonstrations(seeds, max_steps = MAX_STEPS, epsilon = EPSILON, workers = 1,
+                       observation = 'raster', frameSkip = 1, depth = DEPTH):
+    return mapWorkers(runGame, [(seed, max_steps, epsilon) for seed in seeds], startGames,
+                      (observation, frameSkip, depth), workers)
+
+"""
+Write the slots of games to path, one array per ReplayMemory field
+"""
+def saveDemonstrations(path, games, scores):
+    arrays = dict((name, np.concatenate([slots[name] for slots in games]))
+                  for name in games[0])
+    np.savez_compressed(path, scores = np.array(scores), **arrays)
+
+"""
+Write the demonstrations in path to memory, as if they were played into it
+Returns the number of slots written
+"""
+def loadDemonstrations(memory, path):
+    with np.load(path) as demonstrations:
+        frames = demonstrations['frames']
+        if frames.shape[1:] != tuple(memory.frameShape):
+            raise ValueError('%s holds %s frames, the replay memory %s' % (
+                path, frames.shape[1:], tuple(memory.frameShape)))
+        fields = zip(frames, demonstrations['actions'], demonstrations['rewards'],
+                     demonstrations['terminals'], demonstrations['starts'])
+        for frame, action, reward, terminal, start in fields:
+            memory.write(frame, action, reward, terminal, start)
+        return len(frames)
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().split('\n')[0])
+    parser.add_argument('--games', type = int, default = GAMES)
+    parser.add_argument('--max-steps', type = int, default = MAX_STEPS)
+    parser.add_argument('--seed', type = int, default = SEED)
+    parser.add_argument('--depth', type = int, default = DEPTH)
+    parser.add_argument('--epsilon', type = float, default = EPSILON)
+    parser.add_argument('--frame-skip', type = int, default = 1)
+    parser.add_argument('--features', action = 'store_true',
+                        help = 'record game state features instead of frames')
+    parser.add_argument('--workers', type = int, default = multiprocessing.cpu_count())
+    parser.add_argument('--output', default = OUTPUT,
+                        help = 'demonstrations .npz, "none" only reports')
+    args = parser.parse_args()
+
+    seeds = range(args.seed, args.seed + args.games)
+    start = time.time()
+    results = playDemonstrations(seeds, args.max_steps, args.epsilon, args.workers,
+                                 'features' if args.features else 'raster',
+                                 args.frame_skip, args.depth)
+    seconds = time.time() - start
+    games = [slots for slots, score, decisions, plannerSeconds in results]
+    scores = np.array([score for slots, score, decisions, plannerSeconds in results])
+    decisions = sum(result[2] for result in results)
+    plannerSeconds = sum(result[3] for result in results)
+    steps = sum(len(slots['actions']) - 1 for slots in games)
+    if args.output != 'none':
+        saveDemonstrations(args.output, games, scores)
+
+    print(json.dumps({
+        'games': len(games),
+        'score mean': float(scores.mean()),
+        'score min': int(scores.min()),
+        'score max': int(scores.max()),
+        'crashed': int(sum(slots['terminals'].any() for slots in games)),
+        'steps': steps,
+        'decisions/s': decisions / plannerSeconds,
+        'steps/s': steps / seconds,
+        'depth': args.depth,
+        'output': args.output,
+    }, indent = 2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Post-training int8 quantization of the exported Q network, and a report of
+its argmax agreement, game score and latency against network.forward
+Usage: python quantize.py [weights.npz]
+"""
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import evaluate
+import flappybird.flappy_new as game
+import network
+
+WEIGHTS = 'saved_networks/flappybird-dqn.npz' # Written by export.py
+CALIBRATION_FRAMES = 2000 # Stacks activation ranges are measured on
+TEST_FRAMES = 2000 # Stacks argmax agreement is measured on
+EPISODES = 10 # Games played by each network for the score comparison
+QMAX = 127 # Largest int8 magnitude used, symmetric around 0
+
+
+"""
+Quantize weight to int8 with one scale per output channel, its last axis
+Returns the int8 weight and the scales
+"""
+def quantizeWeight(weight):
+    channels = weight.reshape(-1, weight.shape[-1])
+    scales = np.abs(channels).max(axis = 0) / QMAX
+    scales[scales == 0] = 1
+    return np.clip(np.round(weight / scales), -QMAX, QMAX).astype(np.int8), \
+        scales.astype(np.float32)
+
+"""
+Quantize nonnegative activations x at scale to int8 values, kept in a
+float32 array for the matrix products
+"""
+def quantizeActivation(x, scale):
+    return np.clip(np.round(x / scale), 0, QMAX).astype(np.float32)
+
+
+class QuantizedNetwork:
+    """int8 version of network.forward.
+
+    Weights are int8 with per output channel scales. Stacks are uint8
+    already and go into the first layer as they are, the input of every
+    other layer is int8 at a per layer scale calibrated on sample stacks.
+    NumPy has no fast int8 matrix product, so the integer weights are
+    widened to float32 once and the integer products accumulate by float32 GEMM, which
+    gives the same results as an int32 accumulator up to float rounding in
+    the 1600 wide layer. Between layers the accumulator is rescaled to the
+    next layer's int8 input in one multiply and add, with the scales and
+    bias folded in. nbytes counts the int8 weights, what there is to store,
+    the widened products take as much memory as the float32 weights."""
+
+    LAYERS = ('CONV_1', 'CONV_2', 'CONV_3', 'FCL_1', 'FCL_2')
+
+    def __init__(self, weights, calibration):
+        self.biases = dict((layer, weights['B' + layer]) for layer in self.LAYERS)
+        self.weights, self.scales = {}, {}
+        for layer in self.LAYERS:
+            self.weights[layer], self.scales[layer] = quantizeWeight(weights['W' + layer])
+        self.products = dict((layer, weight.astype(np.float32))
+                             for layer, weight in self.weights.items())
+
+        # uint8 stacks times int8 weights stay exact in float32 accumulators
+        self.inputScales = {'CONV_1': 1.0}
+        inputs = self.getLayerInputs(weights, calibration)
+        for layer in self.LAYERS[1:]:
+            self.inputScales[layer] = max(float(inputs[layer]), 1e-6) / QMAX
+
+        # accumulator to real output and to the next layer's int8 input
+        self.outputScales, self.requantizers = {}, {}
+        for layer, nextLayer in zip(self.LAYERS, self.LAYERS[1:] + (None,)):
+            scale = (self.inputScales[layer] * self.scales[layer]).astype(np.float32)
+            self.outputScales[layer] = scale
+            if nextLayer is not None:
+                self.requantizers[layer] = (scale / self.inputScales[nextLayer],
+                                            self.biases[layer] / self.inputScales[nextLayer])
+
+    @property
+    def nbytes(self):
+        """bytes of the int8 weights, their scales and the biases"""
+        return sum(weight.nbytes for weight in self.weights.values()) \
+            + sum(scale.nbytes for scale in self.scales.values()) \
+            + sum(bias.nbytes for bias in self.biases.values())
+
+    def getLayerInputs(self, weights, stacks):
+        """largest input of each layer for the float network on stacks"""
+        largest = dict((layer, 0.0) for layer in self.LAYERS)
+        for start in range(0, len(stacks), network.CHUNK):
+            x = np.asarray(stacks[start:start + network.CHUNK], dtype = np.float32)
+            x = np.maximum(network.conv2d(x, weights['WCONV_1'], 4) + weights['BCONV_1'], 0)
+            x = network.maxPool2x2(x)
+            largest['CONV_2'] = max(largest['CONV_2'], x.max())
+            x = np.maximum(network.conv2d(x, weights['WCONV_2'], 2) + weights['BCONV_2'], 0)
+            largest['CONV_3'] = max(largest['CONV_3'], x.max())
+            x = np.maximum(network.conv2d(x, weights['WCONV_3'], 1) + weights['BCONV_3'], 0)
+            largest['FCL_1'] = max(largest['FCL_1'], x.max())
+            x = np.maximum(x.reshape(len(x), -1).dot(weights['WFCL_1']) + weights['BFCL_1'], 0)
+            largest['FCL_2'] = max(largest['FCL_2'], x.max())
+        return largest
+
+    def dequantize(self, accumulator, layer):
+        """real layer output from its integer accumulator"""
+        return accumulator * self.outputScales[layer] + self.biases[layer]
+
+    def requantize(self, accumulator, layer):
+        """int8 input of the next layer, through the ReLU of layer, computed
+        in place in its accumulator"""
+        scale, bias = self.requantizers[layer]
+        accumulator *= scale
+        accumulator += bias
+        np.rint(accumulator, out = accumulator)
+        return np.clip(accumulator, 0, QMAX, out = accumulator)
+
+    def forward(self, stacks):
+        """Q values and last hidden layer, as network.forward"""
+        if len(stacks) > network.CHUNK:
+            outputs = [self.forward(stacks[start:start + network.CHUNK])
+                       for start in range(0, len(stacks), network.CHUNK)]
+            return tuple(np.concatenate(parts) for parts in zip(*outputs))
+
+        x = network.conv2d(np.asarray(stacks, dtype = np.float32), self.products['CONV_1'], 4)
+        # requantizing is increasing in every channel, so it commutes with
+        # max pooling, which shrinks the accumulator to rescale by 4 first
+        x = self.requantize(network.maxPool2x2(x), 'CONV_1')
+        x = self.requantize(network.conv2d(x, self.products['CONV_2'], 2), 'CONV_2')
+        x = self.requantize(network.conv2d(x, self.products['CONV_3'], 1), 'CONV_3')
+        x = x.reshape(len(x), -1).dot(self.products['FCL_1'])
+        hidden = np.maximum(self.dequantize(x, 'FCL_1'), 0)
+        x = quantizeActivation(hidden, self.inputScales['FCL_2'])
+        return self.dequantize(x.dot(self.products['FCL_2']), 'FCL_2'), hidden
+
+
+"""
+Stacks from games played with forward, taking a random action instead one
+time in ten so frames cover more than one policy's states
+"""
+def getStacks(forward, count, seed = 0):
+    rng = random.Random(seed)
+    game_state = game.GameState(headless = True, observation = 'raster', seed = seed)
+    image_data, reward, terminal = game_state.frame_step([1, 0])
+    stack = np.stack((image_data,) * 4, axis = 2)
+    stacks = np.empty((count, 80, 80, 4), dtype = np.uint8)
+    for i in range(count):
+        action = np.zeros(2)
+        if rng.random() < 0.1:
+            action[rng.randrange(2)] = 1
+        else:
+            action[np.argmax(forward(stack[None])[0][0])] = 1
+        image_data, reward, terminal = game_state.frame_step(action)
+        if terminal:
+            stack = np.stack((image_data,) * 4, axis = 2)
+        else:
+            stack = np.append(image_data[:, :, None], stack[:, :, :3], axis = 2)
+        stacks[i] = stack
+    return stacks
+
+"""
+Seconds per forward call on batches of batch_size stacks
+"""
+def timeForward(forward, stacks, batch_size, calls = 20):
+    batch = stacks[:batch_size]
+    forward(batch)
+    start = time.time()
+    for i in range(calls):
+        forward(batch)
+    return (time.time() - start) / calls
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else WEIGHTS
+    if not os.path.exists(path):
+        sys.exit('%s not found, export a checkpoint with export.py first' % path)
+    weights = network.loadWeights(path)
+    floatForward = lambda stacks: network.forward(weights, stacks)
+
+    calibration = getStacks(floatForward, CALIBRATION_FRAMES, seed = 1)
+    quantized = QuantizedNetwork(weights, calibration)
+    test = getStacks(floatForward, TEST_FRAMES, seed = 2)
+
+    floatReadout = floatForward(test)[0]
+    quantizedReadout = quantized.forward(test)[0]
+    agreement = np.mean(floatReadout.argmax(axis = 1) == quantizedReadout.argmax(axis = 1))
+    error = np.abs(floatReadout - quantizedReadout).max() / np.abs(floatReadout).max()
+    floatBytes = sum(weight.nbytes for weight in weights.values())
+    print('weights float32 %.2f MB, int8 %.2f MB' % (floatBytes / 1e6, quantized.nbytes / 1e6))
+    print('argmax agreement %.4f, largest Q error %.2e of the Q range' % (agreement, error))
+
+    for name, forward in (('float32', floatForward), ('int8', quantized.forward)):
+        scores = [score for score, frames in evaluate.playEpisodes(forward, range(EPISODES))]
+        latencies = ['batch %d %.2f ms' % (batch_size, timeForward(forward, test, batch_size) * 1e3)
+                     for batch_size in (1, 256)]
+        print('%-7s mean score %.1f over %d games (cap %d frames), %s' % (
+            name, np.mean(scores), EPISODES, evaluate.MAX_STEPS, ', '.join(latencies)))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,569 @@
+import json
+import os
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+
+"""
+Allocate a zeroed array, memory-mapped from directory/name.npy if a directory
+is given. An existing file of the same shape and type is reopened as it is
+"""
+def allocate(shape, dtype, directory = None, name = None):
+    if directory is None:
+        return np.zeros(shape, dtype = dtype)
+    path = os.path.join(directory, name + '.npy')
+    if os.path.exists(path):
+        array = np.lib.format.open_memmap(path, mode = 'r+')
+        if array.shape == shape and array.dtype == dtype:
+            return array
+        del array
+    return np.lib.format.open_memmap(path, mode = 'w+', dtype = dtype, shape = shape)
+
+"""
+Importance-sampling weights (N * P(i)) ** -beta of samples drawn with
+probabilities from N transitions, normalized by their maximum
+"""
+def importanceWeights(probabilities, count, beta):
+    weights = (count * probabilities) ** -beta
+    return (weights / weights.max()).astype(np.float32)
+
+
+class FrameStore:
+    """Frames kept as they are, one array of dtype per slot"""
+
+    def __init__(self, capacity, frameShape, directory = None, dtype = np.uint8):
+        self.frameShape = frameShape
+        self.frames = allocate((capacity,) + frameShape, dtype, directory, 'frames')
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def __setitem__(self, slot, frame):
+        self.frames[slot] = frame
+
+    def gather(self, indices):
+        """returns the frames in indices, shaped indices.shape + frameShape"""
+        return self.frames[indices]
+
+
+class PackedFrameStore(FrameStore):
+    """Binary frames packed to one bit per pixel, 800 bytes per 80x80 frame.
+
+    Any nonzero pixel reads back as 255, so 0/255 frames round-trip exactly."""
+
+    def __init__(self, capacity, frameShape, directory = None):
+        self.frameShape = frameShape
+        self.size = int(np.prod(frameShape))
+        self.frames = allocate((capacity, (self.size + 7) // 8), np.uint8, directory,
+                               'packed_frames')
+
+    def __setitem__(self, slot, frame):
+        self.frames[slot] = np.packbits(np.ravel(frame) > 0)
+
+    def gather(self, indices):
+        """returns the frames in indices unpacked to 0/255"""
+        bits = np.unpackbits(self.frames[indices], axis = -1, count = self.size)
+        bits *= 255
+        return bits.reshape(np.shape(indices) + self.frameShape)
+
+
+class ReplayMemory:
+    """Replay memory storing every observed frame once.
+
+    Frame stacks are rebuilt from frame indices when sampling. Given a
+    directory the arrays are memory-mapped files there, and a memory saved
+    with save() is picked up again by the next ReplayMemory on it."""
+
+    def __init__(self, capacity, history = 4, frameShape = (80, 80), actions = 2,
+                 packed = False, directory = None, dtype = np.uint8):
+        self.capacity = capacity
+        self.history = history
+        self.frameShape = frameShape
+        self.actionCount = actions
+        self.packed = packed
+        self.directory = directory
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Slot i holds the frame observed after taking actions[i]
+        if packed:
+            self.frames = PackedFrameStore(capacity, frameShape, directory)
+        else:
+            self.frames = FrameStore(capacity, frameShape, directory, dtype)
+        self.actions = allocate((capacity,), np.int8, directory, 'actions')
+        self.rewards = allocate((capacity,), np.float32, directory, 'rewards')
+        self.terminals = allocate((capacity,), bool, directory, 'terminals')
+        # Slot holds the first frame of a game, no transition ends in it
+        self.starts = allocate((capacity,), bool, directory, 'starts')
+
+        # Next slot to write and number of slots written, in an array so
+        # processes sharing the memory-mapped files also share the position
+        self.position = allocate((2,), np.int64, directory, 'position')
+        if directory is not None:
+            self.load()
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def head(self):
+        return int(self.position[0])
+
+    @head.setter
+    def head(self, value):
+        self.position[0] = value
+
+    @property
+    def count(self):
+        return int(self.position[1])
+
+    @count.setter
+    def count(self, value):
+        self.position[1] = value
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes + self.actions.nbytes + self.rewards.nbytes \
+            + self.terminals.nbytes + self.starts.nbytes
+
+    def getLayout(self):
+        return {'capacity': self.capacity, 'frameShape': list(self.frameShape),
+                'packed': self.packed}
+
+    def load(self):
+        """restores head and count saved in directory for the same layout,
+        otherwise the memory starts empty. Frames are written to the files
+        on every step, but head and count only by save(), so slots from the
+        saved head up to the head a crash left in the position file hold
+        newer transitions than their neighbours. They are marked as game
+        starts, which are never sampled and end frame stacks, so no
+        transition spans either edge of them"""
+        writtenHead, writtenCount = self.head, self.count
+        self.head = self.count = 0
+        path = os.path.join(self.directory, 'memory.json')
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            state = json.load(f)
+        if state['layout'] == self.getLayout():
+            self.head = state['head']
+            self.count = state['count']
+            # a position file older than memory.json tells nothing
+            unsaved = (writtenHead - self.head) % self.capacity \
+                if writtenCount >= self.count else 0
+            self.starts[(self.head + np.arange(unsaved + 1)) % self.capacity] = True
+
+    def getPosition(self):
+        """(head, count) for save() to record from another thread"""
+        return self.head, self.count
+
+    def save(self, position = None):
+        """makes the memory-mapped arrays and the write position durable.
+        Flushing only writes back the pages dirtied since the last save.
+        Given a position taken by getPosition() earlier, that one is saved,
+        so this can run on another thread while frames are still written:
+        every slot up to it is flushed and later ones are dropped by load()"""
+        if self.directory is None:
+            return
+        head, count = self.getPosition() if position is None else position
+        for array in (self.frames.frames, self.actions, self.rewards,
+                      self.terminals, self.starts, self.position):
+            array.flush()
+        path = os.path.join(self.directory, 'memory.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'layout': self.getLayout(), 'head': head, 'count': count}, f)
+        os.replace(path + '.tmp', path)
+
+    def start(self, frame):
+        """Store the first frame of a game"""
+        self.write(frame, 0, 0, False, True)
+
+    def append(self, frame, action, reward, terminal):
+        """Store the frame observed after taking action. A terminal frame
+        is already the first frame of the next game"""
+        self.write(frame, action, reward, terminal, False)
+
+    def write(self, frame, action, reward, terminal, start):
+        slot = self.head
+        self.frames[slot] = frame
+        self.actions[slot] = action
+        self.rewards[slot] = reward
+        self.terminals[slot] = terminal
+        self.starts[slot] = start
+        self.head = (slot + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def stackIndices(self, slots):
+        """Frame indices of the stacks ending in slots, newest frame first.
+        Frames from before the start of a game repeat its first frame"""
+        indices = np.empty((len(slots), self.history), dtype = np.int64)
+        indices[:, 0] = slots
+        for i in range(1, self.history):
+            previous = indices[:, i - 1]
+            first = self.starts[previous] | self.terminals[previous]
+            indices[:, i] = np.where(first, previous, (previous - 1) % self.capacity)
+        return indices
+
+    def getStacks(self, slots):
+        """Frame stacks ending in slots as a (len(slots), 80, 80, history) array"""
+        indices = self.stackIndices(slots)
+        # cv2.merge interleaves the history frames several times faster than
+        # NumPy's strided channel writes or a transposing copy
+        channels = [self.frames.gather(indices[:, i]).reshape(-1, self.frameShape[-1])
+                    for i in range(self.history)]
+        stacks = cv2.merge(channels)
+        return stacks.reshape((len(slots),) + self.frameShape + (self.history,))
+
+    def sampleSlots(self, batchSize):
+        """Pick batchSize slots that end a transition with a full history before it"""
+        # Slots are valid up to the ones whose history reaches the write head
+        valid = self.count - self.history - 1
+        if valid <= 0:
+            raise ValueError('Not enough frames in replay memory to sample')
+
+        slots = np.empty(0, dtype = np.int64)
+        while len(slots) < batchSize:
+            ages = np.random.randint(0, valid, size = batchSize)
+            candidates = (self.head - 1 - ages) % self.capacity
+            slots = np.concatenate((slots, candidates[~self.starts[candidates]]))
+        return slots[:batchSize]
+
+    def sample(self, batchSize):
+        """Sample a minibatch of transitions. Returns states, one-hot
+        actions, rewards, next states and terminals"""
+        slots = self.sampleSlots(batchSize)
+        return self.getBatch(slots)
+
+    def getBatch(self, slots):
+        """Transitions ending in slots, see sample"""
+        previous = (slots - 1) % self.capacity
+        actions = np.zeros((len(slots), self.actionCount), dtype = np.float32)
+        actions[np.arange(len(slots)), self.actions[slots]] = 1
+        return (self.getStacks(previous), actions, self.rewards[slots],
+                self.getStacks(slots), self.terminals[slots])
+
+    def getMass(self):
+        """total sampling weight, here the number of slots sampleSlots picks from"""
+        return max(self.count - self.history - 1, 0)
+
+    def getProbabilities(self, slots):
+        """probability of sampleSlots picking each of slots"""
+        return np.full(len(slots), 1.0 / self.getMass())
+
+    def sampleWeighted(self, batchSize, beta = 1.0):
+        """sample with importance-sampling weights and the ids of the sampled
+        transitions for updatePriorities, all weights are 1 for uniform sampling"""
+        slots = self.sampleSlots(batchSize)
+        weights = importanceWeights(self.getProbabilities(slots), self.count, beta)
+        return self.getBatch(slots) + (weights, self.getSampleIds(slots))
+
+    def getSampleIds(self, slots):
+        """ids of the transitions in slots, here the slots themselves"""
+        return slots
+
+    def updatePriorities(self, ids, errors):
+        """uniform sampling ignores priorities"""
+        pass
+
+
+class SumTree:
+    """Binary tree over a flat array whose nodes hold the sum of their
+    children. Leaves are priorities, so sampling proportionally to them and
+    updating one are both O(log n)."""
+
+    def __init__(self, capacity):
+        self.size = 1 << max(capacity - 1, 1).bit_length()
+        self.tree = np.zeros(2 * self.size, dtype = np.float64)
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.size]
+
+    def set(self, index, value):
+        """sets one leaf, plain Python is faster than NumPy for a single path"""
+        tree = self.tree
+        node = index + self.size
+        tree[node] = value
+        node //= 2
+        while node:
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+            node //= 2
+
+    def update(self, indices, values):
+        """sets many leaves and recomputes every parent once"""
+        nodes = np.asarray(indices) + self.size
+        if not len(nodes):
+            return
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while nodes[0] > 0:
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def find(self, values):
+        """returns the leaves whose prefix sum range holds each value"""
+        nodes = np.ones(len(values), dtype = np.int64)
+        values = np.array(values, dtype = np.float64)
+        while nodes[0] < self.size:
+            left = self.tree[2 * nodes]
+            right = values >= left
+            values -= np.where(right, left, 0)
+            nodes = 2 * nodes + right
+        return nodes - self.size
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """Replay memory sampling transitions in proportion to their TD error
+    raised to alpha, see Schaul et al., Prioritized Experience Replay.
+
+    New transitions get the highest priority seen so far. Priorities live in
+    RAM, a reopened memory-mapped memory starts them all equal. Every slot
+    counts the times it was written, sample ids carry that generation so
+    TD errors of a transition written over since it was sampled are
+    dropped."""
+
+    def __init__(self, capacity, alpha = 0.6, epsilon = 1e-6, **kwargs):
+        ReplayMemory.__init__(self, capacity, **kwargs)
+        self.alpha = alpha
+        self.epsilon = epsilon
+        self.maxPriority = 1.0
+        self.priorities = SumTree(capacity)
+        self.generations = np.zeros(capacity, dtype = np.int64)
+
+        if self.count:
+            ages = np.arange(self.count - self.history - 1)
+            slots = (self.head - 1 - ages) % self.capacity
+            slots = slots[~self.starts[slots]]
+            if len(slots):
+                self.priorities.update(slots, self.maxPriority)
+
+    def write(self, frame, action, reward, terminal, start):
+        slot = self.head
+        ReplayMemory.write(self, frame, action, reward, terminal, start)
+        self.generations[slot] += 1
+        # Same validity as sampleSlots, the newest slot can be sampled once
+        # enough history is stored and the oldest ones can't
+        if start or self.count <= self.history + 1:
+            self.priorities.set(slot, 0)
+        else:
+            self.priorities.set(slot, self.maxPriority)
+        if self.count == self.capacity:
+            self.priorities.set((slot + self.history + 1) % self.capacity, 0)
+
+    def sampleSlots(self, batchSize):
+        """Pick batchSize slots in proportion to their priority, one from
+        each of batchSize equal segments of the total"""
+        total = self.priorities.total
+        if total <= 0:
+            raise ValueError('Not enough frames in replay memory to sample')
+
+        values = (np.arange(batchSize) + np.random.rand(batchSize)) * (total / batchSize)
+        slots = self.priorities.find(np.minimum(values, np.nextafter(total, 0)))
+        # Rounding can land on an empty leaf next to the end of the total
+        empty = self.priorities[slots] <= 0
+        while empty.any():
+            slots[empty] = self.priorities.find(np.random.rand(empty.sum()) * total)
+            empty = self.priorities[slots] <= 0
+        return slots
+
+    def getMass(self):
+        return self.priorities.total
+
+    def getProbabilities(self, slots):
+        return self.priorities[slots] / self.priorities.total
+
+    def getSampleIds(self, slots):
+        """ids of the transitions in slots, their generation and slot"""
+        return self.generations[slots] * self.capacity + slots
+
+    def updatePriorities(self, ids, errors):
+        """sets priorities of sampled transitions from their TD errors. Ids
+        whose slot was written again since they were sampled are dropped,
+        slots that can't be sampled any more stay at 0"""
+        priorities = (np.abs(errors) + self.epsilon) ** self.alpha
+        self.maxPriority = max(self.maxPriority, float(priorities.max()))
+        slots = ids % self.capacity
+        valid = (self.getSampleIds(slots) == ids) & (self.priorities[slots] > 0)
+        self.priorities.update(slots[valid], priorities[valid])
+
+
+class ShardedReplayMemory:
+    """Replay memory shared by several writers, for example actor threads.
+
+    Each writer appends to its own shard, a memory of capacity / shards
+    slots, so its frames stay in order for stack rebuilding. Shards are
+    locked one at a time, a writer only waits while its own shard is being
+    sampled. Sample ids handed out by sampleWeighted are the shard's
+    id * shards + shard.
+
+    Writers in forked processes share a memory given a directory, ideally
+    in /dev/shm, and multiprocessing locks. Priorities are kept in process
+    memory, so prioritized shards can only be written by threads."""
+
+    def __init__(self, shards, capacity, memoryClass = ReplayMemory, directory = None,
+                 lock = threading.Lock, **kwargs):
+        self.shardCapacity = capacity // shards
+        self.shards = []
+        for i in range(shards):
+            shardDirectory = None
+            if directory is not None:
+                shardDirectory = os.path.join(directory, 'shard%d' % i)
+            self.shards.append(memoryClass(self.shardCapacity, directory = shardDirectory,
+                                           **kwargs))
+        self.locks = [lock() for shard in self.shards]
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    @property
+    def nbytes(self):
+        return sum(shard.nbytes for shard in self.shards)
+
+    def getPosition(self):
+        positions = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                positions.append(shard.getPosition())
+        return positions
+
+    def save(self, position = None):
+        """saves every shard, at the positions of getPosition() if given
+        without holding up their writers"""
+        if position is not None:
+            for shard, shardPosition in zip(self.shards, position):
+                shard.save(shardPosition)
+            return
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.save()
+
+    def start(self, shard, frame):
+        """Store the first frame of a game in shard"""
+        with self.locks[shard]:
+            self.shards[shard].start(frame)
+
+    def append(self, shard, frame, action, reward, terminal):
+        """Store the frame observed after taking action in shard"""
+        with self.locks[shard]:
+            self.shards[shard].append(frame, action, reward, terminal)
+
+    def getMass(self):
+        return sum(shard.getMass() for shard in self.shards)
+
+    def sampleWeighted(self, batchSize, beta = 1.0):
+        """sample across shards in proportion to their mass, so a transition
+        is as likely as in one memory holding all of them"""
+        masses = np.array([shard.getMass() for shard in self.shards], dtype = np.float64)
+        if masses.sum() <= 0:
+            raise ValueError('Not enough frames in replay memory to sample')
+        masses /= masses.sum()
+        counts = np.random.multinomial(batchSize, masses)
+
+        batches, probabilities, ids = [], [], []
+        for i, count in enumerate(counts):
+            if count == 0:
+                continue
+            shard = self.shards[i]
+            with self.locks[i]:
+                shardSlots = shard.sampleSlots(count)
+                probabilities.append(shard.getProbabilities(shardSlots) * masses[i])
+                batches.append(shard.getBatch(shardSlots))
+                ids.append(shard.getSampleIds(shardSlots) * len(self.shards) + i)
+
+        batch = tuple(np.concatenate(arrays) for arrays in zip(*batches))
+        weights = importanceWeights(np.concatenate(probabilities), len(self), beta)
+        return batch + (weights, np.concatenate(ids))
+
+    def updatePriorities(self, ids, errors):
+        shards = ids % len(self.shards)
+        for i in np.unique(shards):
+            chosen = shards == i
+            with self.locks[i]:
+                self.shards[i].updatePriorities(ids[chosen] // len(self.shards),
+                                                errors[chosen])
+
+
+class BatchPrefetcher:
+    """Samples minibatches from a memory on a background thread.
+
+    Up to depth batches wait in a queue with their states already converted
+    to contiguous float32, so the learner only pays for get(). Priorities
+    updated meanwhile only apply from the next batch sampled. lock, if
+    given, is held while sampling a memory other threads write without
+    locking it themselves. getBeta() returns the importance sampling
+    exponent for the next batch. An exception raised while sampling stops
+    the thread and is raised by get() once the batches before it are taken."""
+
+    def __init__(self, memory, batchSize, getBeta = None, depth = 2, lock = None):
+        self.memory = memory
+        self.batchSize = batchSize
+        self.getBeta = getBeta or (lambda: 1.0)
+        self.lock = lock
+        self.batches = queue.Queue(depth)
+        self.stop = threading.Event()
+        self.thread = None
+        self.error = None # raised by sampling, re-raised by get()
+        self.waitTime = 0.0 # seconds get() spent waiting for a batch
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+    def sample(self):
+        if self.lock is None:
+            return self.memory.sampleWeighted(self.batchSize, self.getBeta())
+        with self.lock:
+            return self.memory.sampleWeighted(self.batchSize, self.getBeta())
+
+    def run(self):
+        """fill() on the background thread, keeping its exception for get()"""
+        try:
+            self.fill()
+        except Exception as error:
+            self.error = error
+
+    def fill(self):
+        while not self.stop.is_set():
+            try:
+                batch = self.sample()
+            except ValueError:
+                # not enough frames yet
+                time.sleep(0.01)
+                continue
+            states, actions, rewards, nextStates, terminals, weights, ids = batch
+            batch = (states.astype(np.float32), actions, rewards,
+                     nextStates.astype(np.float32), terminals.astype(np.float32),
+                     weights, ids)
+            while not self.stop.is_set():
+                try:
+                    self.batches.put(batch, timeout = 0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """returns the next batch, as sampleWeighted does, raising what
+        stopped the sampling thread if there are no more"""
+        start = time.time()
+        while True:
+            try:
+                batch = self.batches.get(timeout = 0.1)
+                break
+            except queue.Empty:
+                if self.error is not None:
+                    raise self.error
+        self.waitTime += time.time() - start
+        return batch
@@ -0,0 +1,39 @@
+import os
+
+import numpy as np
+
+from activations import READOUT, HIDDEN, ActivationLog, ActivationRecorder
+
+
+def record(path, steps, first = 0):
+    recorder = ActivationRecorder(path, actions = 2, hiddenUnits = 8, hiddenEvery = 2,
+                                  chunkRows = 16)
+    for step in range(first, first + steps):
+        recorder.record(step, np.full(2, step, dtype = np.float32),
+                        np.full(8, step, dtype = np.float32))
+    recorder.close()
+
+def readSteps(log, kind):
+    return np.concatenate([steps for steps, values in log.chunks(kind)]).tolist()
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'activations.bin')
+    record(path, 40)
+    log = ActivationLog(path)
+    assert readSteps(log, READOUT) == list(range(40))
+    assert readSteps(log, HIDDEN) == list(range(0, 40, 2))
+    assert log.summarizeReadouts()['steps'] == 40
+
+def test_restart_after_crash(tmp_path):
+    path = str(tmp_path / 'activations.bin')
+    record(path, 40)
+    # a crash in the middle of writing the last chunk
+    os.truncate(path, os.path.getsize(path) - 50)
+    intact = [steps.tolist() for steps, values in ActivationLog(path).chunks(READOUT)]
+
+    record(path, 40, first = 40)
+    log = ActivationLog(path)
+    steps = readSteps(log, READOUT)
+    assert steps[:sum(map(len, intact))] == sum(intact, [])
+    assert steps[-40:] == list(range(40, 80))
+    assert log.summarizeHidden()['samples'] > 0
@@ -0,0 +1,63 @@
+import numpy as np
+import pygame
+
+import benchmark
+import flappybird.flappy_new as game
+from flappybird import collision
+
+
+def getLegacyHitmasks():
+    return {
+        'pipe': [benchmark.legacyGetHitmask(image) for image in game.IMAGES['pipe']],
+        'player': [benchmark.legacyGetHitmask(image) for image in game.IMAGES['player']],
+    }
+
+def getRandomState(rng, game_state):
+    """player and one pipe pair overlapping it along x most of the time"""
+    pipeHeight = game.IMAGES['pipe'][0].get_height()
+    gapY = int(rng.randint(int(game.BASEY * 0.2), int(game.BASEY * 0.8 - game.PIPEGAPSIZE)))
+    pipeX = game_state.playerx + int(rng.randint(-70, 50))
+    player = {'x': game_state.playerx, 'y': int(rng.randint(-40, int(game.BASEY))),
+              'index': int(rng.randint(len(game.IMAGES['player'])))}
+    return (player, [{'x': pipeX, 'y': gapY - pipeHeight}],
+            [{'x': pipeX, 'y': gapY + game.PIPEGAPSIZE}])
+
+def test_hitmasks_match_legacy():
+    game.GameState(headless = True, observation = 'raster')
+    legacy = getLegacyHitmasks()
+    for name in ('pipe', 'player'):
+        for mask, legacyMask in zip(game.HITMASKS[name], legacy[name]):
+            assert np.array_equal(mask, np.array(legacyMask))
+
+def test_check_crash_matches_legacy():
+    game_state = game.GameState(headless = True, observation = 'raster')
+    legacy = getLegacyHitmasks()
+    rng = np.random.RandomState(0)
+    outcomes = set()
+    for i in range(2000):
+        player, upperPipes, lowerPipes = getRandomState(rng, game_state)
+        crash = game_state.checkCrash(dict(player), upperPipes, lowerPipes)
+        assert crash == benchmark.legacyCheckCrash(dict(player), upperPipes, lowerPipes, legacy)
+        outcomes.add(tuple(crash))
+    # ground crashes, pipe crashes and misses all come up
+    assert outcomes == {(True, True), (True, False), (False, False)}
+
+def test_pixel_collision_matches_legacy():
+    game.GameState(headless = True, observation = 'raster')
+    legacy = getLegacyHitmasks()
+    rng = np.random.RandomState(1)
+    collisions = 0
+    for i in range(2000):
+        index = rng.randint(len(game.IMAGES['player']))
+        pipe = rng.randint(2)
+        playerRect = pygame.Rect(int(rng.randint(0, 80)), int(rng.randint(0, 340)),
+                                 *game.IMAGES['player'][index].get_size())
+        pipeRect = pygame.Rect(int(rng.randint(0, 80)), int(rng.randint(0, 340)) - 160,
+                               *game.IMAGES['pipe'][pipe].get_size())
+        collide = collision.pixelCollision(playerRect, pipeRect, game.HITMASKS['player'][index],
+                                           game.HITMASKS['pipe'][pipe])
+        assert collide == benchmark.legacyPixelCollision(playerRect, pipeRect,
+                                                         legacy['player'][index],
+                                                         legacy['pipe'][pipe])
+        collisions += collide
+    assert 0 < collisions < 2000
@@ -0,0 +1,42 @@
+import numpy as np
+
+import evaluate
+
+
+def forward(stacks):
+    """rough policy flapping when the bird sinks to the bottom of the next
+    pipe's gap, read off the newest raster frame, indexed [x, y]. Games
+    differ by seed without the cost of a network"""
+    frame = stacks[0, :, :60, 0] > 0
+    bird = np.nonzero(frame[14:20].any(axis = 0))[0]
+    pipes = np.nonzero(frame[20:].sum(axis = 1) > 20)[0]
+    flap = False
+    if len(bird) and len(pipes):
+        gap = np.nonzero(~frame[20 + pipes[0]])[0]
+        flap = bird.max() > gap.max() - 2
+    elif len(bird):
+        flap = bird.max() > 40
+    return np.array([[0, flap]], dtype = np.float32), None
+
+def test_seeded_episodes_repeat():
+    seeds = range(4)
+    episodes = evaluate.playEpisodes(forward, seeds, max_steps = 300)
+    assert episodes == evaluate.playEpisodes(forward, seeds, max_steps = 300)
+    # forked workers play the same games
+    assert episodes == evaluate.playEpisodes(forward, seeds, max_steps = 300, workers = 2)
+    assert len(set(episodes)) > 1
+
+def test_no_steps():
+    game_state = evaluate.createGame()
+    assert evaluate.playEpisode(game_state, forward, 0, max_steps = 0) == (0, 0)
+
+def test_stats():
+    episodes = [(0, 50), (2, 120), (4, 300), (10, 300)]
+    stats = evaluate.getStats(episodes, 2.0, max_steps = 300)
+    assert stats['episodes'] == 4
+    assert stats['score mean'] == 4.0 and stats['score median'] == 3.0
+    assert stats['score min'] == 0 and stats['score max'] == 10
+    assert stats['score p25'] == np.percentile([0, 2, 4, 10], 25)
+    assert stats['length max'] == 300 and stats['capped'] == 2
+    assert stats['steps'] == 770 and stats['steps/s'] == 385.0
+    assert stats['scores'] == [0, 2, 4, 10]
@@ -0,0 +1,225 @@
+import os
+import random
+import subprocess
+import sys
+
+import numpy as np
+
+import flappybird.flappy_new as game
+from flappybird.flappy_vector import VectorGameState
+
+
+def getFlaps(steps, seed = 0):
+    return np.random.RandomState(seed).rand(steps) < 0.1
+
+def play(game_state, flaps):
+    """frames, rewards and terminals of frame_step with flaps"""
+    return [game_state.frame_step([1 - flap, flap]) for flap in flaps]
+
+def getPipes(game_state):
+    return [(pipe['x'], pipe['y']) for pipe in game_state.upperPipes + game_state.lowerPipes]
+
+def assertSameSteps(steps, others):
+    assert len(steps) == len(others)
+    for (frame, reward, terminal), (otherFrame, otherReward, otherTerminal) in zip(steps, others):
+        assert np.array_equal(frame, otherFrame)
+        assert reward == otherReward and terminal == otherTerminal
+
+def test_same_seed_same_pipes():
+    first = game.GameState(headless = True, observation = 'raster', seed = 5)
+    second = game.GameState(headless = True, observation = 'raster', seed = 5)
+    other = game.GameState(headless = True, observation = 'raster', seed = 6)
+    assert getPipes(first) == getPipes(second) != getPipes(other)
+    flaps = getFlaps(500)
+    assertSameSteps(play(first, flaps), play(second, flaps))
+    assert getPipes(first) == getPipes(second)
+
+    # reseeding starts the same pipes over
+    first.seed(5)
+    first.reInit()
+    second.seed(5)
+    second.reInit()
+    assert getPipes(first) == getPipes(second)
+
+def test_restore_replays_snapshot():
+    game_state = game.GameState(headless = True, observation = 'raster', seed = 1)
+    play(game_state, getFlaps(200))
+    record = game_state.snapshot()
+    flaps = getFlaps(600, seed = 1)
+    steps = play(game_state, flaps)
+    assert any(terminal for frame, reward, terminal in steps)
+
+    game_state.restore(record)
+    assert np.array_equal(game_state.snapshot(), record)
+    assertSameSteps(play(game_state, flaps), steps)
+
+def test_vector_matches_game(monkeypatch):
+    # both games get the same gaps, in the order they draw them
+    rng = random.Random(1)
+    gaps = [rng.randrange(int(game.BASEY * 0.6 - game.PIPEGAPSIZE)) for i in range(10000)]
+    gameGaps, vectorGaps = iter(gaps), iter(gaps)
+    monkeypatch.setattr(game, 'mix64', lambda seed, index: next(gameGaps))
+    game_state = game.GameState(headless = True, observation = 'raster')
+    games = VectorGameState(1)
+    monkeypatch.setattr(games, 'getRandomGapY', lambda count: np.array(
+        [next(vectorGaps) + int(game.BASEY * 0.2) for i in range(count)]))
+    games.reset(np.ones(1, dtype = bool))
+
+    policy = random.Random(2)
+    crashes = scores = 0
+    for step in range(1500):
+        # head for the gap of the next pipe, with some noise
+        nextPipe = [pipe for pipe in game_state.lowerPipes
+                    if pipe['x'] + games.pipeWidth > game_state.playerx][0]
+        flap = int(game_state.playery > nextPipe['y'] - 30 - policy.random() * 40)
+        frame, reward, terminal = game_state.frame_step([1 - flap, flap])
+        rewards, terminals = games.step([flap])
+        assert reward == rewards[0] and terminal == terminals[0]
+        assert game_state.playery == games.playery[0]
+        assert game_state.playerVelY == games.playerVelY[0]
+        count = games.pipeCount[0]
+        assert [pipe['x'] for pipe in game_state.upperPipes] == games.pipeX[0, :count].tolist()
+        assert [pipe['y'] for pipe in game_state.lowerPipes] == \
+            games.lowerPipeY[0, :count].tolist()
+        assert np.array_equal(frame, games.getObservations()[0])
+        crashes += terminal
+        scores += reward == 1
+    # the comparison covers crashes and scoring
+    assert crashes and scores
+
+def playTicks(game_state, flap, ticks):
+    """frame_step of a game without frame skip, repeated until it crashes"""
+    steps = []
+    while len(steps) < ticks and not (steps and steps[-1][2]):
+        steps.append(game_state.frame_step([1 - flap, flap]))
+    return steps
+
+def test_frame_skip_matches_ticks():
+    for maxPool in (False, True):
+        skipping = game.GameState(headless = True, observation = 'raster', seed = 2,
+                                  frameSkip = 3, maxPool = maxPool)
+        ticking = game.GameState(headless = True, observation = 'raster', seed = 2)
+        crashes = 0
+        for flap in getFlaps(400, seed = 3):
+            frame, reward, terminal = skipping.frame_step([1 - flap, flap])
+            ticks = playTicks(ticking, flap, 3)
+            # a crash ends the step at its tick, the next one starts the new game
+            assert terminal == ticks[-1][2]
+            assert len(ticks) == 3 or terminal
+            assert np.array_equal(skipping.snapshot(), ticking.snapshot())
+            if terminal:
+                crashes += 1
+                assert reward == -1
+                assert np.array_equal(frame, ticks[-1][0])
+            else:
+                assert reward == sum(tickReward for tickFrame, tickReward, end in ticks)
+                expected = ticks[-1][0]
+                if maxPool:
+                    expected = np.maximum(expected, ticks[-2][0])
+                assert np.array_equal(frame, expected)
+        assert crashes
+
+def test_crash_after_score_in_one_step():
+    game_state = game.GameState(headless = True, observation = 'raster', seed = 3)
+    probe = game.GameState(headless = True, observation = 'raster', seed = 3)
+    policy = random.Random(2)
+    for step in range(3000):
+        # head for the gap of the next pipe, with some noise
+        nextPipe = [pipe for pipe in game_state.lowerPipes
+                    if pipe['x'] + game.IMAGES['pipe'][0].get_width() > game_state.playerx][0]
+        flap = int(game_state.playery > nextPipe['y'] - 30 - policy.random() * 40)
+        record = game_state.snapshot()
+        game_state.frame_step([1 - flap, flap])
+        # holding an action from here, does a pipe pass before a crash?
+        for hold in (0, 1):
+            probe.restore(record)
+            probe.frameSkip = 1
+            ticks = playTicks(probe, hold, 4)
+            if ticks[-1][2] and any(reward == 1 for frame, reward, end in ticks):
+                probe.restore(record)
+                probe.frameSkip = len(ticks)
+                frame, reward, terminal = probe.frame_step([1 - hold, hold])
+                assert terminal and reward == -1
+                return
+    assert False, 'no crash right after passing a pipe'
+
+def test_games_created_in_threads_see_all_assets():
+    # a fresh process, this one has loaded the assets already
+    script = '''
+import threading
+import flappybird.flappy_new as game
+barrier = threading.Barrier(8)
+missing = []
+def create():
+    barrier.wait()
+    game_state = game.GameState(headless=True, observation='raster')
+    if 'player' not in game.HITMASKS or 'pipe' not in game.IMAGES:
+        missing.append(True)
+    game_state.frame_step([1, 0])
+threads = [threading.Thread(target=create) for i in range(8)]
+for thread in threads:
+    thread.start()
+for thread in threads:
+    thread.join()
+assert not missing and game.ASSETSLOADED
+'''
+    subprocess.check_call([sys.executable, '-c', script])
+
+def test_headless_picks_dummy_driver():
+    # a fresh process, this one has started its display already
+    script = '''
+import os
+import pygame
+import flappybird.flappy_new as game
+game_state = game.GameState(headless=True, observation='raster')
+assert pygame.display.get_driver() == 'dummy'
+assert os.environ['SDL_VIDEODRIVER'] == 'x11'
+'''
+    env = dict(os.environ, SDL_VIDEODRIVER = 'x11')
+    subprocess.check_call([sys.executable, '-c', script], env = env)
+
+def test_features_scaled_from_game_state():
+    game_state = game.GameState(headless = True, observation = 'features', seed = 4)
+    policy = random.Random(1)
+    pipeW = game.IMAGES['pipe'][0].get_width()
+    features = []
+    for step in range(3000):
+        feature, reward, terminal = game_state.frame_step(
+            [1, 0] if policy.random() < 0.9 else [0, 1])
+        assert feature.shape == (game.FEATURECOUNT,) and feature.dtype == np.float32
+        if not terminal:
+            # the pipes still ahead of the player, nearest first
+            pipes = [(upper['x'], upper['y'], lower['y'])
+                     for upper, lower in zip(game_state.upperPipes, game_state.lowerPipes)
+                     if upper['x'] + pipeW > game_state.playerx]
+            expected = [game_state.playery / game.SCREENHEIGHT,
+                        game_state.playerVelY / float(game_state.playerMaxVelY)]
+            for x, upperY, lowerY in pipes[:2]:
+                expected += [(x - game_state.playerx) / game.SCREENWIDTH,
+                             upperY / game.SCREENHEIGHT, lowerY / game.SCREENHEIGHT]
+            assert np.allclose(feature, expected)
+        features.append(feature)
+    features = np.array(features)
+    assert features.min() >= -1 and features.max() <= 2
+    # the next pipe's distance sweeps the screen, every gap is PIPEGAPSIZE high
+    assert features[:, 2].min() < 0 and features[:, 2].max() > 0.8
+    pipeH = game.IMAGES['pipe'][0].get_height()
+    for upperY, lowerY in ((3, 4), (6, 7)):
+        gaps = (features[:, lowerY] - features[:, upperY]) * game.SCREENHEIGHT - pipeH
+        assert np.allclose(gaps, game.PIPEGAPSIZE, atol = 1e-3)
+
+def test_features_mark_missing_pipes():
+    game_state = game.GameState(headless = True, observation = 'features', seed = 4)
+    features = game_state.getFeatures()
+    assert not np.allclose(features[5:], game.MISSINGPIPE)
+
+    # only the first pipe ahead, as right after a restore() of a trimmed game
+    del game_state.upperPipes[1:], game_state.lowerPipes[1:]
+    trimmed = game_state.getFeatures()
+    assert np.array_equal(trimmed[:5], features[:5])
+    assert np.allclose(trimmed[5:], game.MISSINGPIPE)
+
+    # none ahead
+    for pipe in game_state.upperPipes + game_state.lowerPipes:
+        pipe['x'] = game_state.playerx - 100
+    assert np.allclose(game_state.getFeatures()[2:], game.MISSINGPIPE * 2)
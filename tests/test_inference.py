@@ -0,0 +1,76 @@
+import threading
+import time
+
+import numpy as np
+
+from inference import InferenceServer
+
+
+def createServer(maxBatch, maxWait, batches, release = None):
+    def evaluate(stacks):
+        batches.append(len(stacks))
+        if release is not None:
+            release.wait()
+        time.sleep(0.005)
+        # Q values that tell which stack they came from
+        return stacks[:, 0, :].astype(np.float32) * [-1, 1]
+    return InferenceServer(evaluate, maxBatch, maxWait, stackShape = (1, 2))
+
+def actFromThreads(server, clients, requests):
+    results = dict((client, []) for client in range(clients))
+    barrier = threading.Barrier(clients)
+
+    def client(index):
+        barrier.wait()
+        for i in range(requests):
+            stack = np.full((1, 2), index * requests + i, dtype = np.uint8)
+            results[index].append(server.act(stack))
+
+    threads = [threading.Thread(target = client, args = (index,)) for index in range(clients)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+def joinAll(threads, timeout = 10):
+    deadline = time.time() + timeout
+    for thread in threads:
+        thread.join(max(deadline - time.time(), 0))
+    return not any(thread.is_alive() for thread in threads)
+
+def test_threads_share_batches():
+    batches = []
+    server = createServer(8, 0.02, batches)
+    server.start()
+    threads, results = actFromThreads(server, 16, 10)
+    assert joinAll(threads)
+    server.close()
+
+    # every client gets the Q values of its own stacks, in order
+    for index, actions in results.items():
+        for i, (action, readout) in enumerate(actions):
+            value = index * 10 + i
+            assert readout.tolist() == [-value, value]
+            assert action == int(value > 0)
+    assert sum(batches) == 160 and max(batches) <= 8
+    assert len(batches) < 160
+    stats = server.getStats()
+    assert stats['requests'] == 160 and stats['batches'] == len(batches)
+
+def test_close_serves_waiting_requests():
+    batches = []
+    release = threading.Event()
+    server = createServer(4, 0.05, batches, release)
+    server.start()
+    threads, results = actFromThreads(server, 6, 1)
+    # the first batch is held up until the rest of the requests queue behind it
+    deadline = time.time() + 10
+    while not batches or server.requests.qsize() < 6 - batches[0]:
+        assert time.time() < deadline
+        time.sleep(0.001)
+    closer = threading.Thread(target = server.close)
+    closer.start()
+    release.set()
+    # nobody is left waiting, not the clients and not close()
+    assert joinAll(threads + [closer])
+    assert not server.thread.is_alive()
+    assert sum(len(actions) for actions in results.values()) == 6
@@ -0,0 +1,99 @@
+import json
+import os
+import urllib.request
+
+import pytest
+
+from metrics import Metrics
+
+
+def readLines(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+def fetch(metrics, path):
+    url = 'http://127.0.0.1:%d%s' % (metrics.server.server_address[1], path)
+    with urllib.request.urlopen(url, timeout = 5) as response:
+        return response.headers['Content-Type'], response.read().decode()
+
+def test_flush_writes_interval_records(tmp_path):
+    metrics = Metrics(str(tmp_path), 'train', flushSeconds = 1e9)
+    clock = metrics.now()
+    for step in range(3):
+        clock = metrics.lap('act', clock)
+        metrics.count('frames', 4)
+        metrics.tick()
+    metrics.score(2)
+    metrics.score(4)
+    metrics.flush()
+    metrics.tick()
+    metrics.close()
+
+    first, second = readLines(os.path.join(str(tmp_path), 'train.jsonl'))
+    assert first['steps'] == 3 and first['stages']['act']['calls'] == 3
+    assert first['counters'] == {'frames': 12}
+    assert first['games'] == 2 and first['score mean'] == 3 and first['score max'] == 4
+    # stages and scores are per interval, counters since start
+    assert second['steps'] == 1 and second['stages'] == {} and 'games' not in second
+    assert second['counters'] == {'frames': 12}
+
+def test_log_rotates_after_max_bytes(tmp_path):
+    metrics = Metrics(str(tmp_path), 'train', flushSeconds = 1e9, maxBytes = 1000, backups = 2)
+    for i in range(50):
+        metrics.gauge('index', i)
+        metrics.tick()
+        metrics.flush()
+    metrics.close()
+
+    names = sorted(os.listdir(str(tmp_path)))
+    assert names == ['train.jsonl', 'train.jsonl.1', 'train.jsonl.2']
+    for name in names:
+        assert os.path.getsize(os.path.join(str(tmp_path), name)) <= 1000
+    # the newest records are in the current file, older ones in the backups
+    assert readLines(os.path.join(str(tmp_path), 'train.jsonl'))[-1]['gauges'] == {'index': 49}
+    current = readLines(os.path.join(str(tmp_path), 'train.jsonl'))[0]['gauges']['index']
+    backup = readLines(os.path.join(str(tmp_path), 'train.jsonl.1'))[-1]['gauges']['index']
+    assert backup == current - 1
+
+def test_endpoint_serves_latest_flush(tmp_path):
+    metrics = Metrics(str(tmp_path), 'flappy-bird', flushSeconds = 1e9, port = 0)
+    try:
+        contentType, body = fetch(metrics, '/')
+        assert contentType == 'application/json'
+        assert json.loads(body)['steps'] == 0
+
+        clock = metrics.now()
+        for step in range(5):
+            clock = metrics.lap('train', clock)
+            metrics.tick()
+        metrics.count('frames', 20)
+        metrics.gauge('epsilon', 0.5)
+        # nothing is served before the interval is flushed
+        assert json.loads(fetch(metrics, '/')[1])['steps'] == 0
+        metrics.flush()
+
+        totals = json.loads(fetch(metrics, '/')[1])
+        assert totals['steps'] == 5 and totals['stage calls'] == {'train': 5}
+        assert totals['counters'] == {'frames': 20} and totals['gauges'] == {'epsilon': 0.5}
+        assert totals['latest']['steps'] == 5
+
+        contentType, body = fetch(metrics, '/metrics')
+        assert contentType.startswith('text/plain')
+        lines = body.splitlines()
+        assert 'flappy_bird_steps_total 5' in lines
+        assert 'flappy_bird_stage_calls_total{stage="train"} 5' in lines
+        assert 'flappy_bird_frames_total 20' in lines
+        assert 'flappy_bird_epsilon 0.5' in lines
+    finally:
+        metrics.close()
+
+def test_close_stops_server_thread(tmp_path):
+    metrics = Metrics(str(tmp_path), 'train', flushSeconds = 1e9, port = 0)
+    fetch(metrics, '/')
+    address = metrics.server.server_address
+    assert metrics.thread.is_alive()
+    metrics.close()
+
+    assert not metrics.thread.is_alive()
+    with pytest.raises(OSError):
+        urllib.request.urlopen('http://127.0.0.1:%d/' % address[1], timeout = 1)
@@ -0,0 +1,26 @@
+import numpy as np
+
+import network
+import quantize
+
+
+def createNetworks():
+    weights = network.initWeights(seed = 0)
+    forward = lambda stacks: network.forward(weights, stacks)
+    quantized = quantize.QuantizedNetwork(weights, quantize.getStacks(forward, 200, seed = 1))
+    return weights, forward, quantized
+
+def test_agrees_with_float():
+    weights, forward, quantized = createNetworks()
+    stacks = quantize.getStacks(forward, 300, seed = 2)
+    readout, hidden = forward(stacks)
+    quantizedReadout, quantizedHidden = quantized.forward(stacks)
+    assert np.mean(readout.argmax(axis = 1) == quantizedReadout.argmax(axis = 1)) >= 0.95
+    assert np.abs(readout - quantizedReadout).max() < 0.1 * np.abs(readout).max()
+    # batches are split into chunks like network.forward
+    assert np.array_equal(quantized.forward(stacks[:1])[0], quantizedReadout[:1])
+
+def test_quarter_of_float_size():
+    weights, forward, quantized = createNetworks()
+    floatBytes = sum(weight.nbytes for weight in weights.values())
+    assert quantized.nbytes < 0.26 * floatBytes
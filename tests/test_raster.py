@@ -0,0 +1,7 @@
+import benchmark
+
+
+def test_raster_matches_cv2():
+    # raises AssertionError below benchmark.RASTER_AGREEMENT
+    agreement, cv2Time, rasterTime = benchmark.benchRaster(500)
+    assert agreement >= benchmark.RASTER_AGREEMENT
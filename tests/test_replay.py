@@ -0,0 +1,177 @@
+import time
+
+import numpy as np
+import pytest
+
+from replay import BatchPrefetcher, PrioritizedReplayMemory, ReplayMemory, ShardedReplayMemory, \
+    SumTree
+
+
+def test_sum_tree_update_nothing():
+    tree = SumTree(8)
+    tree.update(np.arange(4), np.ones(4))
+    tree.update(np.zeros(0, dtype = np.int64), np.zeros(0))
+    assert tree.total == 4
+
+def test_update_overwritten_slots():
+    memory = PrioritizedReplayMemory(16, frameShape = (2,))
+    memory.start(np.zeros(2))
+    for i in range(8):
+        memory.append(np.full(2, i), i % 2, 0, False)
+    # every sampled slot was written over by a new game since
+    slots = np.arange(1, 5)
+    memory.priorities.update(slots, np.zeros(len(slots)))
+    memory.updatePriorities(slots, np.ones(len(slots)))
+    assert np.all(memory.priorities[slots] == 0)
+
+def test_update_rewritten_since_sampled():
+    memory = PrioritizedReplayMemory(32, frameShape = (2,))
+    memory.start(np.zeros(2))
+    for i in range(20):
+        memory.append(np.full(2, i), i % 2, 0, False)
+    slots = np.array([6, 7, 14, 15])
+    ids = memory.getSampleIds(slots)
+    # slots 6 and 7 now hold new transitions, still sampleable
+    for i in range(20, 40):
+        memory.append(np.full(2, i), i % 2, 0, False)
+    before = memory.priorities[slots]
+    memory.updatePriorities(ids, np.full(4, 10.0))
+    after = memory.priorities[slots]
+    assert np.all(before > 0)
+    assert np.array_equal(after[:2], before[:2])
+    assert np.all(after[2:] > before[2:])
+
+def test_sharded_sample_ids():
+    memory = ShardedReplayMemory(2, 32, PrioritizedReplayMemory, frameShape = (2,))
+    for shard in range(2):
+        memory.start(shard, np.zeros(2))
+        for i in range(12):
+            memory.append(shard, np.full(2, i), i % 2, 0, False)
+    ids = memory.sampleWeighted(64)[-1]
+    memory.updatePriorities(ids, np.full(len(ids), 10.0))
+    for shard in range(2):
+        chosen = ids[ids % 2 == shard] // 2
+        assert np.all(memory.shards[shard].priorities[chosen % 16] > 1)
+
+def test_reload_after_crash(tmp_path):
+    directory = str(tmp_path)
+    # frames hold the order they were written in
+    memory = ReplayMemory(16, frameShape = (1,), directory = directory)
+    memory.start(np.zeros(1))
+    for i in range(1, 25):
+        memory.append(np.full(1, i), 0, 0, False)
+    memory.save()
+    # written to the mapped files, but the process dies before the next save
+    for i in range(25, 29):
+        memory.append(np.full(1, i), 1, 1, False)
+    del memory
+
+    memory = ReplayMemory(16, frameShape = (1,), directory = directory)
+    assert memory.head == 9 and memory.count == 16
+    assert memory.starts[9:14].all()
+    for age in range(memory.getMass()):
+        slot = (memory.head - 1 - age) % memory.capacity
+        if memory.starts[slot]:
+            continue
+        indices = memory.stackIndices(np.array([(slot - 1) % memory.capacity, slot]))
+        frames = memory.frames.gather(indices)[..., 0]
+        # both stacks are frames written one after the other
+        assert frames[1, 0] == frames[0, 0] + 1
+        assert np.all(np.isin(frames[:, :-1] - frames[:, 1:], (0, 1)))
+
+def test_stacks_newest_frame_first():
+    memory = ReplayMemory(16, frameShape = (2, 3))
+    memory.start(np.zeros((2, 3)))
+    for i in range(1, 10):
+        memory.append(np.full((2, 3), i), 0, 0, i == 5)
+    stacks = memory.getStacks(np.array([3, 8]))
+    assert stacks.shape == (2, 2, 3, 4)
+    assert stacks[0, 0, 0].tolist() == [3, 2, 1, 0]
+    # a terminal frame starts the next game
+    assert stacks[1, 1, 2].tolist() == [8, 7, 6, 5]
+    assert np.array_equal(stacks.astype(np.float32)[..., 1], np.array([2, 7])[:, None, None] * np.ones((2, 3)))
+
+def test_save_earlier_position(tmp_path):
+    directory = str(tmp_path)
+    memory = ReplayMemory(16, frameShape = (1,), directory = directory)
+    memory.start(np.zeros(1))
+    for i in range(1, 8):
+        memory.append(np.full(1, i), 0, 0, False)
+    position = memory.getPosition()
+    # written while a checkpoint thread saves the position taken before
+    for i in range(8, 11):
+        memory.append(np.full(1, i), 0, 0, False)
+    memory.save(position)
+    del memory
+
+    memory = ReplayMemory(16, frameShape = (1,), directory = directory)
+    assert memory.getPosition() == position
+    assert memory.starts[8:12].all()
+
+class CountingMemory:
+    """memory stand-in counting samples, raising error after fail of them"""
+
+    def __init__(self, memory, fail = None, error = RuntimeError('sampling failed')):
+        self.memory = memory
+        self.samples = 0
+        self.fail = fail
+        self.error = error
+
+    def sampleWeighted(self, batchSize, beta = 1.0):
+        if self.samples == self.fail:
+            raise self.error
+        self.samples += 1
+        return self.memory.sampleWeighted(batchSize, beta)
+
+def createFullMemory():
+    memory = ReplayMemory(64, frameShape = (4, 4))
+    memory.start(np.zeros((4, 4)))
+    for i in range(40):
+        memory.append(np.full((4, 4), i), i % 2, 0, False)
+    return memory
+
+def waitFor(condition, timeout = 10):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.01)
+
+def test_prefetcher_queue_depth():
+    memory = CountingMemory(createFullMemory())
+    prefetcher = BatchPrefetcher(memory, 8, depth = 3)
+    prefetcher.start()
+    waitFor(lambda: prefetcher.batches.full())
+    time.sleep(0.1)
+    # one more batch waits for room in the queue, nothing past it is sampled
+    assert memory.samples == 4
+    states, actions, rewards, nextStates, terminals, weights, ids = prefetcher.get()
+    assert states.dtype == np.float32 and states.shape == (8, 4, 4, 4)
+    assert states.flags['C_CONTIGUOUS'] and nextStates.flags['C_CONTIGUOUS']
+    waitFor(lambda: memory.samples == 5)
+
+    start = time.time()
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive() and time.time() - start < 1
+
+def test_prefetcher_waits_for_frames():
+    memory = CountingMemory(createFullMemory(), fail = 0, error = ValueError('not enough'))
+    prefetcher = BatchPrefetcher(memory, 8)
+    prefetcher.start()
+    time.sleep(0.05)
+    # too few frames only means trying again
+    assert prefetcher.thread.is_alive()
+    memory.fail = None
+    assert len(prefetcher.get()) == 7
+    prefetcher.close()
+
+def test_prefetcher_raises_sampling_errors():
+    memory = CountingMemory(createFullMemory(), fail = 2)
+    prefetcher = BatchPrefetcher(memory, 8, depth = 4)
+    prefetcher.start()
+    # batches sampled before the error come first
+    prefetcher.get()
+    prefetcher.get()
+    with pytest.raises(RuntimeError, match = 'sampling failed'):
+        prefetcher.get()
+    assert not prefetcher.thread.is_alive()
+    prefetcher.close()
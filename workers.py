@@ -0,0 +1,35 @@
+"""
+Map a function over tasks in forked worker processes, each holding state
+made once by a setup function, for example a game and a network
+"""
+import multiprocessing
+
+# set in each worker process by startWorker
+worker_state = None
+
+def startWorker(setup, args):
+    global worker_state
+    worker_state = setup(*args)
+
+def runWorkerTask(args):
+    run, task = args
+    return run(worker_state, task)
+
+"""
+Return run(state, task) for every task, in order, where state is
+setup(*args) made once per worker. Uses workers forked processes when there
+are more than one, which inherit setup and args without pickling them, and
+this process otherwise
+"""
+def mapWorkers(run, tasks, setup, args = (), workers = 1):
+    if workers <= 1:
+        state = setup(*args)
+        return [run(state, task) for task in tasks]
+    context = multiprocessing.get_context('fork')
+    pool = context.Pool(workers, initializer = startWorker, initargs = (setup, args))
+    try:
+        return pool.map(runWorkerTask, [(run, task) for task in tasks], chunksize = 1)
+    finally:
+        # SDL catches SIGTERM, so workers are let finish instead of terminated
+        pool.close()
+        pool.join()